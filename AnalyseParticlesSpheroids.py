@@ -1,21 +1,31 @@
 import os
 import re
 import csv
-from ij import IJ, WindowManager
+import sys
+import argparse
+import threading
+import time
+from ij import IJ
 from ij.io import FileSaver
+from java.awt import Color
+from java.util.concurrent import Callable, Executors
 from ij.plugin.frame import RoiManager
-from ij.gui import GenericDialog, Roi
+from ij.gui import GenericDialog, Roi, ShapeRoi, ImageRoi, Overlay
 from ij.plugin import Duplicator
 from ij.plugin.filter import ParticleAnalyzer
-from ij.measure import ResultsTable
+from ij.measure import ResultsTable, Measurements
+from ij.process import LUT
+from toolbox_common import AsyncWriter, parseShard, saveRois, selectShard, shardTag, stopPool, summaryTable, timer
+
+writer = None
 
 # Function to save images as TIFF
-def savetif(img, out_file):
-    FileSaver(img).saveAsTiff(out_file + ".tif")
+def savetif(img, out_file, close=False):
+    writer.submit(FileSaver(img).saveAsTiff, out_file + ".tif", img, close)
 
 # Function to save images as PNG
-def savepng(img, out_file):
-    FileSaver(img).saveAsPng(out_file + ".png")
+def savepng(img, out_file, close=False):
+    writer.submit(FileSaver(img).saveAsPng, out_file + ".png", img, close)
 
 # Function to set up directories
 def setup_directories(outDir):
@@ -25,14 +35,192 @@ def setup_directories(outDir):
         if not os.path.isdir(os.path.join(outDir, subdir)):
             os.makedirs(os.path.join(outDir, subdir))
 
-# Function to process images and analyze particles
-def process_images(inDir_segmented, indir_cropped, outDir, fileExt, sample_nme_pattern, sample_nme_time_pattern, segmented_nme_pattern, re_crop, time_series, scale_factor, channel_spheroid, particle_size_min):
+# Particle analysis with a private ROI list and results table per call, so that images can be analysed concurrently
+particleLock = threading.Lock()
+particleMeasurements = Measurements.AREA | Measurements.MEAN | Measurements.CENTER_OF_MASS | Measurements.ELLIPSE
+
+
+class Particles(object):
+    """ROIs, names and measurements (area, mean, center of mass, fitted ellipse) of the particles of one image."""
+
+    def __init__(self, title, rois, names, table, imageArea):
+        self.title = title
+        self.rois = rois
+        self.names = names
+        self.table = table
+        self.imageArea = imageArea
+
+    def count(self):
+        return len(self.rois)
+
+    def column(self, name):
+        return [self.table.getValue(name, i) for i in range(self.table.size())]
+
+    def summary(self):
+        """The row Analyze Particles adds to the Summary window with 'summarize'."""
+        areas, means = self.column("Area"), self.column("Mean")
+        total = sum(areas)
+        return [("Slice", self.title), ("Count", len(areas)), ("Total Area", total),
+                ("Average Size", total / len(areas) if areas else float('nan')),
+                ("%Area", 100.0 * total / self.imageArea), ("Mean", sum(means) / len(means) if means else float('nan'))]
+
+
+def analyzeParticles(imp, minSize, maxSize=float('inf'), minCirc=0.0, maxCirc=1.0, exclude=False, composite=False,
+                     overlay=False):
+    """Analyze Particles... on a binary image, with the size range in calibrated units as in its dialog."""
+    cal = imp.getCalibration()
+    pixelArea = cal.pixelWidth * cal.pixelHeight
+    options = ParticleAnalyzer.ADD_TO_MANAGER
+    if exclude:
+        options |= ParticleAnalyzer.EXCLUDE_EDGE_PARTICLES
+    if composite:
+        options |= ParticleAnalyzer.COMPOSITE_ROIS
+    if overlay:
+        options |= ParticleAnalyzer.SHOW_OVERLAY_OUTLINES
+    table = ResultsTable()
+    manager = RoiManager(False)
+    with particleLock:
+        # the hidden ROI manager reaches the analyzer through a static field, so the hand-over must not interleave
+        ParticleAnalyzer.setRoiManager(manager)
+        analyzer = ParticleAnalyzer(options, particleMeasurements, table, minSize / pixelArea, maxSize / pixelArea,
+                                    minCirc, maxCirc)
+        analyzer.analyze(imp)
+    rois = list(manager.getRoisAsArray())
+    names = [manager.getName(i) for i in range(manager.getCount())]
+    manager.reset()
+    return Particles(imp.getTitle(), rois, names, table, imp.getWidth() * imp.getHeight() * pixelArea)
+
+
+# Function to analyse one image: spheroid, vessel area and particles on the vessels
+class ImageResult(object):
+    """Summary rows (spheroid, vessel area, particles on the vessels) of one image, or why it was skipped."""
+
+    def __init__(self, key):
+        self.key = key
+        self.rows = []
+        self.skipped = None
+
+
+def closeImages(*images):
+    for imp in images:
+        imp.changes = False
+        imp.close()
+
+
+def analyse_image(key, segment_file, sample, outDir, re_crop, scale_factor, particle_size_min):
+    result = ImageResult(key)
     dupl = Duplicator()
-    rtt = ResultsTable().getResultsTable()
-    rt = ResultsTable().getResultsTable()
-    wm = WindowManager
+    with timer.stage("open", key, os.path.getsize(segment_file) + os.path.getsize(key)):
+        img = IJ.openImage(segment_file)
+        img = dupl.run(img, 1, 1, 1, 1, 1, 1)
+        targetimg = IJ.openImage(key)
 
-    IJ.run("Set Measurements...", "area mean center fit redirect=None decimal=0")
+    start = time.time()
+    targetimg = dupl.run(targetimg, 1, 1, 1, 1, 1, 1)
+    IJ.run(targetimg, "Gaussian Blur...", "sigma=1 scaled")
+    IJ.run(targetimg, "Auto Threshold", "method=Otsu white")
+    IJ.run(targetimg, "Convert to Mask", "")
+    IJ.run(targetimg, "Dilate", "")
+    IJ.run(targetimg, "Dilate", "")
+    IJ.run(targetimg, "Erode", "")
+    IJ.run(targetimg, "Erode", "")
+    IJ.run(targetimg, "Dilate", "")
+    spheroids = analyzeParticles(targetimg, particle_size_min, exclude=True, overlay=True)
+
+    # re-crop around the spheroid if needed
+    if re_crop:
+        if spheroids.count() != 1:
+            result.skipped = "Skipping" + key + ("because more than 1 tROI" if spheroids.count() else "because no tROI")
+            closeImages(img, targetimg)
+            return result
+        calibration = targetimg.getCalibration()
+        resol = 1 / calibration.pixelWidth
+        xpt = spheroids.table.getValue("XM", 0) * resol
+        ypt = spheroids.table.getValue("YM", 0) * resol
+        sidelen = spheroids.table.getValue("Major", 0) * resol * scale_factor
+        roi = Roi(xpt - sidelen / 2, ypt - sidelen / 2, sidelen, sidelen)
+        targetimg.setRoi(roi)
+        targetimg = targetimg.crop()
+        img.setRoi(roi)
+        img = img.crop()
+    targetimg.deleteRoi()
+    # get the spheroid to measure to size
+    spheroid = analyzeParticles(targetimg, particle_size_min, exclude=True, overlay=True)
+    spheroid.table.setPrecision(0)
+    spheroid.table.save(os.path.join(outDir, 'SphereMeasurements', sample + "measurements.csv"))
+    result.rows.append(spheroid.summary())
+    targetimg.deleteRoi()
+    img.deleteRoi()
+    timer.add("spheroid", key, time.time() - start, None)
+
+    # get vessel ROI
+    start = time.time()
+    IJ.run(img, "Auto Threshold", "method=Default white")
+    IJ.run(img, "Convert to Mask", "")
+    IJ.run(img, "Invert", "")
+    IJ.run(img, "Dilate", "")
+    IJ.run(img, "Erode", "")
+    IJ.run(img, "Erode", "")
+    IJ.run(img, "Erode", "")
+    IJ.run(img, "Dilate", "")
+    IJ.run(img, "Dilate", "")
+    IJ.run(img, "Dilate", "")
+    IJ.run(img, "Erode", "")
+    IJ.run(img, "Dilate", "")
+    IJ.run(img, "Erode", "")
+    IJ.run(img, "Dilate", "")
+    vessels = analyzeParticles(img, 100, composite=True)
+    result.rows.append(vessels.summary())
+    if not vessels.rois:
+        result.skipped = "Skipping" + key + "because no vessel ROI"
+        closeImages(img, targetimg)
+        return result
+    vroi = vessels.rois[0]
+    for roi in vessels.rois[1:]:
+        # 'or' is a keyword in Python, so ShapeRoi.or is looked up by name
+        vroi = getattr(ShapeRoi(vroi), "or")(ShapeRoi(roi))
+    saveRois([vroi], ["vessels" if vessels.count() > 1 else vessels.names[0]],
+             os.path.join(outDir, "ROI", sample + "vROIs.zip"))  # save the vROIs
+    timer.add("vessel ROI", key, time.time() - start, None)
+
+    # vROI on the spheroid image
+    start = time.time()
+    targetimg.setRoi(vroi)
+    IJ.run(targetimg, "Make Inverse", "")
+    IJ.run(targetimg, "Clear", "slice")
+    targetimg.deleteRoi()
+    img.deleteRoi()
+
+    particles = analyzeParticles(targetimg, 50, minCirc=0.5, exclude=True)
+    result.rows.append(particles.summary())
+    if particles.count() > 0:
+        saveRois(particles.rois, particles.names, os.path.join(outDir, "ROI", sample + "tROIs.zip"))  # save the tROI
+    timer.add("particles", key, time.time() - start, None)
+    with timer.stage("overlay", key):
+        img.getProcessor().setLut(LUT.createLutFromColor(Color.green))
+        vesselOverlay = ImageRoi(0, 0, img.getProcessor())
+        vesselOverlay.setOpacity(0.4)
+        overlay = targetimg.getOverlay() or Overlay()
+        overlay.add(vesselOverlay)
+        targetimg.setOverlay(overlay)
+    savepng(targetimg.flatten(), os.path.join(outDir, "overlay", sample))
+    closeImages(img, targetimg)
+    return result
+
+
+class ImageTask(Callable):
+    def __init__(self, *args):
+        self.args = args
+
+    def call(self):
+        return analyse_image(*self.args)
+
+
+# Function to process images and analyze particles
+def process_images(inDir_segmented, indir_cropped, outDir, fileExt, sample_nme_pattern, sample_nme_time_pattern, segmented_nme_pattern, re_crop, time_series, scale_factor, channel_spheroid, particle_size_min, shard=None, parallelPref=1):
+    global writer
+    timer.reset()
+    writer = AsyncWriter(1, 4 + parallelPref)
 
     # find the WEKA classified files and the matching tifs in the same folder
     fl_dict = dict()
@@ -59,111 +247,36 @@ def process_images(inDir_segmented, indir_cropped, outDir, fileExt, sample_nme_p
                         fl = os.path.join(indir_cropped, targetfile)
                 fl_dict.update({fl: segment_file})
 
-    for key in fl_dict:
-        rt = ResultsTable().getResultsTable()
-        rm = RoiManager().getInstance()
-        rm.reset()
-        img = IJ.openImage(fl_dict[key])
-        img = dupl.run(img, 1, 1, 1, 1, 1, 1)
-        targetimg = IJ.openImage(key)
+    tasks = []
+    for key in selectShard(sorted(fl_dict), shard):
         if time_series:
             sample = re.findall(sample_nme_time_pattern, key)[0]
         else:
             sample = re.findall(sample_nme_pattern, key)[0]
-
-        targetimg = dupl.run(targetimg, 1, 1, 1, 1, 1, 1)
-        IJ.run(targetimg, "Gaussian Blur...", "sigma=1 scaled")
-        IJ.run(targetimg, "Auto Threshold", "method=Otsu white")
-        IJ.run(targetimg, "Convert to Mask", "")
-        IJ.run(targetimg, "Dilate", "")
-        IJ.run(targetimg, "Dilate", "")
-        IJ.run(targetimg, "Erode", "")
-        IJ.run(targetimg, "Erode", "")
-        IJ.run(targetimg, "Dilate", "")
-        IJ.run(targetimg, "Analyze Particles...",
-               "size=" + str(particle_size_min) + "-Infinity show=Overlay display exclude clear add")
-
-        # re-crop around the spheroid if needed
-        if re_crop:
-            if rm.getCount() > 1:
-                IJ.log("Skipping" + key + "because more than 1 tROI")
-                targetimg = targetimg
-                continue
+        tasks.append(ImageTask(key, fl_dict[key], sample, outDir, re_crop, scale_factor, particle_size_min))
+
+    # the images are analysed concurrently, their Summary rows are collected in input order
+    summary_rows = []
+    pool = Executors.newFixedThreadPool(parallelPref)
+    completed = False
+    try:
+        for future in [pool.submit(task) for task in tasks]:
+            result = future.get()
+            if result.skipped is not None:
+                IJ.log(result.skipped)
             else:
-                calibration = targetimg.getCalibration()
-                resol = 1 / calibration.pixelWidth
-                xpt = rt.getValue("XM", 0) * resol
-                ypt = rt.getValue("YM", 0) * resol
-                sidelen = rt.getValue("Major", 0) * resol * scale_factor
-                roi = Roi(xpt - sidelen / 2, ypt - sidelen / 2, sidelen, sidelen)
-                rm.addRoi(roi)
-                rm.select(targetimg, 1)
-                targetimg = targetimg.crop()
-                rm.select(img, 1)
-                img = img.crop()
-        IJ.run(targetimg, "Select None", "")
-        # get the spheroid to measure to size
-        IJ.run(targetimg, "Analyze Particles...",
-               "size=" + str(particle_size_min) + "-Infinity show=Overlay display exclude clear summarize add")
-        rt.save(os.path.join(outDir, 'SphereMeasurements', sample + "measurements.csv"))
-        IJ.run(targetimg, "Select None", "")
-        IJ.run(img, "Select None", "")
-        rm.reset()
-
-        # get vessel ROI
-        IJ.run(img, "Auto Threshold", "method=Default white")
-        IJ.run(img, "Convert to Mask", "")
-        IJ.run(img, "Invert", "")
-        IJ.run(img, "Dilate", "")
-        IJ.run(img, "Erode", "")
-        IJ.run(img, "Erode", "")
-        IJ.run(img, "Erode", "")
-        IJ.run(img, "Dilate", "")
-        IJ.run(img, "Dilate", "")
-        IJ.run(img, "Dilate", "")
-        IJ.run(img, "Erode", "")
-        IJ.run(img, "Dilate", "")
-        IJ.run(img, "Erode", "")
-        IJ.run(img, "Dilate", "")
-        IJ.run(img, "Analyze Particles...", "size=100-Infinity circularity=0.0-1.00 summarize add composite")
-        win = wm.getWindow("Summary")
-        rtt = win.getTextPanel().getResultsTable()
-        num_rois = rm.getCount()
-        roi_list = list(range(0, num_rois, 1))
-        rm.setSelectedIndexes(roi_list)
-        if num_rois > 1:
-            rm.runCommand(img, "Combine")
-            rm.runCommand(img, 'Add')
-            rm.setSelectedIndexes(roi_list)
-            rm.runCommand(img, 'Delete')
-        else:
-            rm.setSelectedIndexes(roi_list)
-        rm.runCommand("Save", os.path.join(outDir, "ROI", sample + "vROIs.zip"))  # save the vROIs
-
-        # vROI on the spheroid image
-
-        rm.select(targetimg, 0)
-        IJ.run(targetimg, "Make Inverse", "")
-        IJ.run(targetimg, "Clear", "slice")
-        rm.reset()
-        rt.reset()
-        IJ.run(targetimg, "Select None", "")
-        IJ.run(img, "Select None", "")
-
-        IJ.run(targetimg, "Analyze Particles...", "size=50-Infinity circularity=0.50-1.00 exclude summarize add")
-        if rm.getCount() > 0:
-            rm.runCommand("Save", os.path.join(outDir, "ROI", sample + "tROIs.zip"))  # save the tROI
-        IJ.run(img, "Green", "")
-        targetimg.show()
-        img.show()
-        IJ.run(targetimg, "Add Image...", "image=[" + img.getTitle() + "] x=0 y=0 opacity=40")
-        savepng(targetimg, os.path.join(outDir, "overlay", sample))
-        targetimg.changes = False
-        targetimg.close()
-        img.changes = False
-        img.close()
-    rtt.save(os.path.join(outDir, "arearatio.csv"))
-    rtt.reset()
+                summary_rows.extend(result.rows)
+        completed = True
+    finally:
+        # after an error, the queued images are dropped, and the running ones finish before the writer is flushed
+        stopPool(pool, not completed)
+    shardSuffix = shardTag(shard)
+    rtt = summaryTable(summary_rows)
+    rtt.setPrecision(0)
+    rtt.save(os.path.join(outDir, "arearatio" + shardSuffix + ".csv"))
+    for path, error in writer.flush():
+        print("Could not write {}: {}".format(path, error))
+    timer.report(outDir, "StageTimes" + shardSuffix)
 
 
 def clean_area_ratio_csv(outDir, sample_nme_pattern, sample_nme_time_pattern, time_series):
@@ -225,6 +338,9 @@ def show_gui():
     gd.addMessage("Minimum size for analyze particles to find a spheroid.")
     gd.addNumericField("Particle Size Minimum:", 2000, 0)
 
+    gd.addMessage("How many images should be analysed at the same time?")
+    gd.addNumericField("Parallel Images:", 1, 0)
+
     gd.showDialog()
     if gd.wasCanceled():
         return
@@ -242,15 +358,45 @@ def show_gui():
     scale_factor = gd.getNextNumber()
     channel_spheroid = gd.getNextString()
     particle_size_min = gd.getNextNumber()
+    parallelPref = max(1, int(gd.getNextNumber()))
 
     setup_directories(outDir)
     process_images(inDir_segmented, indir_cropped, outDir, fileExt, sample_nme_pattern, sample_nme_time_pattern,
-                   segmented_nme_pattern, re_crop, time_series, scale_factor, channel_spheroid, particle_size_min)
+                   segmented_nme_pattern, re_crop, time_series, scale_factor, channel_spheroid, particle_size_min,
+                   parallelPref=parallelPref)
     #clean_area_ratio_csv(outDir, sample_nme_pattern, sample_nme_time_pattern, time_series)
 
 
+# Command line, e.g. for ImageJ --headless
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="AnalyseParticlesSpheroids.py",
+                                     description="Analyse particles in the vessel area around spheroids.")
+    parser.add_argument("--segmented", required=True, help="directory of the Weka-segmented images")
+    parser.add_argument("--cropped", required=True, help="directory of the cropped images")
+    parser.add_argument("--output", required=True, help="output directory")
+    parser.add_argument("--ext", default=".tif", help="file extension of the images")
+    parser.add_argument("--sample-pattern", default=r'_?(\w{3,4}_SpheroidROI_\d{1,2})_')
+    parser.add_argument("--sample-time-pattern", default=r'_?(\w{3,4}_SpheroidROI_\d{1,2}_T\d{3,4})')
+    parser.add_argument("--segmented-pattern", default=r'classified_')
+    parser.add_argument("--no-time-series", action="store_true", help="the images are not a time series")
+    parser.add_argument("--no-recrop", action="store_true", help="do not re-crop around the spheroids")
+    parser.add_argument("--scale-factor", type=float, default=1.15, help="factor by which the major axis is scaled")
+    parser.add_argument("--spheroid-channel", default="_C01", help="channel containing the spheroids")
+    parser.add_argument("--min-size", type=float, default=2000, help="minimum particle size of a spheroid")
+    parser.add_argument("--shard", type=parseShard, help="i/N: process only the i-th of N parts of the images")
+    parser.add_argument("--parallel", type=int, default=1, help="images analysed at the same time")
+    return parser.parse_args(argv)
+
+
 def main():
-    show_gui()
+    if len(sys.argv) < 2:
+        show_gui()
+        return
+    args = parse_args(sys.argv[1:])
+    setup_directories(args.output)
+    process_images(args.segmented, args.cropped, args.output, args.ext, args.sample_pattern, args.sample_time_pattern,
+                   args.segmented_pattern, not args.no_recrop, not args.no_time_series, args.scale_factor,
+                   args.spheroid_channel, args.min_size, args.shard, max(1, args.parallel))
 
 if __name__ == "__main__":
     main()
@@ -3,19 +3,58 @@
 
 import os
 import re
-from ij import IJ, WindowManager
+import sys
+import argparse
+from ij import IJ, ImagePlus
 from ij.io import FileSaver
+from jarray import array
 from trainableSegmentation import WekaSegmentation
-from ij.plugin import LutLoader
+from ij.plugin import LutLoader, RGBStackMerge
 from ij.gui import GenericDialog
+from toolbox_common import AsyncWriter, parseShard, selectShard, shardTag, timer
+
+writer = None
 
 # Functions to save files
-def savetif(img, out_file):
-    FileSaver(img).saveAsTiff(out_file + ".tif")
+def savetif(img, out_file, close=False):
+    writer.submit(FileSaver(img).saveAsTiff, out_file + ".tif", img, close)
+
+# The classifier is read once per run, not once per image
+def imageSignature(imp):
+    """What the classifier's features depend on: bit depth, number of channels and whether the image is 3D."""
+    return imp.getBitDepth(), imp.getNChannels(), imp.getNSlices() > 1
+
+
+class Classifiers(object):
+    """WekaSegmentations with the model loaded, one per image signature.
+
+    The model is read, and the training image set, only for the first image of each signature. The
+    segmentation keeps a copy of that image, as the image itself is closed once it has been saved.
+    """
+
+    def __init__(self, modelFile):
+        self.modelFile = modelFile
+        self.loaded = {}
+
+    def get(self, imp, name):
+        signature = imageSignature(imp)
+        weka = self.loaded.get(signature)
+        if weka is None:
+            with timer.stage("load classifier", name, os.path.getsize(self.modelFile)):
+                weka = WekaSegmentation()
+                weka.setTrainingImage(imp.duplicate())
+                if not weka.loadClassifier(self.modelFile):
+                    raise IOError("could not load " + self.modelFile)
+            self.loaded[signature] = weka
+        return weka
+
 
 # Function to run the segmentation process
 def run_segmentation(inDir, outDir, classDir, lutFile, fileExt, sample_nme_pattern, sample_nme_time_pattern,
-                     channel_roi_ec, channel_roi_tm, time_series, composite):
+                     channel_roi_ec, channel_roi_tm, time_series, composite, shard=None):
+    global writer
+    timer.reset()
+    writer = AsyncWriter()
 
     if not composite and not os.path.isdir(os.path.join(outDir, "composites")):
         os.makedirs(os.path.join(outDir, "composites"))
@@ -24,43 +63,48 @@ def run_segmentation(inDir, outDir, classDir, lutFile, fileExt, sample_nme_patte
         target_files = {sample_nme_time_pattern.match(f).group(1) for f in os.listdir(inDir) if sample_nme_time_pattern.match(f)}
     else:
         target_files = {f for f in os.listdir(inDir) if sample_nme_pattern.match(f)}
+    target_files = selectShard(sorted(target_files), shard)
 
-    wm = WindowManager
+    classifiers = Classifiers(os.path.join(classDir, 'classifier.model'))
+    with timer.stage("load LUT", lutFile):
+        lut = LutLoader.openLut(lutFile)
 
     for f in target_files:
         try:
             if not composite:
                 vesselimg_fl = os.path.join(inDir, f + "_C" + channel_roi_ec + ".tif")
                 tmimg_fl = os.path.join(inDir, f + "_C" + channel_roi_tm + ".tif")
-                vesselimg = IJ.openImage(vesselimg_fl)
-                tmimg = IJ.openImage(tmimg_fl)
-                IJ.run(vesselimg, "Gaussian Blur...", "sigma=1 scaled")
-                IJ.run(vesselimg, "Auto Threshold", "method=Otsu white")
-                vesselimg.show()
-                tmimg.show()
-                IJ.run(vesselimg, "Merge Channels...",
-                       "c2=" + vesselimg.getTitle() + " c4=" + tmimg.getTitle() + " create keep")
-                vesselimg.changes = False
-                tmimg.changes = False
-                vesselimg.close()
-                tmimg.close()
-                merged_image = wm.getImage('Composite')
-                savetif(merged_image, os.path.join(outDir, "composites", "composite_" + f))
+                with timer.stage("open", f, os.path.getsize(vesselimg_fl) + os.path.getsize(tmimg_fl)):
+                    vesselimg = IJ.openImage(vesselimg_fl)
+                    tmimg = IJ.openImage(tmimg_fl)
+                with timer.stage("composite", f):
+                    IJ.run(vesselimg, "Gaussian Blur...", "sigma=1 scaled")
+                    IJ.run(vesselimg, "Auto Threshold", "method=Otsu white")
+                    # as Merge Channels with c2 (green) and c4 (gray), without showing or looking up windows
+                    merged_image = RGBStackMerge.mergeChannels(array([None, vesselimg, None, tmimg], ImagePlus), False)
+                    merged_image.setTitle("composite_" + f)
             else:
-                merged_image = IJ.openImage(os.path.join(inDir, f))
+                with timer.stage("open", f, os.path.getsize(os.path.join(inDir, f))):
+                    merged_image = IJ.openImage(os.path.join(inDir, f))
 
-            weka = WekaSegmentation()
-            weka.setTrainingImage(merged_image)
-            weka.loadClassifier(os.path.join(classDir, 'classifier.model'))
-            segmented_image = weka.applyClassifier(merged_image, 0, False)
-            lut = LutLoader.openLut(lutFile)
+            weka = classifiers.get(merged_image, f)
+            with timer.stage("classification", f):
+                segmented_image = weka.applyClassifier(merged_image, 0, False)
             segmented_image.getProcessor().setLut(lut)
-            merged_image.close()
+            if not composite:
+                savetif(merged_image, os.path.join(outDir, "composites", "composite_" + f), close=True)
+            else:
+                merged_image.close()
             savetif(segmented_image, os.path.join(outDir, "classified_" + f))
         except Exception as e:
             print("Error processing file {}: {}".format(f, e))
             break
 
+    for path, error in writer.flush():
+        print("Could not write {}: {}".format(path, error))
+
+    timer.report(outDir, "StageTimes" + shardTag(shard))
+
 # GUI function
 def show_gui():
     gd = GenericDialog("Segmentation Parameters")
@@ -113,9 +157,32 @@ def show_gui():
     run_segmentation(inDir, outDir, classDir, lutFile, fileExt, sample_nme_pattern, sample_nme_time_pattern,
                      channel_roi_ec, channel_roi_tm, time_series, composite)
 
-# Main function to execute GUI and processing
+# Command line, e.g. for ImageJ --headless
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="SegmentVesselsWeka.py", description="Segment vessels with a Weka model.")
+    parser.add_argument("--input", required=True, help="input directory")
+    parser.add_argument("--output", required=True, help="output directory")
+    parser.add_argument("--classifier-dir", required=True, help="directory containing classifier.model")
+    parser.add_argument("--lut", required=True, help="LUT file, see ./res/ClassifiedImageLUT.lut")
+    parser.add_argument("--ext", default=".tif", help="file extension of the images")
+    parser.add_argument("--no-time-series", action="store_true", help="the images are not a time series")
+    parser.add_argument("--sample-pattern", default="^(\w{3,4})_")
+    parser.add_argument("--sample-time-pattern", default=r'(.+?_T\d{4})_C\d{2}\.tif')
+    parser.add_argument("--channel-ec", default="00", help="channel of the vessel marker")
+    parser.add_argument("--channel-tm", default="02", help="channel of the transmitted light")
+    parser.add_argument("--composite", action="store_true", help="the input images are composites already")
+    parser.add_argument("--shard", type=parseShard, help="i/N: process only the i-th of N parts of the images")
+    return parser.parse_args(argv)
+
+# Main function to execute GUI or command line and processing
 def main():
-    show_gui()
+    if len(sys.argv) < 2:
+        show_gui()
+        return
+    args = parse_args(sys.argv[1:])
+    run_segmentation(args.input, args.output, args.classifier_dir, args.lut, args.ext,
+                     re.compile(args.sample_pattern), re.compile(args.sample_time_pattern), args.channel_ec,
+                     args.channel_tm, not args.no_time_series, args.composite, args.shard)
 
 # Entry point
 if __name__ == "__main__":
@@ -1,17 +1,28 @@
 from ij import IJ, ImagePlus, ImageStack
+from ij.process import Blitter, FloatProcessor
+from ij.measure import Calibration
 from ij.io import Opener
 from ij.io import FileSaver
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions
 from loci.formats import ImageReader
 from loci.formats import MetadataTools
+from loci.formats import ChannelSeparator
+from loci.plugins.util import ImageProcessorReader
 from ome.units import UNITS
 from ij.plugin import ZProjector
 from ij.gui import GenericDialog
+from java.util.concurrent import Callable, Executors
+from java.lang import Throwable
 import os
 import re
 import time
 import logging
+import json
+import sys
+import argparse
+from toolbox_common import AsyncWriter, FileResult, MetadataCatalog, Options, addCatalogArguments, catalogFile, \
+    catalogRecord, fileResults, logDuration, makeDir, parseShard, selectShard, seriesTag, shardTag, stopPool, timer
 
 
 outDirChoices = ["New Directory, no subfolders", "New Directory, keep input subfolders",
@@ -19,228 +30,674 @@ outDirChoices = ["New Directory, no subfolders", "New Directory, keep input subf
 overwriteChoices = ["NO overwrite existing files", "Overwrite existing files"]
 channelSubfolderChoices = ["yes", "no"]
 zProjChoices = ["Maximum intensity", "Average intensity", 'Minimum intensity', 'Sum Slices', 'Standard Deviation', 'Median']
+zProjSuffixes = ["MAX", "AVG", "MIN", "SUM", "SD", "MED"]
+medianBandBytes = 64 * 1024 * 1024
 mipChoices = ["tiff", "jpg"]
-overwriteList = []
-startTime = time.time()
-imageCount = 0
-voxel_info = str()
-
-gd = GenericDialog("Set ZProject Options")
-gd.addStringField("File extension to be processed", ".nd2")
-gd.addRadioButtonGroup("Output", outDirChoices, 3, 1, outDirChoices[0])
-gd.addRadioButtonGroup("Overwrite", overwriteChoices, 2, 1, overwriteChoices[0])
-gd.addRadioButtonGroup("Save channels in different subfolders", channelSubfolderChoices, 1, 1,
-                       channelSubfolderChoices[0])
-gd.addChoice("What kind of z-projection?", zProjChoices, zProjChoices[0])
-gd.addCheckbox("Convert to RGB", True)
-gd.addCheckboxGroup(2, 1, mipChoices, [True, False], ["How do you want save the z-projections of your images?"])
-gd.addCheckbox("Convert z-stacks to tiff", False)
-gd.showDialog()
-if gd.wasCanceled():
-    exit()
-
-fileExt = gd.getNextString()
-outDirPref = gd.getNextRadioButton()
-overwritePref = gd.getNextRadioButton()
-channelSubfolderPref = gd.getNextRadioButton()
-zProjPref = gd.getNextChoice()
-rgbpref = gd.getNextBoolean()
-mipPrefTIFF = gd.getNextBoolean()
-mipPrefJPG = gd.getNextBoolean()
-stackPref = gd.getNextBoolean()
-
-if not fileExt.startswith('.'):
-    fileExt = '.' + fileExt
-
-inDir = IJ.getDirectory("Choose Directory Containing Input Files")
-if inDir is None:
-    exit('No input directory selected!')
-
-if outDirPref == outDirChoices[2]:
-    outDir = inDir
-else:
-    outDir = IJ.getDirectory("Choose Directory For Output")
-    if outDir is None:
-        exit('No output directory selected!')
-    if outDirPref == outDirChoices[1]:
-        for dirpath, dirnames, filenames in os.walk(inDir):
-            if any([fileExt in f for f in filenames]):
-                structure = os.path.join(outDir, dirpath[len(inDir):])
-                if not os.path.isdir(structure):
-                    os.makedirs(structure)
+outDirArgs = ["flat", "tree", "input"]
+zProjArgs = ["max", "avg", "min", "sum", "sd", "median"]
 
-logging.basicConfig(filename=os.path.join(outDir, "Log.txt"), filemode='w', level=logging.DEBUG,
-                    format='%(asctime)s | %(levelname)s >> %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
 
-logging.info('Start ZProject script')
-logging.info('Preferences')
-logging.info('    Input dir: %s', inDir)
-logging.info('    Output dir: %s', outDir)
-logging.info('    Output format: %s', outDirPref)
-logging.info('    %s', overwritePref)
-logging.info('    Save channels in different subfolders: %s', channelSubfolderPref)
-logging.info('    Z-projection methods: %s', zProjPref)
-logging.info('    RGB: %s', rgbpref)
+opts = None
+writer = None
 
 
-def saveImage(imp, out_file):
-    if stackPref:
-        if overwritePref == overwriteChoices[0]:
+def saveImage(imp, out_file, result):
+    if opts.stackPref:
+        result.outputs.append(out_file)
+        if opts.overwritePref == overwriteChoices[0]:
             if not os.path.exists(out_file):
-                FileSaver(imp).saveAsTiff(out_file)
+                writer.submit(FileSaver(imp).saveAsTiff, out_file, imp)
             else:
-                overwriteList.append(out_file)
-        elif overwritePref == overwriteChoices[1]:
+                result.existingFiles.append(out_file)
+        elif opts.overwritePref == overwriteChoices[1]:
             if not os.path.exists(out_file):
-                FileSaver(imp).saveAsTiff(out_file)
+                writer.submit(FileSaver(imp).saveAsTiff, out_file, imp)
 
             else:
-                overwriteList.append(out_file)
-                FileSaver(imp).saveAsTiff(out_file)
+                result.existingFiles.append(out_file)
+                writer.submit(FileSaver(imp).saveAsTiff, out_file, imp)
 
-def zproj(stackimp):
-    zp = ZProjector(stackimp)
-    if zProjPref == zProjChoices[0]:
-        zp.setMethod(ZProjector.MAX_METHOD)
-    elif zProjPref == zProjChoices[1]:
-        zp.setMethod(ZProjector.AVG_METHOD)
-    elif zProjPref == zProjChoices[2]:
-        zp.setMethod(ZProjector.MIN_METHOD)
-    elif zProjPref == zProjChoices[3]:
-        zp.setMethod(ZProjector.SUM_METHOD)
-    elif zProjPref == zProjChoices[4]:
-        zp.setMethod(ZProjector.SD_METHOD)
-    elif zProjPref == zProjChoices[5]:
+
+class ProjectionAccumulator(object):
+    """Folds z-planes one at a time into running max/min/sum/mean/SD projections.
+
+    Mean and SD use Welford's running update, so every plane is visited exactly once
+    and only a handful of float planes are held, whatever the stack depth.
+    """
+
+    def __init__(self, methods):
+        self.methods = methods
+        self.count = 0
+        self.max = None
+        self.min = None
+        self.sum = None
+        self.mean = None
+        self.m2 = None
+        self.runningSD = zProjChoices[4] in methods
+        self.runningSum = not self.runningSD and (zProjChoices[1] in methods or zProjChoices[3] in methods)
+
+    def add(self, ip):
+        # convertToFloatProcessor() does not copy float input, so only ever write into duplicates
+        fp = ip.convertToFloatProcessor()
+        self.count += 1
+        if self.count == 1:
+            if zProjChoices[0] in self.methods:
+                self.max = fp.duplicate()
+            if zProjChoices[2] in self.methods:
+                self.min = fp.duplicate()
+            if self.runningSum:
+                self.sum = fp.duplicate()
+            if self.runningSD:
+                self.mean = fp.duplicate()
+                self.m2 = FloatProcessor(fp.getWidth(), fp.getHeight())
+            return
+        if self.max is not None:
+            self.max.copyBits(fp, 0, 0, Blitter.MAX)
+        if self.min is not None:
+            self.min.copyBits(fp, 0, 0, Blitter.MIN)
+        if self.sum is not None:
+            self.sum.copyBits(fp, 0, 0, Blitter.ADD)
+        if self.runningSD:
+            delta = fp.duplicate()
+            delta.copyBits(self.mean, 0, 0, Blitter.SUBTRACT)
+            step = delta.duplicate()
+            step.multiply(1.0 / self.count)
+            self.mean.copyBits(step, 0, 0, Blitter.ADD)
+            delta2 = fp.duplicate()
+            delta2.copyBits(self.mean, 0, 0, Blitter.SUBTRACT)
+            delta.copyBits(delta2, 0, 0, Blitter.MULTIPLY)
+            self.m2.copyBits(delta, 0, 0, Blitter.ADD)
+
+    def results(self, bitDepth):
+        """Returns a dict of z-projection choice -> projected ImageProcessor."""
+        results = {}
+        if self.max is not None:
+            results[zProjChoices[0]] = toBitDepth(self.max, bitDepth)
+        if self.min is not None:
+            results[zProjChoices[2]] = toBitDepth(self.min, bitDepth)
+        if self.runningSD:
+            mean = self.mean
+            total = mean.duplicate()
+            total.multiply(self.count)
+            sd = self.m2.duplicate()
+            sd.multiply(1.0 / max(self.count - 1, 1))
+            sd.sqrt()
+            results[zProjChoices[4]] = sd
+        else:
+            total = self.sum
+            if total is not None:
+                mean = total.duplicate()
+                mean.multiply(1.0 / self.count)
+        if zProjChoices[1] in self.methods:
+            results[zProjChoices[1]] = mean
+        if zProjChoices[3] in self.methods:
+            results[zProjChoices[3]] = total
+        return results
+
+
+def toBitDepth(fp, bitDepth):
+    if bitDepth == 8:
+        return fp.convertToByteProcessor(False)
+    if bitDepth == 16:
+        return fp.convertToShortProcessor(False)
+    return fp
+
+
+def medianProjection(readBand, width, height, depth):
+    """Median projection computed in horizontal bands of at most medianBandBytes.
+
+    readBand(z, y, bandHeight) must return the rows y to y + bandHeight of plane z.
+    """
+    bandHeight = max(1, min(height, medianBandBytes // (4 * width * depth)))
+    out = FloatProcessor(width, height)
+    for y in range(0, height, bandHeight):
+        h = min(bandHeight, height - y)
+        band = ImageStack(width, h)
+        for z in range(depth):
+            band.addSlice(readBand(z, y, h))
+        zp = ZProjector(ImagePlus("band", band))
         zp.setMethod(ZProjector.MEDIAN_METHOD)
+        zp.doProjection()
+        out.insert(zp.getProjection().getProcessor().convertToFloatProcessor(), 0, y)
+    return out
+
+
+def stackBand(stack):
+    def readBand(z, y, h):
+        ip = stack.getProcessor(z + 1)
+        ip.setRoi(0, y, stack.getWidth(), h)
+        band = ip.crop()
+        ip.resetRoi()
+        return band
+    return readBand
+
+
+def zprojLegacy(stackimp, method):
+    zp = ZProjector(stackimp)
+    zp.setMethod([ZProjector.MAX_METHOD, ZProjector.AVG_METHOD, ZProjector.MIN_METHOD,
+                  ZProjector.SUM_METHOD, ZProjector.SD_METHOD, ZProjector.MEDIAN_METHOD][zProjChoices.index(method)])
     zp.doProjection()
-    zpimp = zp.getProjection()
-    if rgbpref:
-        IJ.run(zpimp, "RGB Color", "")
-    return zpimp
+    return zp.getProjection()
+
+
+def toProjections(results, title, calibration):
+    projections = []
+    for method in opts.zProjPref:
+        zpimp = ImagePlus(zProjSuffixes[zProjChoices.index(method)] + "_" + title, results[method])
+        zpimp.setCalibration(calibration)
+        zpimp.resetDisplayRange()
+        projections.append((method, zpimp))
+    return projections
+
+
+def toRGB(projections):
+    if opts.rgbpref:
+        for method, zpimp in projections:
+            IJ.run(zpimp, "RGB Color", "")
+    return projections
+
+
+def zproj(stackimp):
+    """Returns [(z-projection choice, ImagePlus)] for all selected methods, reading the stack once."""
+    stack = stackimp.getStack()
+    if stackimp.getBitDepth() == 24:
+        return toRGB([(method, zprojLegacy(stackimp, method)) for method in opts.zProjPref])
+    acc = ProjectionAccumulator(opts.zProjPref)
+    for z in range(stack.getSize()):
+        acc.add(stack.getProcessor(z + 1))
+    results = acc.results(stackimp.getBitDepth())
+    if zProjChoices[5] in opts.zProjPref:
+        results[zProjChoices[5]] = medianProjection(stackBand(stack), stack.getWidth(), stack.getHeight(),
+                                                    stack.getSize())
+    return toRGB(toProjections(results, stackimp.getTitle(), stackimp.getCalibration().copy()))
+
+
+def zprojStream(meta, channel_id):
+    """Same as zproj, but reads the planes of one channel one at a time from the open reader."""
+    acc = ProjectionAccumulator(opts.zProjPref)
+    for index in meta.planeIndices(channel_id):
+        acc.add(meta.readPlane(index))
+    results = acc.results(meta.bitDepth)
+    if zProjChoices[5] in opts.zProjPref:
+        results[zProjChoices[5]] = medianProjection(meta.bandReader(channel_id), meta.pixelSize[0],
+                                                    meta.pixelSize[1], len(meta.planeIndices(channel_id)))
+    return toRGB(toProjections(results, os.path.basename(meta.path), meta.calibration()))
+
+
+def saveMip(img, file_path, result):
+    if opts.mipPrefTIFF:
+        writer.submit(FileSaver(img).saveAsTiff, file_path + ".tiff", img)
+        result.outputs.append(file_path + ".tiff")
+    if opts.mipPrefJPG:
+        writer.submit(FileSaver(img).saveAsJpeg, file_path + ".jpg", img)
+        result.outputs.append(file_path + ".jpg")
+
+
+def saveMips(projections, file_path, result):
+    for method, img in projections:
+        if len(projections) > 1:
+            saveMip(img, file_path + "_" + zProjSuffixes[zProjChoices.index(method)], result)
+        else:
+            saveMip(img, file_path, result)
+
+
+class FileMetadata(object):
+    """OME metadata of one input file, parsed once and shared by all of its channels.
+
+    The metadata comes from the catalog if the file is unchanged since it was recorded. The reader is only
+    opened when planes are streamed, or to fill in the catalog, and stays open until close().
+    """
+
+    def __init__(self, path, catalog, series=0):
+        self.path = path
+        self.series = series
+        self.reader = None
+        record = catalog.lookup(path, series)
+        if record is None:
+            omeMeta = MetadataTools.createOMEXMLMetadata()
+            record = catalogRecord(self.openReader(omeMeta), omeMeta, series)
+            catalog.store(path, record, series)
+        self.channelNames = record['channelNames']
+        self.sizeC = record['sizeC']
+        self.physicalSize = (record['physicalSizeX'], record['physicalSizeY'], record['physicalSizeZ'])
+        self.pixelSize = (record['sizeX'], record['sizeY'], record['sizeZ'])
+        self.bitDepth = record['bitDepth']
+        self.seriesCount = record['seriesCount']
+
+    def openReader(self, omeMeta=None):
+        if self.reader is None:
+            self.reader = ImageProcessorReader(ChannelSeparator(ImageReader()))
+            self.reader.setMetadataStore(omeMeta or MetadataTools.createOMEXMLMetadata())
+            self.reader.setId(self.path)
+            self.reader.setSeries(self.series)
+        return self.reader
+
+    def channelCount(self):
+        return self.sizeC
+
+    def channelName(self, channel_id):
+        if channel_id < len(self.channelNames) and self.channelNames[channel_id] is not None:
+            return self.channelNames[channel_id]
+        return "C" + str(channel_id)
+
+    def planeIndices(self, channel_id):
+        reader = self.openReader()
+        return [reader.getIndex(z, channel_id, t) for t in range(reader.getSizeT()) for z in range(reader.getSizeZ())]
+
+    def readPlane(self, index):
+        return self.openReader().openProcessors(index)[0]
+
+    def bandReader(self, channel_id):
+        indices = self.planeIndices(channel_id)
+        width = self.pixelSize[0]
+
+        def readBand(z, y, h):
+            return self.openReader().openProcessors(indices[z], 0, y, width, h)[0]
+        return readBand
+
+    def calibration(self):
+        cal = Calibration()
+        cal.pixelWidth, cal.pixelHeight, cal.pixelDepth = self.physicalSize
+        cal.setUnit("micron")
+        return cal
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+
+class ProjectionResult(FileResult):
+    """A FileResult that also lists the outputs and existing files of the series, for the manifest."""
+
+    def __init__(self, path, seriesCount=1):
+        FileResult.__init__(self, path)
+        self.seriesCount = seriesCount
+        self.outputs = []
+        self.existingFiles = []
+        self.skipped = False
+
+
+class FileTask(Callable):
+    """Processes one series of a file. The task of the first series finds the series count and, given the pool,
+    submits the other series to it."""
 
+    def __init__(self, root, file, number, series=0, pool=None):
+        self.root = root
+        self.file = file
+        self.number = number
+        self.series = series
+        self.pool = pool
 
+    def call(self):
+        result = ProjectionResult(os.path.join(self.root, self.file))
+        # a file that can't be processed is reported, the others go on
+        try:
+            processFile(self.root, self.file, self.number, self.series, result, self.pool)
+        except (Exception, Throwable) as e:
+            result.error = str(e)
+        return result
 
-def saveMip(img, file_path):
-    if mipPrefTIFF:
-        FileSaver(img).saveAsTiff(file_path + ".tiff")
-    if mipPrefJPG:
-        FileSaver(img).saveAsJpeg(file_path + ".jpg")
 
+class SkippedTask(Callable):
+    """Replays the manifest entry of an input that is unchanged since the last run, without opening it."""
 
-for root, dirs, files in os.walk(inDir):
-    for file in files:
-        if file.endswith(fileExt):
-            logging.info('Starting image #%i (%s)', imageCount, str(file))
+    def __init__(self, path, entry):
+        self.path = path
+        self.entry = entry
+
+    def call(self):
+        result = ProjectionResult(self.path)
+        result.skipped = True
+        result.info('Skipping unchanged image (%s)', os.path.basename(self.path))
+        result.voxelRows = [str(row) for row in self.entry['voxelRows']]
+        result.outputs = [str(output) for output in self.entry['outputs']]
+        return result
+
+
+def loadManifest():
+    if os.path.isfile(opts.manifestFile):
+        with open(opts.manifestFile, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def saveManifest(manifest):
+    with open(opts.manifestFile + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    if os.path.exists(opts.manifestFile):
+        os.remove(opts.manifestFile)
+    os.rename(opts.manifestFile + ".tmp", opts.manifestFile)
+
+
+def fileStamp(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+def isUpToDate(entry, path):
+    if entry is None or opts.overwritePref != overwriteChoices[0]:
+        return False
+    size, mtime = fileStamp(path)
+    # an output that was cut short by a crash has another size than the one recorded
+    outputSizes = entry.get('outputSizes', {})
+    return (entry['size'] == size and entry['mtime'] == mtime and entry['params'] == opts.manifestParams
+            and all(os.path.isfile(output) and os.path.getsize(output) == outputSizes.get(output)
+                    for output in entry['outputs']))
+
+
+def commitManifest(manifest, finished, failedWrites):
+    """Records the finished files once the writer is flushed, with the size of every output. Files with an output
+    that could not be written are left out (and dropped from the manifest), so the next run processes them again."""
+    for path, entry in finished.items():
+        if any(output in failedWrites or not os.path.isfile(output) for output in entry['outputs']):
+            manifest.pop(path, None)
+            continue
+        entry['outputSizes'] = dict((output, os.path.getsize(output)) for output in entry['outputs'])
+        manifest[path] = entry
+    saveManifest(manifest)
+
+
+def outputPaths(root, channel_name, out_name):
+    """Returns the stack tiff path and the z-projection path (without extension) and creates their folders."""
+    if opts.outDirPref == outDirChoices[0]:
+        baseDir = opts.outDir
+    elif opts.outDirPref == outDirChoices[1]:
+        baseDir = root.replace(opts.inDir, opts.outDir)
+    else:
+        baseDir = root
+    if opts.channelSubfolderPref == "yes":
+        baseDir = os.path.join(baseDir, channel_name)
+        makeDir(baseDir)
+    out_file = os.path.join(baseDir, out_name + ".tiff")
+    if opts.outDirPref == outDirChoices[0]:
+        mipDir = os.path.join(baseDir, "MIP")
+        if any([opts.mipPrefJPG, opts.mipPrefTIFF]):
+            makeDir(mipDir)
+        mipOutFile = os.path.join(mipDir, out_name)
+    else:
+        mipOutFile = out_file.replace(".tiff", "_mip")
+    return out_file, mipOutFile
+
+
+def processChannel(root, base_name, meta, channel_id, imp, result):
+    """Saves the stack (if loaded) and the z-projections of one channel. Without imp, planes are streamed."""
+    channel_name = str(meta.channelName(channel_id))
+    out_name = base_name + "_" + channel_name
+    out_name = out_name.replace(" ", "")
+
+    physSizeX, physSizeY, physSizeZ = meta.physicalSize
+    stackSizeX, stackSizeY, stackSizeZ = meta.pixelSize
+    result.info('    Saving under: %s', out_name)
+    result.info('        Size in micrometer: %.4f, %.4f, %.4f', physSizeX, physSizeY, physSizeZ)
+    result.info('        Size in pixel: %i, %i, %i', stackSizeX, stackSizeY, stackSizeZ)
+    result.voxelRows.append(','.join([str(entry) for entry in (out_name, physSizeX, physSizeY, physSizeZ,
+                                                               stackSizeX, stackSizeY, stackSizeZ)]) + '\n')
+
+    out_file, mipOutFile = outputPaths(root, channel_name, out_name)
+    if imp is not None:
+        saveImage(imp, out_file, result)
+    if any([opts.mipPrefJPG, opts.mipPrefTIFF]) and opts.zProjPref:
+        with timer.stage("projection", meta.path):
+            if imp is not None:
+                projections = zproj(imp)
+            else:
+                projections = zprojStream(meta, channel_id)
+        saveMips(projections, mipOutFile, result)
+
+
+def processFile(root, file, number, series, result, pool=None):
+    with timer.stage("metadata", os.path.join(root, file)):
+        meta = FileMetadata(os.path.join(root, file), opts.catalog, series)
+    try:
+        seriesCount = result.seriesCount = meta.seriesCount
+        # the series are only known once the file is parsed, in the worker; each further series is a task of its own
+        if series == 0 and pool is not None:
+            result.seriesFutures = [pool.submit(FileTask(root, file, number, s)) for s in range(1, seriesCount)]
+        if seriesCount == 1:
+            result.info('Starting image #%i (%s)', number, str(file))
+        else:
+            result.info('Starting image #%i (%s, series %i of %i)', number, str(file), series + 1, seriesCount)
+        base_name = file.split(opts.fileExt)[0] + seriesTag(series, seriesCount)
+        if opts.stackPref:
             options = ImporterOptions()
             options.setAutoscale(True)
             options.setId(os.path.join(root, file))
+            options.clearSeries()
+            options.setSeriesOn(series, True)
             options.setSplitChannels(True)
-            imps = BF.openImagePlus(options)
-            imageCount += 1
+            with timer.stage("import", os.path.join(root, file), os.path.getsize(os.path.join(root, file))):
+                imps = BF.openImagePlus(options)
             for imp in imps:
-                reader = ImageReader()
-                omeMeta = MetadataTools.createOMEXMLMetadata()
-                reader.setMetadataStore(omeMeta)
-                reader.setId(os.path.join(root, file))
-
-                filename = str(imp)
-                channel_id = int(re.findall("C=(\d)", filename)[0])
-                channel_name = omeMeta.getChannelName(0, channel_id)
-                out_name = filename.split('"')[1]
-                out_name = out_name.split(fileExt)[0] + "_" + str(channel_name)
-                out_name = out_name.replace(" ", "")
-
-                physSizeX = omeMeta.getPixelsPhysicalSizeX(0)
-                physSizeY = omeMeta.getPixelsPhysicalSizeY(0)
-                physSizeZ = omeMeta.getPixelsPhysicalSizeZ(0)
-                stackSizeX = omeMeta.getPixelsSizeX(0).getValue()
-                stackSizeY = omeMeta.getPixelsSizeY(0).getValue()
-                stackSizeZ = omeMeta.getPixelsSizeZ(0).getValue()
-                logging.info('    Saving under: %s', out_name)
-                logging.info('        Size in micrometer: %.4f, %.4f, %.4f', physSizeX.value(), physSizeY.value(), physSizeZ.value())
-                logging.info('        Size in pixel: %i, %i, %i', stackSizeX, stackSizeY, stackSizeZ)
-                voxel_info += ','.join([str(entry) for entry in (out_name, physSizeX.value(), physSizeY.value(), physSizeZ.value(),
-                                                 stackSizeX, stackSizeY, stackSizeZ)]) + '\n'
-                if outDirPref == outDirChoices[0] and channelSubfolderPref == "no":
-                    out_file = os.path.join(outDir, out_name + ".tiff")
-                    saveImage(imp, out_file)
-                    if any([mipPrefJPG, mipPrefTIFF]):
-                        mipOutFile = os.path.join(outDir, "MIP", out_name)
-                        if not os.path.isdir(os.path.join(outDir, "MIP")):
-                            os.mkdir(os.path.join(outDir, "MIP"))
-                        outimp = zproj(imp)
-                        saveMip(outimp, mipOutFile)
-
-                elif outDirPref == outDirChoices[0] and channelSubfolderPref == "yes":
-                    out_file = os.path.join(outDir, channel_name, out_name + ".tiff")
-                    if not os.path.isdir(os.path.join(outDir, channel_name)):
-                        os.mkdir(os.path.join(outDir, channel_name))
-                    saveImage(imp, out_file)
-                    if any([mipPrefJPG, mipPrefTIFF]):
-                        mipOutFile = os.path.join(outDir, channel_name, "MIP", out_name)
-                        if not os.path.isdir(os.path.join(outDir, channel_name, "MIP")):
-                            os.mkdir(os.path.join(outDir, channel_name, "MIP"))
-                        outimp = zproj(imp)
-                        saveMip(outimp, mipOutFile)
-
-                elif outDirPref == outDirChoices[1] and channelSubfolderPref == "no":
-                    outSubDir = root.replace(inDir, outDir)
-                    out_file = os.path.join(outSubDir, out_name + ".tiff")
-                    saveImage(imp, out_file)
-                    if any([mipPrefJPG, mipPrefTIFF]):
-                        mipOutFile = out_file.replace(".tiff", "_mip")
-                        outimp = zproj(imp)
-                        saveMip(outimp, mipOutFile)
-
-                elif outDirPref == outDirChoices[1] and channelSubfolderPref == "yes":
-                    outSubDir = root.replace(inDir, outDir)
-                    if not os.path.isdir(os.path.join(outSubDir, channel_name)):
-                        os.mkdir(os.path.join(outSubDir, channel_name))
-                    out_file = os.path.join(outSubDir, channel_name, out_name + ".tiff")
-                    saveImage(imp, out_file)
-                    if any([mipPrefJPG, mipPrefTIFF]):
-                        mipOutFile = out_file.replace(".tiff", "_mip")
-                        outimp = zproj(imp)
-                        saveMip(outimp, mipOutFile)
-
-                elif outDirPref == outDirChoices[2] and channelSubfolderPref == "no":
-                    out_file = os.path.join(root, out_name + ".tiff")
-                    saveImage(imp, out_file)
-                    if any([mipPrefJPG, mipPrefTIFF]):
-                        mipOutFile = out_file.replace(".tiff", "_mip")
-                        outimp = zproj(imp)
-                        saveMip(outimp, mipOutFile)
-
-                elif outDirPref == outDirChoices[2] and channelSubfolderPref == "yes":
-                    out_file = os.path.join(root, channel_name, out_name + ".tiff")
-                    if not os.path.isdir(os.path.join(root, channel_name)):
-                        os.mkdir(os.path.join(root, channel_name))
-                    saveImage(imp, out_file)
-                    if any([mipPrefJPG, mipPrefTIFF]):
-                        mipOutFile = out_file.replace(".tiff", "_mip")
-                        outimp = zproj(imp)
-                        saveMip(outimp, mipOutFile)
-
-with open(os.path.join(outDir, "VoxelSize.txt"), 'w') as output:
-    output.write(voxel_info)
-
-duration = time.time()- startTime
-logging.info('Processing finished')
-
-duration_h, rest = divmod(duration, 3600)
-duration_min, rest = divmod(rest, 60)
-duration_s = int(round(rest))
-if duration_h > 0:
-    logging.info('%i files procced in %i h, %i min and %i s', imageCount, duration_h, duration_min, duration_s)
-elif duration_min > 0:
-    logging.info('%i files procced in %i min and %i s', imageCount, duration_min, duration_s)
-else:
-    logging.info('%i files procced in %i s', imageCount, duration_s)
-
-if overwriteList:
-    logging.info('Existing Files:')
-    for item in overwriteList:
-        logging.info('    %s', item)
-
-IJ.log("\\Clear")
-IJ.log("Finished")
+                channel_id = int(re.findall("C=(\d)", str(imp))[0])
+                processChannel(root, base_name, meta, channel_id, imp, result)
+        else:
+            for channel_id in range(meta.channelCount()):
+                processChannel(root, base_name, meta, channel_id, None, result)
+    finally:
+        meta.close()
+    return result
+
+
+def run_zproject(inDir, outDir, fileExt=".nd2", outDirPref=outDirChoices[0], overwritePref=overwriteChoices[0],
+                 channelSubfolderPref=channelSubfolderChoices[0], zProjPref=zProjChoices[:1], rgbpref=True,
+                 mipPrefTIFF=True, mipPrefJPG=False, stackPref=False, parallelPref=1, shard=None, writerThreads=1,
+                 catalogPath=catalogFile):
+    global opts, writer
+    startTime = time.time()
+    timer.reset()
+    overwriteList = []
+    imageCount = 0
+    skippedCount = 0
+    failedFiles = []
+    voxel_info = str()
+    inDir = os.path.join(inDir, '')
+    outDir = inDir if outDirPref == outDirChoices[2] else os.path.join(outDir, '')
+    if outDirPref == outDirChoices[1]:
+        for dirpath, dirnames, filenames in os.walk(inDir):
+            if any([fileExt in f for f in filenames]):
+                structure = os.path.join(outDir, dirpath[len(inDir):])
+                if not os.path.isdir(structure):
+                    os.makedirs(structure)
+
+    # array jobs share the output dir, so every shard keeps its own log, manifest and voxel sizes
+    shardSuffix = shardTag(shard)
+
+    logging.basicConfig(filename=os.path.join(outDir, "Log" + shardSuffix + ".txt"), filemode='w', level=logging.DEBUG,
+                        format='%(asctime)s | %(levelname)s >> %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
+
+    logging.info('Start ZProject script')
+    logging.info('Preferences')
+    logging.info('    Input dir: %s', inDir)
+    logging.info('    Output dir: %s', outDir)
+    logging.info('    Output format: %s', outDirPref)
+    logging.info('    %s', overwritePref)
+    logging.info('    Save channels in different subfolders: %s', channelSubfolderPref)
+    logging.info('    Z-projection methods: %s', ', '.join(zProjPref))
+    logging.info('    RGB: %s', rgbpref)
+    logging.info('    Files processed in parallel: %i', parallelPref)
+    logging.info('    Writer threads: %i', writerThreads)
+    if shard is not None:
+        logging.info('    Shard: %i/%i', shard[0], shard[1])
+
+    # an input is skipped when its size, mtime and the projection settings match the last run and its outputs exist
+    manifestParams = {'fileExt': fileExt, 'output': outDirPref, 'channelSubfolders': channelSubfolderPref,
+                      'zProjection': zProjPref, 'rgb': rgbpref, 'mipTIFF': mipPrefTIFF, 'mipJPG': mipPrefJPG,
+                      'stackTIFF': stackPref}
+    opts = Options(inDir=inDir, outDir=outDir, fileExt=fileExt, outDirPref=outDirPref, overwritePref=overwritePref,
+                   channelSubfolderPref=channelSubfolderPref, zProjPref=zProjPref, rgbpref=rgbpref,
+                   mipPrefTIFF=mipPrefTIFF, mipPrefJPG=mipPrefJPG, stackPref=stackPref,
+                   manifestFile=os.path.join(outDir, "Manifest" + shardSuffix + ".json"), manifestParams=manifestParams,
+                   catalog=MetadataCatalog(catalogPath))
+    logging.info('    Metadata catalog: %s', opts.catalog.status)
+    manifest = loadManifest()
+
+    inputs = []
+    for root, dirs, files in os.walk(inDir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(fileExt):
+                inputs.append((root, file))
+
+    # log lines, voxel sizes and existing files are merged in input order, whatever order the workers finish in
+    writer = AsyncWriter(writerThreads, 2 * (parallelPref + writerThreads))
+    pool = Executors.newFixedThreadPool(parallelPref)
+
+    # every series of a file is a task of its own, so the series of multi-position files are processed in parallel
+    tasks = []
+    for number, (root, file) in enumerate(selectShard(inputs, shard)):
+        path = os.path.join(root, file)
+        if isUpToDate(manifest.get(path), path):
+            tasks.append(SkippedTask(path, manifest[path]))
+        else:
+            tasks.append(FileTask(root, file, number, 0, pool))
+
+    seriesDone = {}
+    finished = {}
+    completed = False
+    try:
+        futures = [pool.submit(task) for task in tasks]
+        for result in fileResults(futures):
+            for msg, args in result.logLines:
+                logging.info(msg, *args)
+            voxel_info += ''.join(result.voxelRows)
+            overwriteList.extend(result.existingFiles)
+            if result.error is not None:
+                logging.error('Could not process %s: %s', result.path, result.error)
+            if result.skipped:
+                skippedCount += 1
+                continue
+            # a file goes into the manifest once all of its series are done, and only if none of them failed
+            done = seriesDone.setdefault(result.path, [])
+            done.append(result)
+            # the first series knows how many the file has
+            if len(done) == done[0].seriesCount:
+                if any(series.error is not None for series in done):
+                    failedFiles.append(result.path)
+                    continue
+                imageCount += 1
+                size, mtime = fileStamp(result.path)
+                finished[result.path] = {'size': size, 'mtime': mtime, 'params': manifestParams,
+                                         'outputs': sum([series.outputs for series in done], []),
+                                         'voxelRows': sum([series.voxelRows for series in done], [])}
+        completed = True
+    finally:
+        # after an error, the queued files are dropped before the writer is flushed
+        stopPool(pool, not completed)
+        writeErrors = writer.flush()
+        for path, error in writeErrors:
+            logging.error('Could not write %s: %s', path, error)
+        # the outputs are only on disk now
+        commitManifest(manifest, finished, set(path for path, error in writeErrors))
+        opts.catalog.close()
+
+    with open(os.path.join(outDir, "VoxelSize" + shardSuffix + ".txt"), 'w') as output:
+        output.write(voxel_info)
+
+    logDuration(startTime, imageCount)
+    if skippedCount:
+        logging.info('%i unchanged files skipped', skippedCount)
+    if failedFiles:
+        logging.error('%i files could not be processed:', len(failedFiles))
+        for path in failedFiles:
+            logging.error('    %s', path)
+
+    if overwriteList:
+        logging.info('Existing Files:')
+        for item in overwriteList:
+            logging.info('    %s', item)
+
+    timer.report(outDir, "StageTimes" + shardSuffix)
+
+    IJ.log("\\Clear")
+    IJ.log("Finished")
+
+
+def show_gui():
+    gd = GenericDialog("Set ZProject Options")
+    gd.addStringField("File extension to be processed", ".nd2")
+    gd.addRadioButtonGroup("Output", outDirChoices, 3, 1, outDirChoices[0])
+    gd.addRadioButtonGroup("Overwrite", overwriteChoices, 2, 1, overwriteChoices[0])
+    gd.addRadioButtonGroup("Save channels in different subfolders", channelSubfolderChoices, 1, 1,
+                           channelSubfolderChoices[0])
+    gd.addCheckboxGroup(len(zProjChoices), 1, zProjChoices, [True] + [False] * (len(zProjChoices) - 1),
+                        ["What kind of z-projection?"])
+    gd.addCheckbox("Convert to RGB", True)
+    gd.addCheckboxGroup(2, 1, mipChoices, [True, False], ["How do you want save the z-projections of your images?"])
+    gd.addCheckbox("Convert z-stacks to tiff", False)
+    gd.addNumericField("Files processed in parallel", 1, 0)
+    gd.addNumericField("Writer threads", 1, 0)
+    gd.showDialog()
+    if gd.wasCanceled():
+        return
+
+    fileExt = gd.getNextString()
+    outDirPref = gd.getNextRadioButton()
+    overwritePref = gd.getNextRadioButton()
+    channelSubfolderPref = gd.getNextRadioButton()
+    zProjPref = [choice for choice in zProjChoices if gd.getNextBoolean()]
+    rgbpref = gd.getNextBoolean()
+    mipPrefTIFF = gd.getNextBoolean()
+    mipPrefJPG = gd.getNextBoolean()
+    stackPref = gd.getNextBoolean()
+    parallelPref = max(1, int(gd.getNextNumber()))
+    writerThreads = max(1, int(gd.getNextNumber()))
+
+    if not fileExt.startswith('.'):
+        fileExt = '.' + fileExt
+
+    inDir = IJ.getDirectory("Choose Directory Containing Input Files")
+    if inDir is None:
+        IJ.log('No input directory selected!')
+        return
+
+    if outDirPref == outDirChoices[2]:
+        outDir = inDir
+    else:
+        outDir = IJ.getDirectory("Choose Directory For Output")
+        if outDir is None:
+            IJ.log('No output directory selected!')
+            return
+
+    run_zproject(inDir, outDir, fileExt, outDirPref, overwritePref, channelSubfolderPref, zProjPref, rgbpref,
+                 mipPrefTIFF, mipPrefJPG, stackPref, parallelPref, writerThreads=writerThreads)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="ZProject.py", description="Split channels and z-project microscopy images.")
+    parser.add_argument("--input", required=True, help="directory containing the input files")
+    parser.add_argument("--output", help="output directory (not needed with --layout input)")
+    parser.add_argument("--ext", default=".nd2", help="file extension to be processed")
+    parser.add_argument("--layout", choices=outDirArgs, default=outDirArgs[0],
+                        help="flat: new directory, no subfolders; tree: keep input subfolders; input: write next to the inputs")
+    parser.add_argument("--overwrite", action="store_true", help="overwrite existing files")
+    parser.add_argument("--channel-subfolders", choices=channelSubfolderChoices, default=channelSubfolderChoices[0])
+    parser.add_argument("--projection", nargs="+", choices=zProjArgs, default=zProjArgs[:1])
+    parser.add_argument("--no-rgb", action="store_true", help="do not convert the z-projections to RGB")
+    parser.add_argument("--mip-format", nargs="+", choices=mipChoices, default=mipChoices[:1])
+    parser.add_argument("--save-stacks", action="store_true", help="convert the z-stacks to tiff")
+    parser.add_argument("--parallel", type=int, default=1, help="files processed in parallel")
+    parser.add_argument("--shard", type=parseShard, help="i/N: process only the i-th of N parts of the input list")
+    parser.add_argument("--writers", type=int, default=1, help="threads writing the output files")
+    addCatalogArguments(parser)
+    args = parser.parse_args(argv)
+    if args.output is None and args.layout != outDirArgs[2]:
+        parser.error("--output is required unless --layout input")
+    return args
+
+
+def main():
+    if len(sys.argv) < 2:
+        show_gui()
+        return
+    args = parse_args(sys.argv[1:])
+    fileExt = args.ext if args.ext.startswith('.') else '.' + args.ext
+    run_zproject(args.input, args.output or args.input, fileExt, outDirChoices[outDirArgs.index(args.layout)],
+                 overwriteChoices[1] if args.overwrite else overwriteChoices[0], args.channel_subfolders,
+                 [zProjChoices[zProjArgs.index(method)] for method in zProjArgs if method in args.projection],
+                 not args.no_rgb, "tiff" in args.mip_format, "jpg" in args.mip_format, args.save_stacks,
+                 max(1, args.parallel), args.shard, max(1, args.writers), args.catalog)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,496 @@
+import os
+import re
+import math
+import sys
+import shutil
+import random
+import argparse
+import csv
+import json
+import time
+import logging
+import threading
+import subprocess
+from ij import IJ, ImagePlus
+from ij.io import FileSaver, RoiEncoder, TiffDecoder
+from ij.gui import Line, Roi
+from ij.process import ByteProcessor, ColorProcessor, ShortProcessor, ImageProcessor
+from ij.plugin import RGBStackMerge
+from loci.formats import MetadataTools, FormatTools
+from loci.formats.out import OMETiffWriter
+from loci.common import DataTools
+from ome.units import UNITS
+from ome.units.quantity import Length
+from java.lang import Runtime, System
+from java.awt import Color
+from java.util.zip import ZipEntry, ZipOutputStream
+from java.io import BufferedOutputStream, DataOutputStream, FileOutputStream
+
+scriptDir = os.path.dirname(os.path.abspath(sys.argv[0])) if sys.argv and sys.argv[0] else os.getcwd()
+scriptNames = ["ZProject", "split_channels", "histo_splitter", "cropROI", "SegmentVesselsWeka",
+               "AnalyseParticlesSpheroids"]
+
+# Dataset sizes; every value can be overridden on the command line
+presets = {
+    'small': {'stacks': 4, 'stackSize': 512, 'planes': 16, 'channels': 3, 'slides': 1, 'slideSize': 4096,
+              'samples': 2, 'timepoints': 3, 'wellSize': 1024},
+    'medium': {'stacks': 8, 'stackSize': 1024, 'planes': 32, 'channels': 4, 'slides': 2, 'slideSize': 12000,
+               'samples': 4, 'timepoints': 6, 'wellSize': 2048},
+    'large': {'stacks': 16, 'stackSize': 2048, 'planes': 64, 'channels': 6, 'slides': 4, 'slideSize': 20000,
+              'samples': 8, 'timepoints': 12, 'wellSize': 2048},
+}
+pixelWidth = 0.65
+# bumped when the generated files change, so that older data directories are regenerated
+datasetVersion = 2
+
+
+# Synthetic data; the layouts and file names match the scripts' defaults, and the ground truth goes to truth.json
+def writeOmeTiff(path, planes, sizeX, sizeY, sizeZ, channelNames):
+    """Writes uint16 planes, given in XYZCT order, as a single-series OME-TIFF."""
+    meta = MetadataTools.createOMEXMLMetadata()
+    MetadataTools.populateMetadata(meta, 0, os.path.basename(path), True, "XYZCT",
+                                   FormatTools.getPixelTypeString(FormatTools.UINT16), sizeX, sizeY, sizeZ,
+                                   len(channelNames), 1, 1)
+    for c, name in enumerate(channelNames):
+        meta.setChannelName(name, 0, c)
+    meta.setPixelsPhysicalSizeX(Length(pixelWidth, UNITS.MICROMETER), 0)
+    meta.setPixelsPhysicalSizeY(Length(pixelWidth, UNITS.MICROMETER), 0)
+    meta.setPixelsPhysicalSizeZ(Length(2.0, UNITS.MICROMETER), 0)
+    if os.path.exists(path):
+        os.remove(path)
+    writer = OMETiffWriter()
+    writer.setMetadataRetrieve(meta)
+    writer.setId(path)
+    try:
+        for index, ip in enumerate(planes):
+            writer.saveBytes(index, DataTools.shortsToBytes(ip.getPixels(), True))
+    finally:
+        writer.close()
+
+
+def makeStacks(dataDir, params, rng):
+    """Multi-channel z-stacks with blobs that peak at a known plane, for ZProject.py and split_channels.py."""
+    size, depth = params['stackSize'], params['planes']
+    channelNames = ["Ch%i" % c for c in range(params['channels'])]
+    truth = []
+    for n in range(params['stacks']):
+        blobs = [(rng.randint(0, size - 1), rng.randint(0, size - 1), rng.randint(4, size // 16),
+                  rng.randint(0, depth - 1)) for i in range(size // 16)]
+
+        def planes():
+            for c in range(len(channelNames)):
+                for z in range(depth):
+                    ip = ShortProcessor(size, size)
+                    ip.add(100)
+                    for x, y, r, zc in blobs:
+                        ip.setValue(max(0, 4000 - 400 * abs(z - zc)) * (c + 1))
+                        ip.fillOval(x - r, y - r, 2 * r, 2 * r)
+                    ip.noise(20)
+                    yield ip
+        name = "stack%03d.ome.tif" % n
+        writeOmeTiff(os.path.join(dataDir, "stacks", name), planes(), size, size, depth, channelNames)
+        truth.append({'file': name, 'blobs': [{'x': x, 'y': y, 'r': r, 'z': zc} for x, y, r, zc in blobs]})
+    return truth
+
+
+def makeSlides(dataDir, params, rng):
+    """Whole-slide-sized RGB TIFFs with tissue sections at known bounding boxes, for histo_splitter.py."""
+    size = params['slideSize']
+    truth = []
+    for n in range(params['slides']):
+        ip = ColorProcessor(size, size)
+        ip.setColor(Color(240, 240, 240))
+        ip.fill()
+        boxes = []
+        for i in range(4):
+            w, h = rng.randint(size // 8, size // 4), rng.randint(size // 8, size // 4)
+            x, y = (i % 2) * size // 2 + rng.randint(0, size // 4), (i // 2) * size // 2 + rng.randint(0, size // 4)
+            ip.setColor(Color(rng.randint(150, 220), rng.randint(60, 120), rng.randint(150, 200)))
+            ip.fillOval(x, y, w, h)
+            boxes.append({'x': x, 'y': y, 'width': w, 'height': h})
+        ip.noise(8)
+        imp = ImagePlus("slide", ip)
+        imp.getCalibration().pixelWidth = imp.getCalibration().pixelHeight = pixelWidth
+        imp.getCalibration().setUnit("micron")
+        name = "slide%02d_Wholeslide_Default_Extended.tif" % n
+        FileSaver(imp).saveAsTiff(os.path.join(dataDir, "slides", name))
+        # the ROI set histo_splitter.py would have saved, for its replay mode
+        saveRois([Roi(box['x'], box['y'], box['width'], box['height']) for box in boxes],
+                 os.path.join(dataDir, "slides", name.replace(".tif", "") + "ROIs.zip"))
+        truth.append({'file': name, 'tissue': boxes})
+    return truth
+
+
+def saveRois(rois, path):
+    zos = ZipOutputStream(BufferedOutputStream(FileOutputStream(path)))
+    out = DataOutputStream(zos)
+    encoder = RoiEncoder(out)
+    for i, roi in enumerate(rois):
+        zos.putNextEntry(ZipEntry("tissue-%i.roi" % (i + 1)))
+        encoder.write(roi)
+        out.flush()
+    out.close()
+
+
+def wellImages(size, spheroids, t):
+    """Vessel (C00), spheroid (C01) and transmitted light (C02) images of one well at timepoint t."""
+    vessel, spheroid, transmitted = ByteProcessor(size, size), ByteProcessor(size, size), ByteProcessor(size, size)
+    vessel.add(20)
+    spheroid.add(20)
+    transmitted.add(180)
+    vessel.setLineWidth(3)
+    vessel.setValue(180)
+    spheroid.setValue(200)
+    transmitted.setValue(90)
+    for s in spheroids:
+        x, y, r = s['x'] + s['dx'] * t, s['y'] + s['dy'] * t, s['r'] + s['growth'] * t
+        for angle in s['vessels']:
+            length = r + (t + 1) * r // 4
+            vessel.drawLine(x, y, int(x + length * math.cos(angle)), int(y + length * math.sin(angle)))
+        spheroid.fillOval(x - r, y - r, 2 * r, 2 * r)
+        transmitted.fillOval(x - r, y - r, 2 * r, 2 * r)
+    for ip in (vessel, spheroid, transmitted):
+        ip.noise(10)
+    return vessel, spheroid, transmitted
+
+
+def makeWells(dataDir, params, rng):
+    """Time series of spheroids sprouting vessels, for cropROI.py and the scripts that work on its crops."""
+    size = params['wellSize']
+    truth = []
+    for n in range(params['samples']):
+        spheroids = []
+        for i in range(2):
+            spheroids.append({'x': size // 4 + i * size // 2, 'y': size // 2 + rng.randint(-size // 8, size // 8),
+                              'r': size // 16, 'growth': size // 256, 'dx': rng.randint(-3, 3),
+                              'dy': rng.randint(-3, 3),
+                              'vessels': [rng.uniform(0, 2 * math.pi) for k in range(rng.randint(3, 6))]})
+        sample = "SP%02d" % n
+        for t in range(params['timepoints']):
+            for c, ip in enumerate(wellImages(size, spheroids, t)):
+                imp = ImagePlus(sample, ip)
+                imp.getCalibration().pixelWidth = imp.getCalibration().pixelHeight = pixelWidth
+                imp.getCalibration().setUnit("micron")
+                FileSaver(imp).saveAsTiff(os.path.join(dataDir, "wells", "%s_well-t%04d-C%02d.tif" % (sample, t + 1, c)))
+        truth.append({'sample': sample, 'spheroids': spheroids})
+    return truth
+
+
+def trainClassifier(path, params, rng):
+    """Trains a vessel/background classifier on a synthetic composite, prepared like SegmentVesselsWeka.py does."""
+    from trainableSegmentation import WekaSegmentation
+    size = params['wellSize'] // 4
+    spheroid = {'x': size // 2, 'y': size // 2, 'r': size // 8, 'growth': 0, 'dx': 0, 'dy': 0,
+                'vessels': [rng.uniform(0, 2 * math.pi) for k in range(4)]}
+    vessel, unused, transmitted = wellImages(size, [spheroid], 2)
+    vesselimg = ImagePlus("vessel", vessel)
+    IJ.run(vesselimg, "Gaussian Blur...", "sigma=1 scaled")
+    IJ.run(vesselimg, "Auto Threshold", "method=Otsu white")
+    composite = RGBStackMerge.mergeChannels([vesselimg, ImagePlus("transmitted", transmitted)], False)
+    weka = WekaSegmentation(composite)
+    length = spheroid['r'] * 2
+    for angle in spheroid['vessels']:
+        x, y = spheroid['x'] + 1.2 * spheroid['r'] * math.cos(angle), spheroid['y'] + 1.2 * spheroid['r'] * math.sin(angle)
+        weka.addExample(0, Line(x, y, x + length * math.cos(angle), y + length * math.sin(angle)), 1)
+    weka.addExample(1, Roi(0, 0, size // 8, size // 8), 1)
+    weka.addExample(1, Roi(size - size // 8, size - size // 8, size // 8, size // 8), 1)
+    weka.trainClassifier()
+    weka.saveClassifier(path)
+
+
+def makeData(dataDir, params, seed):
+    """Generates the datasets, unless dataDir already holds them for the same parameters."""
+    paramsFile = os.path.join(dataDir, "dataset.json")
+    if os.path.isfile(paramsFile):
+        with open(paramsFile, 'r') as f:
+            if json.load(f) == {'params': params, 'seed': seed, 'version': datasetVersion}:
+                return
+    for subdir in ["stacks", "slides", "wells", "classifier"]:
+        if os.path.isdir(os.path.join(dataDir, subdir)):
+            shutil.rmtree(os.path.join(dataDir, subdir))
+        os.makedirs(os.path.join(dataDir, subdir))
+    ImageProcessor.setRandomSeed(seed)
+    rng = random.Random(seed)
+    truth = {'stacks': makeStacks(dataDir, params, rng), 'slides': makeSlides(dataDir, params, rng),
+             'wells': makeWells(dataDir, params, rng)}
+    try:
+        trainClassifier(os.path.join(dataDir, "classifier", "classifier.model"), params, rng)
+    except ImportError:
+        print("Trainable Weka Segmentation is not installed, SegmentVesselsWeka.py will be skipped")
+    with open(os.path.join(dataDir, "truth.json"), 'w') as f:
+        json.dump(truth, f, indent=1, sort_keys=True)
+    with open(paramsFile, 'w') as f:
+        json.dump({'params': params, 'seed': seed, 'version': datasetVersion}, f)
+
+
+# Measurements
+class HeapSampler(object):
+    """Polls the used Java heap on a background thread and keeps the maximum."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def used(self):
+        runtime = Runtime.getRuntime()
+        return runtime.totalMemory() - runtime.freeMemory()
+
+    def start(self):
+        System.gc()
+        self.peak = self.used()
+        self.running = True
+        self.thread = threading.Thread(target=self.poll, name="heap-sampler")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def poll(self):
+        while self.running:
+            self.peak = max(self.peak, self.used())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return self.peak
+
+
+def inputFiles(directory, fileExt):
+    files = []
+    for root, dirs, names in os.walk(directory):
+        files.extend(os.path.join(root, name) for name in names if name.endswith(fileExt))
+    return files
+
+
+def resetLogging():
+    # the scripts configure the root logger, which logging.basicConfig only does once per process
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+        handler.close()
+
+
+def measure(name, run, inputs, outDir):
+    """Runs one script and returns its files/s, MB/s, peak heap and the stage summary it wrote to outDir."""
+    if os.path.isdir(outDir):
+        shutil.rmtree(outDir)
+    os.makedirs(outDir)
+    resetLogging()
+    nbytes = sum(os.path.getsize(path) for path in inputs)
+    result = {'files': len(inputs), 'bytes': nbytes, 'error': None}
+    heap = HeapSampler()
+    heap.start()
+    start = time.time()
+    try:
+        run()
+    except Exception as e:
+        result['error'] = str(e)
+    seconds = time.time() - start
+    result.update({'seconds': seconds, 'peak_heap_MB': heap.stop() / 1e6,
+                   'files_per_s': len(inputs) / seconds if seconds > 0 else None,
+                   'MB_per_s': nbytes / seconds / 1e6 if seconds > 0 else None})
+    stageFile = os.path.join(outDir, "StageTimes.json")
+    if os.path.isfile(stageFile):
+        with open(stageFile, 'r') as f:
+            result['stages'] = json.load(f)['stages']
+    print("%-26s %6i files %9.1f s %8.2f MB/s %8.0f MB heap%s" % (
+        name, len(inputs), seconds, result['MB_per_s'] or 0, result['peak_heap_MB'],
+        "" if result['error'] is None else "  ERROR: " + result['error']))
+    return result
+
+
+# Correctness: cheap comparisons of the outputs with truth.json, so that a faster run is also a right one
+def outputFiles(outDir, fileExt):
+    return dict((os.path.basename(path), path) for path in inputFiles(outDir, fileExt))
+
+
+def checkZProject(truth, outDir, params):
+    """Every blob peaks at the maximum of its channel, so the MIP is at its brightest at each blob centre."""
+    files, problems = outputFiles(outDir, ".tiff"), []
+    for stack in truth['stacks']:
+        for c in range(params['channels']):
+            name = "%s_Ch%i.tiff" % (stack['file'].split(".ome.tif")[0], c)
+            if name not in files:
+                problems.append("no MIP " + name)
+                continue
+            ip = IJ.openImage(files[name]).getProcessor()
+            brightest = ip.getStatistics().max
+            dim = [blob for blob in stack['blobs'] if ip.getPixelValue(blob['x'], blob['y']) < 0.9 * brightest]
+            if dim:
+                problems.append("%s: %i of %i blob centres below the peak" % (name, len(dim), len(stack['blobs'])))
+    return problems
+
+
+def checkSplitChannels(truth, outDir, params):
+    """One file per channel of each stack."""
+    files = outputFiles(outDir, ".tiff")
+    return ["no channel file " + name for name in
+            ("%s_Ch%i.tiff" % (stack['file'].split(".ome.tif")[0], c)
+             for stack in truth['stacks'] for c in range(params['channels'])) if name not in files]
+
+
+def checkHistoSplitter(truth, outDir, params):
+    """One crop per tissue section, the size of its bounding box."""
+    files, problems = outputFiles(outDir, ".tiff"), []
+    for slide in truth['slides']:
+        for i, box in enumerate(slide['tissue']):
+            # the crops are named after the slide without histo_splitter.py's default file ID
+            name = "%s_ROI-%i.tiff" % (slide['file'].replace("Wholeslide_Default_Extended", "").split(".tif")[0], i + 1)
+            if name not in files:
+                problems.append("no crop " + name)
+                continue
+            fi = TiffDecoder(os.path.dirname(files[name]), name).getTiffInfo()[0]
+            if (fi.width, fi.height) != (box['width'], box['height']):
+                problems.append("%s is %ix%i instead of %ix%i" % (name, fi.width, fi.height, box['width'],
+                                                                   box['height']))
+    return problems
+
+
+def checkCropROI(truth, outDir, params):
+    """The spheroid count of each sample."""
+    countFile = os.path.join(outDir, "spheroid_count.csv")
+    if not os.path.isfile(countFile):
+        return ["no spheroid_count.csv"]
+    with open(countFile, 'r') as f:
+        rows = list(csv.DictReader(f))
+    problems = []
+    for well in truth['wells']:
+        counts = [int(float(row['Count'])) for row in rows if row['Slice'].startswith(well['sample'] + "_")]
+        if counts != [len(well['spheroids'])]:
+            problems.append("%s: %s spheroids instead of %i" % (well['sample'], counts, len(well['spheroids'])))
+    return problems
+
+
+checks = {"ZProject": checkZProject, "split_channels": checkSplitChannels, "histo_splitter": checkHistoSplitter,
+          "cropROI": checkCropROI}
+
+
+def checkOutputs(results, dataDir, outDir, params):
+    """Adds 'check' (the problems found, empty if none) to the results of the scripts there is a check for."""
+    with open(os.path.join(dataDir, "truth.json"), 'r') as f:
+        truth = json.load(f)
+    for name in scriptNames:
+        if name not in checks or 'seconds' not in results.get(name, {}):
+            continue
+        try:
+            problems = checks[name](truth, os.path.join(outDir, name), params)
+        except Exception as e:
+            problems = ["check failed: " + str(e)]
+        results[name]['check'] = problems
+        print("%-26s %s" % (name, "outputs OK" if not problems else "WRONG OUTPUT: " + "; ".join(problems[:5])))
+
+
+def runScripts(dataDir, outDir, scripts, parallel, writers):
+    sys.path.insert(0, scriptDir)
+    results = {}
+    stacks = os.path.join(dataDir, "stacks")
+    slides = os.path.join(dataDir, "slides")
+    wells = os.path.join(dataDir, "wells")
+    out = dict((name, os.path.join(outDir, name)) for name in scriptNames)
+    classifierDir = os.path.join(dataDir, "classifier")
+
+    if "ZProject" in scripts:
+        import ZProject
+        results["ZProject"] = measure("ZProject", lambda: ZProject.run_zproject(
+            stacks, out["ZProject"], ".ome.tif", overwritePref=ZProject.overwriteChoices[1],
+            parallelPref=parallel, writerThreads=writers), inputFiles(stacks, ".ome.tif"), out["ZProject"])
+    if "split_channels" in scripts:
+        import split_channels
+        results["split_channels"] = measure("split_channels", lambda: split_channels.run_split_channels(
+            stacks, out["split_channels"], ".ome.tif", parallelPref=parallel, writerThreads=writers),
+            inputFiles(stacks, ".ome.tif"), out["split_channels"])
+    if "histo_splitter" in scripts:
+        import histo_splitter
+        results["histo_splitter"] = measure("histo_splitter", lambda: histo_splitter.run_replay(
+            slides, out["histo_splitter"], ".tif", outDirPref=histo_splitter.outDirChoices[0],
+            parallelPref=parallel, writerThreads=writers), inputFiles(slides, ".tif"), out["histo_splitter"])
+    if "cropROI" in scripts:
+        import cropROI
+        results["cropROI"] = measure("cropROI", lambda: cropROI.run_spheroid_analysis(
+            wells, out["cropROI"], ".tif", "^(\w{3,4})_", r'-t(\d{4})', r'-C(\d{2})', 2000, 1.5, "01",
+            cropROI.resortChoices[0], True), inputFiles(wells, ".tif"), out["cropROI"])
+    if "SegmentVesselsWeka" in scripts:
+        if not os.path.isfile(os.path.join(classifierDir, "classifier.model")):
+            results["SegmentVesselsWeka"] = {'skipped': "no classifier, Trainable Weka Segmentation is not installed"}
+        else:
+            import SegmentVesselsWeka
+            crops = [path for path in inputFiles(out["cropROI"], ".tif") if os.path.dirname(path) == out["cropROI"]]
+            results["SegmentVesselsWeka"] = measure("SegmentVesselsWeka", lambda: SegmentVesselsWeka.run_segmentation(
+                out["cropROI"], out["SegmentVesselsWeka"], classifierDir,
+                os.path.join(scriptDir, "res", "ClassifiedImageLUT.lut"), ".tif", re.compile("^(\w{3,4})_"),
+                re.compile(r'(.+?_T\d{4})_C\d{2}\.tif'), "00", "02", True, False),
+                [path for path in crops if path.endswith(("_C00.tif", "_C02.tif"))], out["SegmentVesselsWeka"])
+    if "AnalyseParticlesSpheroids" in scripts:
+        import AnalyseParticlesSpheroids
+
+        def analyse():
+            AnalyseParticlesSpheroids.setup_directories(out["AnalyseParticlesSpheroids"])
+            AnalyseParticlesSpheroids.process_images(
+                out["SegmentVesselsWeka"], out["cropROI"], out["AnalyseParticlesSpheroids"], ".tif",
+                r'_?(\w{3,4}_SpheroidROI_\d{1,2})_', r'_?(\w{3,4}_SpheroidROI_\d{1,2}_T\d{3,4})', r'classified_',
+                True, True, 1.15, "_C01", 2000)
+        segmented = [path for path in inputFiles(out["SegmentVesselsWeka"], ".tif")
+                     if os.path.basename(path).startswith("classified_")]
+        results["AnalyseParticlesSpheroids"] = measure("AnalyseParticlesSpheroids", analyse, segmented,
+                                                       out["AnalyseParticlesSpheroids"])
+    return results
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=scriptDir).strip()
+    except Exception:
+        return None
+
+
+def compare(results, previousFile):
+    with open(previousFile, 'r') as f:
+        previous = json.load(f)
+    print("Compared to %s (%s):" % (previousFile, previous.get('commit')))
+    for name in scriptNames:
+        old, new = previous['scripts'].get(name, {}), results['scripts'].get(name, {})
+        if old.get('seconds') and new.get('seconds'):
+            print("%-26s %9.1f s -> %9.1f s  (x%.2f)" % (name, old['seconds'], new['seconds'],
+                                                        old['seconds'] / new['seconds']))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="benchmark.py",
+                                     description="Benchmark the toolbox scripts on synthetic datasets.")
+    parser.add_argument("--data", required=True, help="directory for the synthetic datasets, reused between runs")
+    parser.add_argument("--output", required=True, help="directory for the script outputs and the results")
+    parser.add_argument("--scale", choices=sorted(presets), default="small", help="dataset size preset")
+    for key in sorted(presets['small']):
+        parser.add_argument("--" + key, type=int, help="override the preset's " + key)
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic data")
+    parser.add_argument("--scripts", nargs='+', choices=scriptNames, default=scriptNames)
+    parser.add_argument("--parallel", type=int, default=1, help="files processed in parallel, where supported")
+    parser.add_argument("--writers", type=int, default=1, help="writer threads, where supported")
+    parser.add_argument("--label", default="benchmark", help="results are written to <output>/<label>.json")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    params = dict(presets[args.scale])
+    for key in params:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    start = time.time()
+    makeData(args.data, params, args.seed)
+    print("Synthetic data ready in %.1f s" % (time.time() - start))
+    results = {'label': args.label, 'commit': gitCommit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'scale': args.scale, 'params': params, 'seed': args.seed, 'parallel': args.parallel,
+               'writers': args.writers, 'java': System.getProperty("java.version"),
+               'imagej': IJ.getFullVersion(), 'cpus': Runtime.getRuntime().availableProcessors(),
+               'max_heap_MB': Runtime.getRuntime().maxMemory() / 1e6,
+               'scripts': runScripts(args.data, args.output, args.scripts, args.parallel, args.writers)}
+    checkOutputs(results['scripts'], args.data, args.output, params)
+    with open(os.path.join(args.output, args.label + ".json"), 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,635 @@
 import os
 import re
-import time
-from ij import IJ, WindowManager
-from ij.measure import ResultsTable
-from ij.gui import Roi
-from ij.io import FileSaver
-from ij.plugin.frame import RoiManager
+import sys
+import argparse
+import math
+from ij import IJ, ImagePlus
+from ij.measure import Calibration, Measurements
+from ij.gui import Roi, EllipseRoi, OvalRoi, Overlay, ShapeRoi
+from ij.io import FileSaver, FileInfo, FileOpener, TiffDecoder
+from ij.process import ByteProcessor, ShortProcessor, FloatProcessor, ImageProcessor, ImageStatistics, AutoThresholder
+from ij.plugin.filter import GaussianBlur
+from java.lang import String, Throwable
+from java.awt import Color, Rectangle
+from java.util.concurrent import Callable, Executors
+from java.io import RandomAccessFile
+from java.nio import ByteBuffer, ByteOrder
+from jarray import zeros
 from ij.gui import GenericDialog
+from toolbox_common import AsyncWriter, parseShard, saveRois, selectShard, shardTag, stopPool, summaryTable, timer
+
+resortChoices = ["None", "Sample", "Timepoint (if time series)", "Channel"]
+resortArgs = ["none", "sample", "timepoint", "channel"]
+
+writer = None
 
 # Functions to save files
-def savetif(img, out_file):
-    FileSaver(img).saveAsTiff(out_file + ".tif")
+def savetif(img, out_file, close=False):
+    writer.submit(FileSaver(img).saveAsTiff, out_file + ".tif", img, close)
+
+def savepng(img, out_file, close=False):
+    writer.submit(FileSaver(img).saveAsPng, out_file + ".png", img, close)
+
+# Index of the input files by sample, timepoint and channel
+def firstMatch(pattern, name):
+    """Returns what re.findall(pattern, name)[0] would, or None if the pattern does not match."""
+    match = pattern.search(name)
+    if match is None:
+        return None
+    if pattern.groups == 0:
+        return match.group(0)
+    return match.group(1) if pattern.groups == 1 else match.groups()
+
+
+class FilenameIndex(object):
+    """Parses the name of every input file once, in one scan of the folder.
+
+    entries holds a dict (file, sample, timepoint, channel) per file in name order; files with the extension
+    whose names lack the sample, channel or (for time series) timepoint are listed in unmatched instead.
+    """
+
+    def __init__(self, inDir, fileExt, sample_nme_pattern, time_pattern, channel_pattern, time_series):
+        sample_re, time_re, channel_re = [re.compile(p) for p in (sample_nme_pattern, time_pattern, channel_pattern)]
+        self.entries = []
+        self.unmatched = []
+        self.bySample = {}
+        for file in sorted(os.listdir(inDir)):
+            if not file.endswith(fileExt):
+                continue
+            entry = {'file': file, 'sample': firstMatch(sample_re, file), 'channel': firstMatch(channel_re, file),
+                     'timepoint': firstMatch(time_re, file) if time_series else None}
+            if entry['sample'] is None or entry['channel'] is None or (time_series and entry['timepoint'] is None):
+                self.unmatched.append(file)
+                continue
+            self.entries.append(entry)
+            self.bySample.setdefault(entry['sample'], []).append(entry)
+
+    def samples(self):
+        return sorted(self.bySample)
+
+    def timepoints(self, sample):
+        return sorted(set(entry['timepoint'] for entry in self.bySample.get(sample, [])))
+
+    def select(self, sample, timepoint=None, channel=None):
+        """Returns the entries of sample, optionally only those of one timepoint and/or channel (a regex)."""
+        entries = self.bySample.get(sample, [])
+        if timepoint is not None:
+            entries = [entry for entry in entries if entry['timepoint'] == timepoint]
+        if channel is not None:
+            channel_re = re.compile(channel)
+            entries = [entry for entry in entries if channel_re.match(entry['channel'])]
+        return entries
+
+
+# Output layout: the folder of every crop follows from the index, so the crops are written in place
+class OutputLayout(object):
+    """Plans the folder of each crop from the resort choice (by sample, timepoint or channel, or none) and
+    creates the folders once, before any crop is written."""
+
+    keys = {resortChoices[1]: 'sample', resortChoices[2]: 'timepoint', resortChoices[3]: 'channel'}
+
+    def __init__(self, outDir, resort, entries):
+        self.outDir = outDir
+        self.key = OutputLayout.keys.get(resort)
+        for folder in sorted(set(self.folder(entry) for entry in entries)):
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+    def folder(self, entry):
+        # without a time series there are no timepoint folders
+        if self.key is None or entry[self.key] is None:
+            return self.outDir
+        return os.path.join(self.outDir, entry[self.key])
+
+    def path(self, entry, name):
+        return os.path.join(self.folder(entry), name)
+
+
+# Spheroid detection on the pixel arrays: blur, Otsu threshold and dilate, then connected components in one pass
+def spheroidMask(ip, sigma, dilations=3, threshold=None):
+    """Blurs an 8- or 16-bit ip in place and returns the mask of its bright objects (255 on 0), dilated dilations
+    times, and the threshold used (Otsu's of the blurred ip unless given)."""
+    GaussianBlur().blurGaussian(ip, sigma, sigma, 0.01)
+    if threshold is None:
+        threshold = AutoThresholder().getThreshold(AutoThresholder.Method.Otsu, ip.getHistogram())
+    # the objects are the pixels above the threshold, as with Auto Threshold's 'white' option
+    ip.setThreshold(threshold + 1, ip.maxValue(), ImageProcessor.NO_LUT_UPDATE)
+    mask = ip.createMask()
+    ip.resetThreshold()
+    for i in range(dilations):
+        mask.dilate(1, 0)
+    return mask, threshold
+
+
+def squareSum(k):
+    # sum of x * x for x = 0..k
+    return k * (k + 1) * (2 * k + 1) / 6.0
+
+
+class Component(object):
+    """Pixel count, sums of x, y, x*x, y*y and x*y, and bounds of one 8-connected component."""
+
+    def __init__(self):
+        self.n = self.sx = self.sy = self.sxx = self.syy = self.sxy = 0.0
+        self.xmin = self.ymin = float('inf')
+        self.xmax = self.ymax = -1
+        # (y, x) of the first pixel in row order, which orders the components
+        self.start = None
+
+    def addRun(self, y, a, b):
+        length = b - a + 1
+        sx = (a + b) * length / 2.0
+        self.n += length
+        self.sx += sx
+        self.sy += y * length
+        self.sxx += squareSum(b) - squareSum(a - 1)
+        self.syy += float(y) * y * length
+        self.sxy += y * sx
+        self.xmin, self.xmax = min(self.xmin, a), max(self.xmax, b)
+        self.ymin, self.ymax = min(self.ymin, y), max(self.ymax, y)
+        if self.start is None or (y, a) < self.start:
+            self.start = (y, a)
+
+    def merge(self, other):
+        self.n += other.n
+        self.sx += other.sx
+        self.sy += other.sy
+        self.sxx += other.sxx
+        self.syy += other.syy
+        self.sxy += other.sxy
+        self.xmin, self.xmax = min(self.xmin, other.xmin), max(self.xmax, other.xmax)
+        self.ymin, self.ymax = min(self.ymin, other.ymin), max(self.ymax, other.ymax)
+        self.start = min(self.start, other.start)
+
+    def shift(self, dx, dy):
+        """Moves the component by (dx, dy), e.g. from a window to the whole image."""
+        self.sxx += 2 * dx * self.sx + self.n * dx * dx
+        self.syy += 2 * dy * self.sy + self.n * dy * dy
+        self.sxy += dy * self.sx + dx * self.sy + self.n * dx * dy
+        self.sx += self.n * dx
+        self.sy += self.n * dy
+        self.xmin, self.xmax, self.ymin, self.ymax = self.xmin + dx, self.xmax + dx, self.ymin + dy, self.ymax + dy
+        self.start = (self.start[0] + dy, self.start[1] + dx)
+
+    def centroid(self):
+        # pixel centres, as XM and YM of a mask
+        return self.sx / self.n + 0.5, self.sy / self.n + 0.5
+
+    def major(self):
+        """Major axis of the ellipse with the same second moments and area, as ImageJ's 'Fit ellipse'."""
+        xm, ym = self.sx / self.n, self.sy / self.n
+        # central moments, with 1/12 for the extent of a pixel
+        u20 = self.sxx / self.n - xm * xm + 1 / 12.0
+        u02 = self.syy / self.n - ym * ym + 1 / 12.0
+        u11 = self.sxy / self.n - xm * ym
+        root = math.sqrt(((u20 - u02) / 2.0) ** 2 + u11 * u11)
+        ratio = math.sqrt(((u20 + u02) / 2.0 + root) / ((u20 + u02) / 2.0 - root))
+        return 2 * math.sqrt(self.n * ratio / math.pi)
+
+
+def maskRuns(mask, y, foreground=re.compile(u'\xff+')):
+    """Returns the (first, last) x of the runs of 255 in row y of a mask."""
+    width = mask.getWidth()
+    # the row as a string of characters 0 and 255, so that the runs are found by the regex engine; ISO-8859-1 maps
+    # each byte to the character of the same code, whatever the platform's default charset
+    row = String(mask.getPixels(), y * width, width, "ISO-8859-1")
+    return [(m.start(), m.end() - 1) for m in foreground.finditer(row)]
+
+
+def labelComponents(mask):
+    """Labels the 8-connected components of a mask row by row, merging the runs with union-find, and returns
+    their accumulated moments. Time is linear in the number of pixels."""
+    parent = []
+    stats = []
+
+    def find(label):
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
+    previous = []
+    for y in range(mask.getHeight()):
+        current = []
+        k = 0
+        for a, b in maskRuns(mask, y):
+            label = None
+            # runs of the row above that touch [a, b], diagonals included
+            while k < len(previous) and previous[k][1] < a - 1:
+                k += 1
+            j = k
+            while j < len(previous) and previous[j][0] <= b + 1:
+                other = find(previous[j][2])
+                if label is None:
+                    label = other
+                elif other != label:
+                    parent[other] = label
+                    stats[label].merge(stats[other])
+                    stats[other] = None
+                j += 1
+            if label is None:
+                label = len(parent)
+                parent.append(label)
+                stats.append(Component())
+            stats[label].addRun(y, a, b)
+            current.append((a, b, label))
+        previous = current
+    return sorted([component for component in stats if component is not None], key=lambda c: c.start)
+
+
+def self_test():
+    """Labels a synthetic mask (a disc, a tilted ellipse, a ring and a U, whose arms are joined further down) and
+    compares the centroids and major axes with ImageJ's measurements of the same shapes. Returns the differences
+    found, none if the engine agrees with ImageJ."""
+    ring = ShapeRoi(OvalRoi(300, 40, 120, 120)).xor(ShapeRoi(OvalRoi(330, 70, 60, 60)))
+    u = ShapeRoi(Roi(20, 130, 80, 50)).xor(ShapeRoi(Roi(40, 130, 40, 30)))
+    shapes = [OvalRoi(20, 30, 80, 80), EllipseRoi(160, 110, 250, 60, 0.5), ring, u]
+    mask = ByteProcessor(460, 200)
+    mask.setColor(255)
+    for roi in shapes:
+        mask.fill(roi)
+    components = labelComponents(mask)
+    if len(components) != len(shapes):
+        return ["{} components found instead of {}".format(len(components), len(shapes))]
+    problems = []
+    for k, roi in enumerate(shapes):
+        mask.setRoi(roi)
+        stats = ImageStatistics.getStatistics(mask, Measurements.CENTROID | Measurements.ELLIPSE, None)
+        mask.resetRoi()
+        # the component around the shape's centroid
+        component = min(components, key=lambda c: (c.centroid()[0] - stats.xCentroid) ** 2
+                                                  + (c.centroid()[1] - stats.yCentroid) ** 2)
+        x, y = component.centroid()
+        if abs(x - stats.xCentroid) > 0.05 or abs(y - stats.yCentroid) > 0.05:
+            problems.append("shape {}: centroid ({:.2f}, {:.2f}) instead of ({:.2f}, {:.2f})".format(
+                k, x, y, stats.xCentroid, stats.yCentroid))
+        if abs(component.major() - stats.major) > 0.005 * stats.major:
+            problems.append("shape {}: major axis {:.2f} instead of {:.2f}".format(k, component.major(), stats.major))
+    return problems
+
+
+def spheroidRois(components, scale_factor):
+    """Square ROIs centred on the components, with the major axis times scale_factor as side."""
+    rois = []
+    for component in components:
+        xpt, ypt = component.centroid()
+        sidelen = component.major() * scale_factor
+        rois.append(Roi(xpt - sidelen / 2, ypt - sidelen / 2, sidelen, sidelen))
+    return rois
+
+
+# Coarse-to-fine detection: candidates on a binned copy, centroid and major axis in full-resolution windows
+coarseMinPixels = 400  # pixels the smallest spheroid keeps on the binned copy
+coarseTolerance = 0.05  # accepted difference to the full-resolution ROIs, relative to the ROI side
+
+
+def coarseBin(minPixels):
+    """Bin factor leaving a spheroid of minPixels about coarseMinPixels pixels; 1 where binning does not pay."""
+    return max(1, min(16, int(math.sqrt(minPixels / coarseMinPixels))))
+
+
+def detectCoarse(ip, sigma, minPixels, factor, dilations=3):
+    """Finds the spheroids of an 8- or 16-bit ip via a copy binned by factor, without changing ip.
+
+    The candidates are re-detected at full resolution, with the threshold of the binned copy, in a window around
+    each. Returns the components (in image coordinates), the binned mask and the threshold, or None if a spheroid
+    reaches the edge of its window, in which case the image has to be analysed at full resolution.
+    """
+    mask, threshold = spheroidMask(ip.bin(factor), float(sigma) / factor, 1)
+    margin = 2 * factor + dilations + int(math.ceil(3 * sigma)) + 2
+    width, height = ip.getWidth(), ip.getHeight()
+    components, found = [], set()
+    for candidate in labelComponents(mask):
+        # smaller candidates may still be spheroids at full resolution
+        if candidate.n * factor * factor < minPixels / 2:
+            continue
+        x0, y0 = max(0, candidate.xmin * factor - margin), max(0, candidate.ymin * factor - margin)
+        x1 = min(width, (candidate.xmax + 1) * factor + margin)
+        y1 = min(height, (candidate.ymax + 1) * factor + margin)
+        ip.setRoi(x0, y0, x1 - x0, y1 - y0)
+        window = ip.crop()
+        ip.resetRoi()
+        windowMask, threshold = spheroidMask(window, sigma, dilations, threshold)
+        cx, cy = candidate.centroid()
+        cx, cy = cx * factor - x0, cy * factor - y0
+        nearest = None
+        for component in labelComponents(windowMask):
+            x, y = component.centroid()
+            if nearest is None or (x - cx) ** 2 + (y - cy) ** 2 < nearest[0]:
+                nearest = ((x - cx) ** 2 + (y - cy) ** 2, component)
+        if nearest is None:
+            continue
+        spheroid = nearest[1]
+        if ((spheroid.xmin == 0 and x0 > 0) or (spheroid.ymin == 0 and y0 > 0)
+                or (spheroid.xmax == x1 - x0 - 1 and x1 < width) or (spheroid.ymax == y1 - y0 - 1 and y1 < height)):
+            return None
+        spheroid.shift(x0, y0)
+        if spheroid.n >= minPixels and spheroid.start not in found:
+            found.add(spheroid.start)
+            components.append(spheroid)
+    return sorted(components, key=lambda c: c.start), mask, threshold
+
+
+def compareRois(reference, rois, tolerance=coarseTolerance):
+    """Lists the differences between two ROI lists beyond tolerance (relative to the reference side)."""
+    if len(reference) != len(rois):
+        return ["%i ROIs instead of %i" % (len(rois), len(reference))]
+    messages = []
+    for i, (expected, roi) in enumerate(zip(reference, rois)):
+        a, b = expected.getFloatBounds(), roi.getFloatBounds()
+        offset = max(abs(a.getCenterX() - b.getCenterX()), abs(a.getCenterY() - b.getCenterY()))
+        if offset > tolerance * a.width or abs(a.width - b.width) > tolerance * a.width:
+            messages.append("ROI %i at (%.1f, %.1f) side %.1f instead of (%.1f, %.1f) side %.1f" % (
+                i, b.getCenterX(), b.getCenterY(), b.width, a.getCenterX(), a.getCenterY(), a.width))
+    return messages
+
+
+def componentSummary(title, components, imageArea, pixelArea):
+    """The row Analyze Particles adds to the Summary window with 'summarize', measured on the mask."""
+    total = sum(component.n for component in components) * pixelArea
+    count = len(components)
+    return [("Slice", title), ("Count", count), ("Total Area", total),
+            ("Average Size", total / count if count else float('nan')), ("%Area", 100.0 * total / imageArea),
+            ("Mean", 255 if count else float('nan'))]
+
+
+# Reading ROI rectangles straight from the file
+class TiffRegions(object):
+    """Reads rectangles of an uncompressed single-plane TIFF from disk, row by row, without loading the image.
+
+    open() returns None for files it can't read this way (compressed, stacks, RGB, ...), which are then loaded.
+    """
+
+    types = {FileInfo.GRAY8: 1, FileInfo.GRAY16_UNSIGNED: 2, FileInfo.GRAY32_FLOAT: 4}
+
+    @staticmethod
+    def open(path):
+        if not path.lower().endswith((".tif", ".tiff")):
+            return None
+        try:
+            info = TiffDecoder(os.path.dirname(path), os.path.basename(path)).getTiffInfo()
+        except (Exception, Throwable):
+            return None
+        if info is None or len(info) != 1:
+            return None
+        fi = info[0]
+        if fi.nImages != 1 or fi.compression != FileInfo.COMPRESSION_NONE or fi.fileType not in TiffRegions.types \
+                or fi.lutSize > 0:
+            return None
+        # the rows must follow each other in the file, as ImageJ writes them
+        offsets, lengths = fi.stripOffsets, fi.stripLengths
+        if offsets is not None and any(offsets[k + 1] != offsets[k] + lengths[k] for k in range(len(offsets) - 1)):
+            return None
+        return TiffRegions(path, fi)
+
+    def __init__(self, path, fi):
+        self.fi = fi
+        self.bytesPerPixel = TiffRegions.types[fi.fileType]
+        self.offset = fi.stripOffsets[0] if fi.stripOffsets is not None else fi.getOffset()
+        self.file = RandomAccessFile(path, "r")
+        self.calibration = TiffRegions.readCalibration(fi)
+
+    @staticmethod
+    def readCalibration(fi):
+        """The calibration IJ.openImage gives the file: the unit, z spacing and origin of an ImageJ TIFF are in its
+        description, which TiffDecoder leaves unparsed."""
+        props = FileOpener(fi).decodeDescriptionString(fi) if fi.description is not None else None
+        cal = Calibration()
+        if fi.pixelWidth > 0 and fi.unit is not None:
+            cal.pixelWidth, cal.pixelHeight, cal.pixelDepth = fi.pixelWidth, fi.pixelHeight, fi.pixelDepth
+            cal.setUnit(fi.unit)
+        if props is not None:
+            try:
+                cal.xOrigin = float(props.getProperty("xorigin", "0"))
+                cal.yOrigin = float(props.getProperty("yorigin", "0"))
+            except ValueError:
+                pass
+        return cal
+
+    def read(self, bounds):
+        """Returns the rectangle bounds (clipped to the image) as a calibrated image."""
+        fi, bpp = self.fi, self.bytesPerPixel
+        x, y = max(0, bounds.x), max(0, bounds.y)
+        w = min(bounds.x + bounds.width, fi.width) - x
+        h = min(bounds.y + bounds.height, fi.height) - y
+        data = zeros(w * h * bpp, 'b')
+        for row in range(h):
+            self.file.seek(self.offset + ((y + row) * fi.width + x) * bpp)
+            self.file.readFully(data, row * w * bpp, w * bpp)
+        if bpp == 1:
+            ip = ByteProcessor(w, h, data)
+        else:
+            buf = ByteBuffer.wrap(data).order(ByteOrder.LITTLE_ENDIAN if fi.intelByteOrder else ByteOrder.BIG_ENDIAN)
+            if bpp == 2:
+                pixels = zeros(w * h, 'h')
+                buf.asShortBuffer().get(pixels)
+                ip = ShortProcessor(w, h, pixels, None)
+            else:
+                pixels = zeros(w * h, 'f')
+                buf.asFloatBuffer().get(pixels)
+                ip = FloatProcessor(w, h, pixels, None)
+        imp = ImagePlus(fi.fileName, ip)
+        # the origin moves with the rectangle, as when ImageJ crops the opened image
+        cal = self.calibration.copy()
+        cal.xOrigin, cal.yOrigin = cal.xOrigin - x, cal.yOrigin - y
+        imp.setCalibration(cal)
+        return imp
+
+    def close(self):
+        self.file.close()
+
+
+# Function to find the spheroids of one image and the square ROIs to crop them
+class SpheroidResult(object):
+    """Crop ROIs and their names, the Summary row, the image marked with the ROIs and the threshold of the
+    spheroids (None if the image had to be converted to 8-bit), for one sample."""
+
+    def __init__(self, sample_name, rois, names, summary, marked, threshold=None):
+        self.sample_name = sample_name
+        self.rois = rois
+        self.names = names
+        self.summary = summary
+        self.marked = marked
+        self.threshold = threshold
+
+
+def detect_spheroids(inDir, file, sample_name, particle_size_min, scale_factor, coarse=False, verify=False):
+    with timer.stage("open", file, os.path.getsize(os.path.join(inDir, file))):
+        img = IJ.openImage(os.path.join(inDir, file))
+    calibration = img.getCalibration()
+    pixelArea = calibration.pixelWidth * calibration.pixelHeight
+    # sigma=1 and the minimum size are in calibrated units, as in the Gaussian Blur and Analyze Particles dialogs
+    sigma = 1 / calibration.pixelWidth
+    minPixels = particle_size_min / pixelArea
+    ip = img.getProcessor()
+    converted = ip.getBitDepth() not in (8, 16)
+    if converted:
+        ip = ip.convertToByte(True)
+    factor = coarseBin(minPixels) if coarse else 1
+    reference = ip.duplicate() if verify and factor > 1 else None
+    with timer.stage("detection", file):
+        detected = detectCoarse(ip, sigma, minPixels, factor) if factor > 1 else None
+        if detected is None:
+            if factor > 1:
+                print("{}: a spheroid exceeds its window, detecting at full resolution".format(file))
+                factor = 1
+            mask, threshold = spheroidMask(ip, sigma)
+            components = [component for component in labelComponents(mask) if component.n >= minPixels]
+            detected = components, mask, threshold
+        components, mask, threshold = detected
+    with timer.stage("measure", file):
+        rois = spheroidRois(components, scale_factor)
+        names = [sample_name + "_SpheroidROI_" + str(i) for i in range(len(rois))]
+    if reference is not None and factor > 1:
+        with timer.stage("verify", file):
+            fullMask, fullThreshold = spheroidMask(reference, sigma)
+            full = [component for component in labelComponents(fullMask) if component.n >= minPixels]
+            fullRois = spheroidRois(full, scale_factor)
+            messages = compareRois(fullRois, rois)
+        for message in messages:
+            print("{}: {}".format(file, message))
+        # beyond the tolerance, the full-resolution detection is the one kept
+        if messages:
+            print("{}: coarse detection off by more than the tolerance, using the full-resolution ROIs".format(file))
+            components, mask, threshold, rois, factor = full, fullMask, fullThreshold, fullRois, 1
+            names = [sample_name + "_SpheroidROI_" + str(i) for i in range(len(rois))]
+    img.close()
+    # the mask is binned in coarse-to-fine mode, and so is the image marked with the ROIs
+    marked = ImagePlus(img.getTitle(), mask)
+    overlay = Overlay()
+    for roi in rois:
+        bounds = roi.getFloatBounds()
+        marker = Roi(bounds.x / factor, bounds.y / factor, bounds.width / factor, bounds.height / factor)
+        marker.setStrokeColor(Color.red)
+        marker.setStrokeWidth(5)
+        overlay.add(marker)
+    marked.setOverlay(overlay)
+    summary = componentSummary(img.getTitle(), components, img.getWidth() * img.getHeight() * pixelArea, pixelArea)
+    return SpheroidResult(sample_name, rois, names, summary, marked.flatten(), None if converted else threshold)
+
+
+class DetectionTask(Callable):
+    def __init__(self, *args):
+        self.args = args
+
+    def call(self):
+        return detect_spheroids(*self.args)
+
+
+# Tracking the spheroids through a time series, searching only around their ROI at the neighbouring timepoint
+trackMargin = 0.5  # the search window extends the previous ROI by this fraction of its side on each side
+
+
+class TimepointImage(object):
+    """One image of a time series, read only at the search windows if it's an uncompressed TIFF, else loaded."""
+
+    def __init__(self, path):
+        self.regions = TiffRegions.open(path)
+        self.img = None
+        if self.regions is not None:
+            fi = self.regions.fi
+            self.width, self.height = fi.width, fi.height
+            self.pixelWidth = self.regions.calibration.pixelWidth
+        else:
+            with timer.stage("open", os.path.basename(path), os.path.getsize(path)):
+                self.img = IJ.openImage(path)
+            self.width, self.height = self.img.getWidth(), self.img.getHeight()
+            self.pixelWidth = self.img.getCalibration().pixelWidth
+
+    def window(self, x, y, w, h):
+        if self.regions is not None:
+            return self.regions.read(Rectangle(x, y, w, h)).getProcessor()
+        ip = self.img.getProcessor()
+        ip.setRoi(x, y, w, h)
+        window = ip.crop()
+        ip.resetRoi()
+        return window
+
+    def close(self):
+        if self.regions is not None:
+            self.regions.close()
+        else:
+            self.img.close()
+
+
+def trackRoi(image, roi, threshold, scale_factor, dilations=3):
+    """Re-detects the spheroid of roi in a window around it and returns its new ROI, or None if the window holds
+    no spheroid near roi or the spheroid reaches the edge of even the enlarged window."""
+    bounds = roi.getFloatBounds()
+    cx, cy = bounds.getCenterX(), bounds.getCenterY()
+    sigma = 1 / image.pixelWidth
+    for margin in (trackMargin, 2 * trackMargin):
+        pad = bounds.width * margin + dilations + math.ceil(3 * sigma)
+        x0, y0 = max(0, int(bounds.x - pad)), max(0, int(bounds.y - pad))
+        x1 = min(image.width, int(math.ceil(bounds.x + bounds.width + pad)))
+        y1 = min(image.height, int(math.ceil(bounds.y + bounds.height + pad)))
+        if x1 <= x0 or y1 <= y0:
+            return None
+        ip = image.window(x0, y0, x1 - x0, y1 - y0)
+        level = threshold
+        # converted windows are scaled on their own, so their threshold can't be carried over
+        if ip.getBitDepth() not in (8, 16) or level is None:
+            ip, level = ip.convertToByte(True), None
+        mask, level = spheroidMask(ip, sigma, dilations, level)
+        nearest = None
+        for component in labelComponents(mask):
+            x, y = component.centroid()
+            distance = (x + x0 - cx) ** 2 + (y + y0 - cy) ** 2
+            if nearest is None or distance < nearest[0]:
+                nearest = (distance, component)
+        # a spheroid further away than its side is another one
+        if nearest is None or nearest[0] > bounds.width ** 2:
+            return None
+        spheroid = nearest[1]
+        if not ((spheroid.xmin == 0 and x0 > 0) or (spheroid.ymin == 0 and y0 > 0)
+                or (spheroid.xmax == x1 - x0 - 1 and x1 < image.width)
+                or (spheroid.ymax == y1 - y0 - 1 and y1 < image.height)):
+            spheroid.shift(x0, y0)
+            return spheroidRois([spheroid], scale_factor)[0]
+    return None
+
+
+def track_spheroids(inDir, roi_files, start, rois, threshold, scale_factor):
+    """Follows the ROIs found in roi_files[start] through the other (timepoint, file) pairs of roi_files, to the
+    following and to the preceding timepoints. Returns the ROIs by timepoint; lost spheroids keep their ROI."""
+    tracked = {roi_files[start][0]: rois}
+    for step in (1, -1):
+        previous = rois
+        k = start + step
+        while 0 <= k < len(roi_files):
+            timepoint, file = roi_files[k]
+            image = TimepointImage(os.path.join(inDir, file))
+            try:
+                with timer.stage("tracking", file):
+                    current = []
+                    for i, roi in enumerate(previous):
+                        updated = trackRoi(image, roi, threshold, scale_factor)
+                        if updated is None:
+                            print("{}: spheroid {} not found near its ROI, keeping the previous one".format(file, i))
+                            updated = roi
+                        current.append(updated)
+            finally:
+                image.close()
+            tracked[timepoint] = previous = current
+            k += step
+    return tracked
+
+
+class TrackingTask(Callable):
+    def __init__(self, *args):
+        self.args = args
+
+    def call(self):
+        return track_spheroids(*self.args)
 
-def savepng(img, out_file):
-    FileSaver(img).saveAsPng(out_file + ".png")
 
 # Function to run the spheroid analysis to find the right ROIs to make the crop
 def run_spheroid_analysis(inDir, outDir, fileExt, sample_nme_pattern, time_pattern, channel_pattern,
-                          particle_size_min, scale_factor, channel_roi, resort, time_series):
+                          particle_size_min, scale_factor, channel_roi, resort, time_series, shard=None,
+                          parallelPref=1, coarse=False, verify=False, track=False):
+    global writer
+    timer.reset()
+    writer = AsyncWriter(1, 4 + parallelPref)
 
     if not os.path.isdir(os.path.join(outDir, 'ROI')):
         os.makedirs(os.path.join(outDir, 'ROI'))
@@ -25,142 +637,113 @@ def run_spheroid_analysis(inDir, outDir, fileExt, sample_nme_pattern, time_patte
     if not os.path.isdir(os.path.join(outDir, 'ROI', "ROIimages")):
         os.makedirs(os.path.join(outDir, 'ROI', "ROIimages"))
 
-    # Initialize Fiji's ROI Manager and ResultsTable
-    rm = RoiManager().getInstance()
-    rt = ResultsTable.getResultsTable()
-    rm.reset()
-    rt.reset()
-    wm = WindowManager
-
-    sample_name_list = []
-    filedct = {}
-
-    # Collect sample names and files based on the regex patterns as provided
-    for file in os.listdir(inDir):
-        if file.endswith(fileExt) and re.findall(time_pattern, file):
-            sample_name = re.findall(sample_nme_pattern, file)[0]
-            sample_name_list.append(sample_name)
-
-    sample_name_list = set(sample_name_list)
-
-    # Determine latest time point for each sample if it's a time series
-    if time_series:
-        for n in sample_name_list:
-            timepoint_list = []
-            for file in os.listdir(inDir):
-                if file.endswith(fileExt) and re.findall(n, file):
-                    timepoint = re.findall(time_pattern, file)[0]
-                    timepoint_list.append(timepoint)
-            filedct.update({n: max(timepoint_list)})
-
-    sample_name_list = set(sample_name_list)
-    correct_files = []
-
-    # Filter correct files based on regex criteria
-    for key in filedct.keys():
-        for file in os.listdir(inDir):
-            if time_series:
-                if file.endswith(fileExt) and re.findall(channel_pattern, file) and re.findall(key, file):
-                    channel = re.findall(channel_pattern, file)[0]
-                    timepoint = re.findall(time_pattern, file)[0]
-                    if re.match(channel_roi, channel) and timepoint == filedct[key]:
-                        correct_files.append(file)
-            elif not time_series:
-                if file.endswith(fileExt) and re.findall(channel_pattern, file) and re.findall(key, file):
-                    channel = re.findall(channel_pattern, file)[0]
-                    if re.match(channel_roi, channel):
-                        correct_files.append(file)
-
-    # Process each file
-    for file in correct_files:
-        sample_name = re.findall(sample_nme_pattern, file)[0]
-        img = IJ.openImage(os.path.join(inDir, file))
-        calibration = img.getCalibration()
-        pixel_width = 1 / calibration.pixelWidth
-        time.sleep(3)
-        IJ.run(img, "Gaussian Blur...", "sigma=1 scaled")
-        IJ.run(img, "Auto Threshold", "method=Otsu white")
-        IJ.run(img, "Convert to Mask", "")
-        IJ.run(img, "Dilate", "")
-        IJ.run(img, "Dilate", "")
-        IJ.run(img, "Dilate", "")
-        IJ.run(img, "Analyze Particles...", "size=" + str(particle_size_min) + "-Infinity show=Overlay summarize overlay add")
-        num_rois = rm.getCount()
-        roi_list = list(range(0, num_rois, 1))
-        for i in roi_list:
-            rm.select(img, i)
-            rm.runCommand(img, "Measure")
-            xpt = rt.getValue("XM", i) * pixel_width
-            ypt = rt.getValue("YM", i) * pixel_width
-            sidelen = rt.getValue("Major", i) * pixel_width * scale_factor
-            roi = Roi(xpt - sidelen / 2, ypt - sidelen / 2, sidelen, sidelen)
-            rm.addRoi(roi)
-            rm.rename(rm.getCount() - 1, sample_name + "_SpheroidROI_" + str(i))
-            rm.select(img, i)
-        rm.setSelectedIndexes(roi_list)
-        rm.runCommand(img, 'Delete')
-        rm.runCommand(img, "Show All")
-        rm.runCommand("Set Line Width", "5")
-        rm.runCommand("Set Color...", "red")
-        imp_flat = img.flatten()
-        savepng(imp_flat, os.path.join(outDir, "ROI", 'ROIimages', sample_name))
-        rm.runCommand("Save", os.path.join(outDir, "ROI", sample_name + "spheroidROIs.zip"))
-        img.close()
-        rm.reset()
-        rt.reset()
-
-    # Process files for each channel
-    for file in os.listdir(inDir):
-        if file.endswith(fileExt) and re.findall(channel_pattern, file):
-            rm.reset()
-            sample_name = re.findall(sample_nme_pattern, file)[0]
-            channel = re.findall(channel_pattern, file)[0]
-            if time_series:
-                timepoint = re.findall(time_pattern, file)[0]
-
-            img = IJ.openImage(os.path.join(inDir, file))
-            roipath = os.path.join(outDir, "ROI", sample_name + "spheroidROIs.zip")
-            rm.open(roipath)
-            num_rois = rm.getCount()
-            roi_list = list(range(0, num_rois, 1))
-            for i in roi_list:
-                cropped = img.duplicate()
-                rm.select(cropped, i)
-                cropped = cropped.crop()
-                roiname = rm.getName(i)
+    # One scan of the input folder, all later stages look the files up in the index
+    with timer.stage("index"):
+        index = FilenameIndex(inDir, fileExt, sample_nme_pattern, time_pattern, channel_pattern, time_series)
+    for file in index.unmatched:
+        print("Skipping {}: the name does not match the sample, time or channel pattern".format(file))
+
+    # Each array job gets its own share of the samples, all channels and timepoints of a sample stay together
+    sample_name_list = selectShard(index.samples(), shard)
+    roi_sets = {}
+
+    # The spheroids are detected in the ROI channel, at the latest timepoint if it's a time series
+    roi_entries = []
+    for sample_name in sample_name_list:
+        latest = index.timepoints(sample_name)[-1] if time_series else None
+        roi_entries.extend(index.select(sample_name, latest, channel_roi))
+
+    # The images are analysed concurrently, the results are collected in sample order
+    summary_rows = []
+    thresholds = {}
+    pool = Executors.newFixedThreadPool(parallelPref)
+    completed = False
+    try:
+        futures = [pool.submit(DetectionTask(inDir, entry['file'], entry['sample'], particle_size_min, scale_factor,
+                                             coarse, verify))
+                   for entry in roi_entries]
+        for future in futures:
+            result = future.get()
+            sample_name = result.sample_name
+            summary_rows.append(result.summary)
+            savepng(result.marked, os.path.join(outDir, "ROI", 'ROIimages', sample_name))
+            with timer.stage("save", sample_name + "spheroidROIs.zip"):
+                saveRois(result.rois, result.names, os.path.join(outDir, "ROI", sample_name + "spheroidROIs.zip"))
+            # kept for the crops of all channels and timepoints, rather than reading the zip again for each
+            roi_sets[sample_name] = (result.rois, result.names)
+            thresholds[sample_name] = result.threshold
+
+        # Tracking gives every timepoint ROIs of its own, updated from those of the neighbouring timepoint
+        if time_series and track:
+            tracks = []
+            for sample_name in sample_name_list:
+                if sample_name not in roi_sets:
+                    continue
+                roi_files = [(timepoint, index.select(sample_name, timepoint, channel_roi))
+                             for timepoint in index.timepoints(sample_name)]
+                roi_files = [(timepoint, entries[0]['file']) for timepoint, entries in roi_files if entries]
+                # the ROIs were detected at the latest timepoint
+                rois = roi_sets[sample_name][0]
+                tracks.append((sample_name, pool.submit(TrackingTask(inDir, roi_files, len(roi_files) - 1, rois,
+                                                                     thresholds[sample_name], scale_factor))))
+            for sample_name, future in tracks:
+                names = roi_sets[sample_name][1]
+                for timepoint, rois in sorted(future.get().items()):
+                    zipname = sample_name + "_T" + timepoint + "spheroidROIs.zip"
+                    with timer.stage("save", zipname):
+                        saveRois(rois, names, os.path.join(outDir, "ROI", zipname))
+                    roi_sets[(sample_name, timepoint)] = (rois, names)
+        completed = True
+    finally:
+        # after an error, the queued images are dropped instead of being analysed for nothing
+        stopPool(pool, not completed)
+
+    # The crops are written straight to their folders, which are created here once
+    with timer.stage("layout"):
+        layout = OutputLayout(outDir, resort, [entry for sample_name in sample_name_list if roi_sets.get(sample_name)
+                                               for entry in index.select(sample_name)])
+
+    # Process files for each channel; uncompressed TIFFs are read only at the ROIs, other files are loaded once
+    for sample_name in sample_name_list:
+        rois, roinames = roi_sets.get(sample_name, ([], []))
+        if not rois:
+            continue
+        for entry in index.select(sample_name):
+            file, channel, timepoint = entry['file'], entry['channel'], entry['timepoint']
+            # tracked ROIs of this timepoint if there are any, else those of the detection
+            rois, roinames = roi_sets.get((sample_name, timepoint), roi_sets[sample_name])
+            regions = TiffRegions.open(os.path.join(inDir, file))
+            if regions is None:
+                with timer.stage("open", file, os.path.getsize(os.path.join(inDir, file))):
+                    img = IJ.openImage(os.path.join(inDir, file))
+            for roi, roiname in zip(rois, roinames):
+                with timer.stage("crop", file) as stage:
+                    if regions is not None:
+                        cropped = regions.read(roi.getBounds())
+                    else:
+                        img.setRoi(roi)
+                        cropped = img.crop()
+                    stage.nbytes = cropped.getSizeInBytes()
                 if time_series:
                     outname = roiname + "_T" + timepoint + "_C" + channel
                 else:
                     outname = roiname + "_C" + channel
-                savetif(cropped, os.path.join(outDir, outname))
-            img.close()
+                savetif(cropped, layout.path(entry, outname))
+            if regions is not None:
+                regions.close()
+            else:
+                img.close()
 
     # Save no of spheroids
-    win = wm.getWindow("Summary")
-    summary_rt = win.getTextPanel().getResultsTable()
-    summary_rt.save(os.path.join(outDir, "spheroid_count.csv"))
-
-    # Resort
-    files = [f for f in os.listdir(outDir) if os.path.isfile(os.path.join(outDir, f)) and f.endswith(".tif")]
-    for f in files:
-        if resort == "Sample":
-            sample_name = re.findall(sample_nme_pattern, f)[0]
-            resort_folder = os.path.join(outDir, sample_name)
-            if not os.path.exists(resort_folder):
-                os.makedirs(resort_folder)
-            os.rename(os.path.join(outDir, f), os.path.join(resort_folder, f))
-        elif resort == "Timepoint":
-            timepoint = re.findall(time_pattern, file)[0]
-            resort_folder = os.path.join(outDir, timepoint)
-            if not os.path.exists(resort_folder):
-                os.makedirs(resort_folder)
-            os.rename(os.path.join(outDir, f), os.path.join(resort_folder, f))
-        elif resort == "Channel":
-            channel = re.findall(channel_pattern, file)[0]
-            resort_folder = os.path.join(outDir, channel)
-            if not os.path.exists(resort_folder):
-                os.makedirs(resort_folder)
-            os.rename(os.path.join(outDir, f), os.path.join(resort_folder, f))
+    summary_rt = summaryTable(summary_rows)
+    shardSuffix = shardTag(shard)
+    summary_rt.save(os.path.join(outDir, "spheroid_count" + shardSuffix + ".csv"))
+
+    # All crops must be on disk before the stage times are reported
+    for path, error in writer.flush():
+        print("Could not write {}: {}".format(path, error))
+
+    timer.report(outDir, "StageTimes" + shardSuffix)
 
 # GUI
 def show_gui():
@@ -176,6 +759,7 @@ def show_gui():
 
     gd.addMessage("Are the images from a time series?")
     gd.addCheckbox("Time Series", True)
+    gd.addCheckbox("Track the spheroids (ROIs per timepoint instead of the last timepoint's)", False)
 
     gd.addMessage("Regex patterns for extract sample name, timepoints, and channels from the filename:")
     gd.addStringField("Sample name pattern:", "^(\w{3,4})_")
@@ -186,13 +770,16 @@ def show_gui():
     gd.addNumericField("Min Particle Size:", 2000, 0)
     gd.addMessage("Factor by which the major axis is being scaled.")
     gd.addNumericField("Scale Factor:", 1.5, 1)
+    gd.addCheckbox("Coarse-to-fine detection (faster; threshold and marked image from a binned copy)", False)
 
     gd.addMessage("Which channel contains the spheroids?")
     gd.addStringField("Channel ROI:", "C01")
 
     gd.addMessage("Do you want the cropped images to be sorted?")
-    gd.addChoice("Resort Output:", ["None", "Sample", "Timepoint (if time series)", "Channel"],
-                 "None")
+    gd.addChoice("Resort Output:", resortChoices, resortChoices[0])
+
+    gd.addMessage("How many images should be analysed at the same time?")
+    gd.addNumericField("Parallel Images:", 1, 0)
 
     # Show the dialog
     gd.showDialog()
@@ -206,21 +793,70 @@ def show_gui():
     outDir = gd.getNextString()
     fileExt = gd.getNextString()
     time_series = gd.getNextBoolean()
+    track = gd.getNextBoolean()
     sample_nme_pattern = gd.getNextString()
     time_pattern = gd.getNextString()
     channel_pattern = gd.getNextString()
     particle_size_min = int(gd.getNextNumber())
     scale_factor = gd.getNextNumber()
+    coarse = gd.getNextBoolean()
     channel_roi = gd.getNextString()
     resort = gd.getNextChoice()
+    parallelPref = max(1, int(gd.getNextNumber()))
 
     # Run the spheroid analysis with the obtained parameters
     run_spheroid_analysis(inDir, outDir, fileExt, sample_nme_pattern, time_pattern, channel_pattern,
-                          particle_size_min, scale_factor, channel_roi, resort, time_series)
+                          particle_size_min, scale_factor, channel_roi, resort, time_series, parallelPref=parallelPref,
+                          coarse=coarse, track=track)
 
-# Main function to execute GUI and processing
+# Command line, e.g. for ImageJ --headless
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="cropROI.py", description="Crop individual spheroids from images.")
+    parser.add_argument("--input", help="input directory")
+    parser.add_argument("--output", help="output directory")
+    parser.add_argument("--ext", default=".tif", help="file extension of the images")
+    parser.add_argument("--no-time-series", action="store_true", help="the images are not a time series")
+    parser.add_argument("--track", action="store_true",
+                        help="follow the spheroids from the latest timepoint through the earlier ones, with ROIs per "
+                             "timepoint, instead of using the latest timepoint's ROIs for all")
+    parser.add_argument("--sample-pattern", default="^(\w{3,4})_")
+    parser.add_argument("--time-pattern", default=r'-t(\d{4})')
+    parser.add_argument("--channel-pattern", default=r'-C(\d{2})')
+    parser.add_argument("--min-size", type=int, default=2000, help="minimum particle size of a spheroid")
+    parser.add_argument("--scale-factor", type=float, default=1.5, help="factor by which the major axis is scaled")
+    parser.add_argument("--roi-channel", default="C01", help="channel containing the spheroids")
+    parser.add_argument("--resort", choices=resortArgs, default=resortArgs[0])
+    parser.add_argument("--shard", type=parseShard, help="i/N: process only the i-th of N parts of the samples")
+    parser.add_argument("--parallel", type=int, default=1, help="images analysed at the same time")
+    parser.add_argument("--coarse", action="store_true",
+                        help="find the spheroids on a binned copy and refine them at full resolution; faster, but the "
+                             "threshold and the marked image come from the binned copy")
+    parser.add_argument("--verify-detection", action="store_true",
+                        help="with --coarse, also detect at full resolution and use its ROIs if they differ by more "
+                             "than the tolerance")
+    parser.add_argument("--self-test", action="store_true",
+                        help="check the spheroid measurements against ImageJ's on a synthetic image and exit")
+    args = parser.parse_args(argv)
+    if not args.self_test and (args.input is None or args.output is None):
+        parser.error("--input and --output are required")
+    return args
+
+# Main function to execute GUI or command line and processing
 def main():
-    show_gui()
+    if len(sys.argv) < 2:
+        show_gui()
+        return
+    args = parse_args(sys.argv[1:])
+    if args.self_test:
+        problems = self_test()
+        for problem in problems:
+            print(problem)
+        print("Self-test {}".format("failed" if problems else "passed"))
+        sys.exit(1 if problems else 0)
+    run_spheroid_analysis(args.input, args.output, args.ext, args.sample_pattern, args.time_pattern,
+                          args.channel_pattern, args.min_size, args.scale_factor, args.roi_channel,
+                          resortChoices[resortArgs.index(args.resort)], not args.no_time_series, args.shard,
+                          max(1, args.parallel), args.coarse, args.verify_detection, args.track)
 
 # Entry point
 if __name__ == "__main__":
@@ -4,52 +4,501 @@ from ij.io import FileSaver
 from loci.plugins import BF
 from ij.gui import WaitForUserDialog
 from loci.plugins.in import ImporterOptions
-from loci.formats import ImageReader
-from loci.formats import MetadataTools
+from loci.formats import ImageReader, ChannelSeparator
+from loci.plugins.util import ImageProcessorReader
+from loci.formats import FormatTools
 from ome.units import UNITS
-from ij.gui import GenericDialog
+from ij.gui import GenericDialog, Roi
+from ij.io import RoiDecoder
+from ij.plugin import RoiScaler
+from ij import CompositeImage
+from ij.process import ColorProcessor, ImageProcessor
 from ij.plugin.frame import RoiManager
+from java.lang import String, Throwable, Runtime
+from java.util.concurrent import Callable, Executors
+from java.util.zip import ZipInputStream
+from java.io import BufferedInputStream, ByteArrayOutputStream, FileInputStream, FileOutputStream
+from jarray import zeros
 import os
 import re
+import sys
+import argparse
 import time
 import logging
+import math
+import threading
+from toolbox_common import AsyncWriter, FileResult, MetadataCatalog, Options, addCatalogArguments, catalogFile, \
+    logDuration, parseShard, readMetadata, saveRois, selectShard, seriesTag, shardTag, stopPool, timedSave, timer
 
 outDirChoices = [
     "New Directory, no subfolders",
     "New Directory, keep input subfolders",
     "Within (subfolders of) input directory"]
-voxel_info = str()
-startTime = time.time()
-imageCount = 0
-
-gd = GenericDialog("Set HistoSplitter.py Options")
-gd.addStringField("File extension to be processed", ".tif")
-gd.addStringField(
-    "String to identify your input images", "Wholeslide_Default_Extended")
-gd.addRadioButtonGroup("Output", outDirChoices, 3, 1, outDirChoices[2])
-gd.addRadioButtonGroup("Do you want to continue?", ['yes', 'no'], 2, 1, 'no')
-gd.showDialog()
-if gd.wasCanceled():
-    exit()
-
-fileExt = gd.getNextString()
-fileID = gd.getNextString()
-outDirPref = gd.getNextRadioButton()
-contPref = gd.getNextRadioButton()
-
-if not fileExt.startswith('.'):
-    fileExt = '.' + fileExt
-
-inDir = IJ.getDirectory("Choose Directory Containing Input Files")
-if inDir is None:
-    exit('No input directory selected!')
-
-if outDirPref == outDirChoices[2]:
-    outDir = inDir
-else:
-    outDir = IJ.getDirectory("Choose Directory For Output")
-    if outDir is None:
-        exit('No output directory selected!')
+outDirArgs = ["flat", "tree", "input"]
+previewSize = 4096
+previewBandBytes = 64 * 1024 * 1024
+defaultPrefetchMemory = min(1024, Runtime.getRuntime().maxMemory() // (4 * 1024 * 1024))
+
+
+writer = None
+
+
+opts = None
+
+
+class SlideRegions(object):
+    """Reads regions and overviews of one series of a slide, without loading the whole slide at full resolution."""
+
+    def __init__(self, path, series, record):
+        self.base = ImageReader()
+        self.reader = ImageProcessorReader(ChannelSeparator(self.base))
+        self.reader.setFlattenedResolutions(False)
+        self.reader.setId(path)
+        self.reader.setSeries(series)
+        self.record = record
+        self.rgb = (self.base.isRGB() and self.base.getRGBChannelCount() == 3
+                    and FormatTools.getBytesPerPixel(self.base.getPixelType()) == 1)
+
+    def toImage(self, planes, title, scale=1):
+        if self.rgb:
+            ip = ColorProcessor(planes[0].getWidth(), planes[0].getHeight())
+            ip.setRGB(planes[0].getPixels(), planes[1].getPixels(), planes[2].getPixels())
+            imp = ImagePlus(title, ip)
+        else:
+            stack = ImageStack(planes[0].getWidth(), planes[0].getHeight())
+            for ip in planes:
+                stack.addSlice(ip)
+            imp = ImagePlus(title, stack)
+            imp.setDimensions(self.reader.getSizeC(), self.reader.getSizeZ(), self.reader.getSizeT())
+        cal = imp.getCalibration()
+        if self.record['physicalSizeX'] is not None:
+            cal.pixelWidth, cal.pixelHeight = self.record['physicalSizeX'] * scale, self.record['physicalSizeY'] * scale
+            cal.setUnit("micron")
+        return imp
+
+    def read(self, bounds, title):
+        """Returns the region bounds (clipped to the slide) as an image like the one Bio-Formats imports."""
+        x, y = max(0, bounds.x), max(0, bounds.y)
+        w = min(bounds.x + bounds.width, self.reader.getSizeX()) - x
+        h = min(bounds.y + bounds.height, self.reader.getSizeY()) - y
+        planes = [self.reader.openProcessors(index, x, y, w, h)[0] for index in range(self.reader.getImageCount())]
+        return self.toImage(planes, title)
+
+    def preview(self, title):
+        """Returns an overview of at most previewSize pixels per side, its scale to full resolution and whether
+        it had to be computed (rather than read from a pyramid level)."""
+        try:
+            for level in range(self.reader.getResolutionCount()):
+                self.reader.setResolution(level)
+                if max(self.reader.getSizeX(), self.reader.getSizeY()) <= previewSize:
+                    scale = float(self.record['sizeX']) / self.reader.getSizeX()
+                    planes = [self.reader.openProcessors(index)[0] for index in range(self.reader.getImageCount())]
+                    return self.toImage(planes, title, scale), scale, False
+        finally:
+            self.reader.setResolution(0)
+        return self.downsample(title), self.downsampleFactor(), True
+
+    def downsampleFactor(self):
+        return int(math.ceil(max(self.reader.getSizeX(), self.reader.getSizeY()) / float(previewSize)))
+
+    def downsample(self, title):
+        # full-resolution bands of at most previewBandBytes are read and shrunk one after the other
+        width, height, factor = self.reader.getSizeX(), self.reader.getSizeY(), self.downsampleFactor()
+        rowBytes = width * FormatTools.getBytesPerPixel(self.reader.getPixelType()) * self.reader.getImageCount()
+        bandHeight = max(1, previewBandBytes // rowBytes // factor) * factor
+        planes = None
+        for y in range(0, height - factor + 1, bandHeight):
+            h = min(bandHeight, height - y) // factor * factor
+            band = [self.reader.openProcessors(index, 0, y, width, h)[0]
+                    for index in range(self.reader.getImageCount())]
+            if planes is None:
+                planes = [ip.createProcessor(width // factor, height // factor) for ip in band]
+            for plane, ip in zip(planes, band):
+                ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+                plane.insert(ip.resize(width // factor, h // factor, True), 0, y // factor)
+        return self.toImage(planes, title, factor)
+
+    def close(self):
+        self.reader.close()
+
+
+def loadPreview(file, regions, name):
+    """Returns the annotation view of a slide and its scale to full resolution.
+
+    Pyramid files use their largest level that fits previewSize; other slides are shrunk once and the result
+    is cached in Previews/ of the output folder.
+    """
+    cacheFile = os.path.join(opts.outDir, "Previews", name + "_preview_x%i.tif" % regions.downsampleFactor())
+    if os.path.isfile(cacheFile) and os.path.getmtime(cacheFile) >= os.path.getmtime(file):
+        imp, scale = IJ.openImage(cacheFile), regions.downsampleFactor()
+    else:
+        imp, scale, computed = regions.preview(name)
+        if computed and scale > 1:
+            if not os.path.isdir(os.path.dirname(cacheFile)):
+                os.makedirs(os.path.dirname(cacheFile))
+            FileSaver(imp).saveAsTiff(cacheFile)
+    if imp.getNChannels() > 1 and not imp.isComposite():
+        imp = CompositeImage(imp, IJ.COMPOSITE)
+    return imp, scale
+
+
+def loadRois(path):
+    """Reads a ROI set saved by saveRois (or the RoiManager) and returns the ROIs and their names."""
+    rois, names = [], []
+    zis = ZipInputStream(BufferedInputStream(FileInputStream(path)))
+    buf = zeros(65536, 'b')
+    try:
+        entry = zis.getNextEntry()
+        while entry is not None:
+            if entry.getName().endswith(".roi"):
+                data = ByteArrayOutputStream()
+                n = zis.read(buf)
+                while n > 0:
+                    data.write(buf, 0, n)
+                    n = zis.read(buf)
+                roi = RoiDecoder.openFromByteArray(data.toByteArray())
+                if roi is not None:
+                    rois.append(roi)
+                    names.append(entry.getName()[:-len(".roi")])
+            entry = zis.getNextEntry()
+    finally:
+        zis.close()
+    return rois, names
+
+
+def cropBaseName(file, tag):
+    return os.path.basename(file).replace(opts.fileID, '').replace(opts.fileExt, '') + tag
+
+
+def roiZipPath(file, tag):
+    return file.replace(opts.fileExt, "") + tag + "ROIs.zip"
+
+
+def cropPath(out_name, file):
+    if opts.outDirPref == outDirChoices[1]:
+        return os.path.join(opts.outDir, os.path.relpath(os.path.dirname(file), opts.inDir), out_name)
+    return os.path.join(opts.outDir, out_name)
+
+
+def queueCrop(imp, path):
+    writer.submit(FileSaver(imp).saveAsTiff, path, imp)
+
+
+def writeCrop(imp, path):
+    if timedSave(FileSaver(imp).saveAsTiff, path) is False:
+        raise IOError("could not save " + path)
+
+
+def exportCrops(regions, file, base_name, rois, save=queueCrop):
+    """Reads the ROIs from the slide at full resolution and hands the crops to save(imp, path)."""
+    i = 0
+    for roi in rois:
+        i += 1
+        outname = base_name + "_ROI-" + str(i) + ".tiff"
+        with timer.stage("crop", file) as stage:
+            crop_imp = regions.read(roi.getBounds(), outname)
+            stage.nbytes = crop_imp.getSizeInBytes()
+        save(crop_imp, cropPath(outname, file))
+
+
+def SaveVoxel(outDir, voxel_info, name="PhysicalSize"):
+    """Writes the rows of voxel_info, keeping the rows of the other slides already in the file, e.g. those of an
+    earlier session or of the interactive run a replay is repeating. A slide's old row is replaced by its new one."""
+    path = os.path.join(outDir, name + ".txt")
+    rows = voxel_info.splitlines(True)
+    if os.path.isfile(path):
+        # the slide (with its series tag) is all but the last four columns
+        slides = set(row.rsplit(',', 4)[0] for row in rows)
+        with open(path, 'r') as previous:
+            kept = [row if row.endswith('\n') else row + '\n' for row in previous
+                    if row.strip() and row.rsplit(',', 4)[0] not in slides]
+        rows = kept + rows
+    with open(path, 'w') as output:
+        output.write(''.join(rows))
+
+
+class ProgressJournal(object):
+    """Append-only list of the finished slides (ProcessedFiles.txt), synced to disk after every entry.
+
+    A slide is added once the crops and ROI sets of all its series are on disk, so after a crash at most
+    the slides still being cropped are done again. Slides with a failed series are never added.
+    """
+
+    def __init__(self, path, done=(), append=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.failed = set()
+        self.stream = FileOutputStream(path, append)
+        if not append:
+            for file in done:
+                self.stream.write(String(file + '\n').getBytes("UTF-8"))
+            self.stream.getFD().sync()
+
+    def add(self, file):
+        with self.lock:
+            if file in self.failed:
+                return
+            self.stream.write(String(file + '\n').getBytes("UTF-8"))
+            self.stream.getFD().sync()
+
+    def fail(self, file):
+        with self.lock:
+            self.failed.add(file)
+
+    def close(self):
+        self.stream.close()
+
+
+def readJournal(path):
+    """Returns the slides listed in a progress journal, in the order they were finished."""
+    done, seen = [], set()
+    with open(path, 'r') as p:
+        for line in p:
+            # a partial last line left by a crash matches no slide and does no harm
+            if line.strip() and line.strip() not in seen:
+                done.append(line.strip())
+                seen.add(line.strip())
+    return done
+
+
+def waitForCrops(cropTasks, pending):
+    """Blocks until at most pending crop tasks are unfinished. The slides waiting to be cropped keep their readers
+    open, so they must not pile up when the annotation is faster than the cropping."""
+    waiting = [(file, future) for file, future in cropTasks if not future.isDone()]
+    for file, future in waiting[:max(0, len(waiting) - pending)]:
+        with timer.stage("crop backlog", file):
+            try:
+                future.get()
+            except (Exception, Throwable):
+                # reported by saveProgress
+                pass
+
+
+def saveProgress(outDir, journal, cropPool, cropTasks):
+    # wait for the crops still being cut, the finished slides are in the journal already
+    stopPool(cropPool)
+    for file, future in cropTasks:
+        try:
+            future.get()
+        except (Exception, Throwable) as e:
+            logging.error('Could not crop %s: %s', file, e)
+    journal.close()
+    timer.report(outDir)
+
+
+class PreparedSlide(object):
+    """One series of a slide, ready for annotation: its metadata, region reader and overview."""
+
+    def __init__(self, file, series, seriesCount):
+        self.file = file
+        self.tag = seriesTag(series, seriesCount)
+        self.lastSeries = series == seriesCount - 1
+        with timer.stage("metadata", file):
+            self.record = readMetadata(file, opts.catalog, series, False)
+        self.regions = SlideRegions(file, series, self.record)
+        try:
+            with timer.stage("preview", file):
+                self.imp, self.scale = loadPreview(file, self.regions,
+                                                   os.path.basename(file).replace(opts.fileExt, '') + self.tag)
+        except:
+            self.regions.close()
+            raise
+        self.bytes = self.imp.getSizeInBytes()
+
+    def close(self):
+        self.regions.close()
+
+
+class SlidePrefetcher(object):
+    """Prepares the slides on a background thread, in order and ahead of the one being annotated.
+
+    At most depth slides wait in take(), and a further one is only started while the waiting ones hold less
+    than memoryCap bytes (counting previewEstimate for the one being prepared). The first is always prepared.
+    A slide (or series) that can't be prepared is logged, failed in the journal and listed in failed, and the
+    next one is prepared instead.
+    """
+
+    previewEstimate = previewSize * previewSize * 4 + previewBandBytes
+
+    def __init__(self, files, depth, memoryCap, journal):
+        self.files = list(files)
+        self.depth = depth
+        self.memoryCap = memoryCap
+        self.journal = journal
+        self.failed = []
+        self.ready = []
+        self.held = 0
+        self.done = False
+        self.stopped = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.work, name="slide-prefetch")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def work(self):
+        try:
+            for file in self.files:
+                try:
+                    with timer.stage("metadata", file):
+                        seriesCount = readMetadata(file, opts.catalog, 0, False)['seriesCount']
+                except (Exception, Throwable) as e:
+                    self.skip(file, e)
+                    continue
+                for series in range(seriesCount):
+                    with self.condition:
+                        while not self.stopped and self.ready and (
+                                len(self.ready) >= self.depth or self.held + self.previewEstimate > self.memoryCap):
+                            self.condition.wait()
+                        if self.stopped:
+                            return
+                    try:
+                        slide = PreparedSlide(file, series, seriesCount)
+                    except (Exception, Throwable) as e:
+                        self.skip(file + seriesTag(series, seriesCount), e, file)
+                        continue
+                    with self.condition:
+                        self.ready.append(slide)
+                        self.held += slide.bytes
+                        self.condition.notifyAll()
+        except (Exception, Throwable) as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notifyAll()
+
+    def skip(self, name, error, file=None):
+        # the slide is never journaled, so a continued run tries it again
+        self.journal.fail(file or name)
+        self.failed.append((name, str(error)))
+        logging.error('Could not open %s: %s', name, error)
+
+    def take(self):
+        """Returns the next prepared slide, or None after the last one."""
+        with self.condition:
+            while not self.ready and not self.done:
+                self.condition.wait()
+            if self.ready:
+                slide = self.ready.pop(0)
+                self.held -= slide.bytes
+                self.condition.notifyAll()
+                return slide
+        if self.error is not None:
+            raise self.error
+        return None
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notifyAll()
+        self.thread.join()
+        for slide in self.ready:
+            slide.imp.close()
+            slide.close()
+        self.ready = []
+
+
+class CropTask(Callable):
+    """Cuts the ROIs of an annotated slide from the file at full resolution and saves them and the ROI set."""
+
+    def __init__(self, slide, base_name, rois, names, journal):
+        self.slide = slide
+        self.base_name = base_name
+        self.rois = rois
+        self.names = names
+        self.journal = journal
+
+    def call(self):
+        try:
+            # the ROI set first, so that the crops are newer than it and a replay finds them up to date
+            saveRois(self.rois, self.names, roiZipPath(self.slide.file, self.slide.tag))
+            # written here rather than queued, so that the slide is only journaled once its crops are on disk
+            exportCrops(self.slide.regions, self.slide.file, self.base_name, self.rois, writeCrop)
+            # the row goes with the crops, so that a journaled slide always has its size in PhysicalSize.txt
+            SaveVoxel(opts.outDir, voxelRow(self.slide.file, self.slide.tag, self.slide.record))
+        except:
+            self.journal.fail(self.slide.file)
+            raise
+        finally:
+            self.slide.close()
+        if self.slide.lastSeries:
+            self.journal.add(self.slide.file)
+
+
+def voxelRow(file, tag, record):
+    return ','.join([str(entry) for entry in (file + tag, record['physicalSizeX'], record['physicalSizeY'],
+                                              record['sizeX'], record['sizeY'])]) + '\n'
+
+
+class ReplayResult(FileResult):
+    """A FileResult that also counts the crops of the replayed slide."""
+
+    def __init__(self, path):
+        FileResult.__init__(self, path)
+        self.exported = 0
+        self.upToDate = 0
+
+
+class ReplayTask(Callable):
+    def __init__(self, file, number):
+        self.file = file
+        self.number = number
+
+    def call(self):
+        # a slide that can't be replayed is reported, the others go on
+        try:
+            return replaySlide(self.file, self.number)
+        except (Exception, Throwable) as e:
+            result = ReplayResult(self.file)
+            result.error = str(e)
+            return result
+
+
+def isUpToDate(out_files, sources):
+    newest = max(os.path.getmtime(source) for source in sources)
+    return all(os.path.isfile(out_file) and os.path.getmtime(out_file) >= newest for out_file in out_files)
+
+
+def replaySlide(file, number):
+    """Exports the crops of every series of a slide that has a saved ROI set, unless they are up to date."""
+    result = ReplayResult(file)
+    result.info('Starting image #%i (%s)', number, os.path.basename(file))
+    with timer.stage("metadata", file):
+        seriesCount = readMetadata(file, opts.catalog, 0, False)['seriesCount']
+    for series in range(seriesCount):
+        tag = seriesTag(series, seriesCount)
+        roiFile = roiZipPath(file, tag)
+        if not os.path.isfile(roiFile):
+            result.info('    No ROIs saved (%s)', os.path.basename(roiFile))
+            continue
+        with timer.stage("metadata", file):
+            record = readMetadata(file, opts.catalog, series, False)
+        result.voxelRows.append(voxelRow(file, tag, record))
+        rois, names = loadRois(roiFile)
+        base_name = cropBaseName(file, tag)
+        out_files = [cropPath(base_name + "_ROI-" + str(i + 1) + ".tiff", file) for i in range(len(rois))]
+        if isUpToDate(out_files, [file, roiFile]):
+            result.info('    %i crops up to date', len(out_files))
+            result.upToDate += len(out_files)
+            continue
+        regions = SlideRegions(file, series, record)
+        try:
+            exportCrops(regions, file, base_name, rois)
+        finally:
+            regions.close()
+        result.info('    %i crops exported', len(out_files))
+        result.exported += len(out_files)
+    return result
+
+
+def setup(inDir, outDir, fileExt, fileID, outDirPref, logName, catalogPath=catalogFile):
+    """Sets opts, creates the output folders and the log, and returns the slides in input order."""
+    global opts
+    if not fileExt.startswith('.'):
+        fileExt = '.' + fileExt
+    inDir = os.path.join(inDir, '')
+    outDir = inDir if outDirPref == outDirChoices[2] else os.path.join(outDir, '')
     if outDirPref == outDirChoices[1]:
         for dirpath, dirnames, filenames in os.walk(inDir):
             if any([fileExt in f for f in filenames]):
@@ -57,148 +506,296 @@ else:
                 if not os.path.isdir(structure):
                     os.makedirs(structure)
 
-logging.basicConfig(
-    filename=os.path.join(outDir, "Log.txt"), filemode='w',
-    level=logging.DEBUG,
-    format='%(asctime)s | %(levelname)s >> %(message)s',
-    datefmt='%Y/%m/%d %H:%M:%S')
-
-logging.info('Start HistoSplitter script')
-logging.info('Preferences')
-logging.info('    Input dir: %s', inDir)
-logging.info('    Output dir: %s', outDir)
-logging.info('    Output format: %s', outDirPref)
-logging.info('    Continue: %s', contPref)
-
-
-def saveROIImage(img, out_name):
-    if outDirPref == outDirChoices[0] or outDirPref == outDirChoices[2]:
-        out_file = os.path.join(outDir, out_name)
-        FileSaver(img).saveAsTiff(out_file)
-    elif outDirPref == outDirChoices[1]:
-        outSubDir = root.replace(inDir, outDir)
-        out_file = os.path.join(outSubDir, out_name)
-        FileSaver(img).saveAsTiff(out_file)
-
-
-def SaveVoxel(outDir, voxel_info):
-    with open(os.path.join(outDir, "PhysicalSize.txt"), 'w') as output:
-        output.write(voxel_info)
-
-
-def saveProgress(outDir, list):
-    with open(os.path.join(outDir, "ProcessedFiles.txt"), 'w') as f:
-        f.write('\n'.join(list))
-
-
-fileList = []
-for root, dirs, files in os.walk(inDir):
-    for file in files:
-        find = re.findall(fileID, file)
-        if find and file.endswith(fileExt):
-            fileList.append(os.path.join(root, file))
-
-if contPref == 'yes':
-    processedFile = IJ.getFilePath('Please select your processed file list.')
-    with open(processedFile, 'r') as p:
-        processedList = [line.strip() for line in p]
-    fileList = (set(fileList) | set(processedList)) - set(processedList)
-else:
-    processedList = []
+    logging.basicConfig(
+        filename=os.path.join(outDir, logName + ".txt"), filemode='w',
+        level=logging.DEBUG,
+        format='%(asctime)s | %(levelname)s >> %(message)s',
+        datefmt='%Y/%m/%d %H:%M:%S')
 
+    opts = Options(inDir=inDir, outDir=outDir, fileExt=fileExt, fileID=fileID, outDirPref=outDirPref,
+                   catalog=MetadataCatalog(catalogPath))
 
-for file in fileList:
-    options = ImporterOptions()
-    options.setId(file)
-    imps = BF.openImagePlus(options)
-    for imp in imps:
-        imageCount += 1
-        reader = ImageReader()
-        omeMeta = MetadataTools.createOMEXMLMetadata()
-        reader.setMetadataStore(omeMeta)
-        reader.setId(file)
-
-        base_name = os.path.basename(file)
-        base_name = base_name.replace(fileID, '')
-        base_name = base_name.replace(fileExt, '')
-
-        physSizeX = omeMeta.getPixelsPhysicalSizeX(0)
-        physSizeY = omeMeta.getPixelsPhysicalSizeY(0)
-        stackSizeX = omeMeta.getPixelsSizeX(0).getValue()
-        stackSizeY = omeMeta.getPixelsSizeY(0).getValue()
-
-        voxel_info += ','.join(
-                [str(entry) for entry in (file,
-                physSizeX.value(), physSizeY.value(),
-                stackSizeX, stackSizeY)]
-            ) + '\n'
-
-        rm = RoiManager.getInstance()
-        if not rm:
-            rm = RoiManager()
-        rm.runCommand("reset")
-        imp.setRoi(1760, 1200, 1632, 1344)
-        imp.flattenStack()
-        imp.show()
-        wait = WaitForUserDialog("Set and add ROIs, then click OK.")
-        wait.show()
-        if wait.escPressed():
-            logging.info('Esc was pressed')
-            SaveVoxel(outDir, voxel_info)
-            saveProgress(outDir, processedList)
-            imp.close()
-            exit()
+    fileList = []
+    for root, dirs, files in os.walk(inDir):
+        dirs.sort()
+        for file in sorted(files):
+            find = re.findall(fileID, file)
+            if find and file.endswith(fileExt):
+                fileList.append(os.path.join(root, file))
+    return fileList
+
+
+def run_histo_splitter(inDir, outDir, fileExt=".tif", fileID="Wholeslide_Default_Extended",
+                       outDirPref=outDirChoices[2], continuePref=False, processedFile=None, prefetchPref=1,
+                       prefetchMemoryPref=defaultPrefetchMemory, catalogPath=catalogFile):
+    """Shows every slide for annotation and exports the crops of the ROIs set on it.
 
-        rm = RoiManager.getInstance()
-        rois = rm.getRoisAsArray()
-        if not rois:
-            wait = WaitForUserDialog("You need to set ROIs, then click OK.")
-            wait.show()
+    With continuePref, the slides listed in processedFile (by default the journal of the output folder) are
+    skipped and the journal is continued.
+    """
+    startTime = time.time()
+    timer.reset()
+    fileList = setup(inDir, outDir, fileExt, fileID, outDirPref, "Log", catalogPath)
+
+    logging.info('Start HistoSplitter script')
+    logging.info('Preferences')
+    logging.info('    Input dir: %s', opts.inDir)
+    logging.info('    Output dir: %s', opts.outDir)
+    logging.info('    Output format: %s', outDirPref)
+    journalFile = os.path.join(opts.outDir, "ProcessedFiles.txt")
+    if continuePref and processedFile is None and os.path.isfile(journalFile):
+        processedFile = journalFile
+    logging.info('    Continue: %s', processedFile if continuePref and processedFile else 'no')
+    logging.info('    Slides prepared ahead: %i (up to %i MB)', prefetchPref, prefetchMemoryPref)
+    logging.info('    Metadata catalog: %s', opts.catalog.status)
+
+    processedList = []
+    if continuePref:
+        if processedFile is None:
+            logging.info('No progress journal found, starting with the first slide')
+        else:
+            processedList = readJournal(processedFile)
+            done = set(processedList)
+            fileList = [file for file in fileList if file not in done]
+            logging.info('%i slides done already, %i to go', len(processedList), len(fileList))
+    sameJournal = processedFile is not None and os.path.abspath(processedFile) == os.path.abspath(journalFile)
+    journal = ProgressJournal(journalFile, processedList, append=continuePref and sameJournal)
+
+    # the next slides are prepared while the current one is annotated, the crops are cut and saved in the background
+    prefetcher = SlidePrefetcher(fileList, prefetchPref, prefetchMemoryPref * 1024 * 1024, journal)
+    cropPool = Executors.newFixedThreadPool(1)
+    cropTasks = []
+    imageCount = 0
+    stopReason = None
+    slide = None
+    completed = False
+    try:
+        slide = prefetcher.take()
+        while slide is not None:
+            file = slide.file
+            imageCount += 1
+
+            imp, scale = slide.imp, slide.scale
+            rm = RoiManager.getInstance()
+            if not rm:
+                rm = RoiManager()
+            rm.runCommand("reset")
+            imp.setRoi(Roi(1760 / scale, 1200 / scale, 1632 / scale, 1344 / scale))
+            imp.show()
+            with timer.stage("annotation", file):
+                wait = WaitForUserDialog("Set and add ROIs, then click OK.")
+                wait.show()
             if wait.escPressed():
-                logging.info('Esc was pressed')
-                SaveVoxel(outDir, voxel_info)
-                saveProgress(outDir, processedList)
-                imp.close()
-                exit()
+                stopReason = 'Esc was pressed'
+                break
+
+            rm = RoiManager.getInstance()
+            rois = rm.getRoisAsArray()
             if not rois:
-                logging.info('No ROIs set')
-                SaveVoxel(outDir, voxel_info)
-                saveProgress(outDir, processedList)
-                imp.close()
-                exit()
-
-        i = 0
-        for roi in rois:
-            i += 1
-            imp.setRoi(roi)
-            crop_imp = imp.crop()
-            outname = base_name + "_ROI-" + str(i) + ".tiff"
-            saveROIImage(crop_imp, outname)
-
-        out_roi_zip_file = os.path.join(root, file.replace(fileExt, "") + "ROIs.zip")
-        rm.runCommand("Save", out_roi_zip_file)
-        processedList.append(file)
-        imp.close()
-
-SaveVoxel(outDir, voxel_info)
-saveProgress(outDir, processedList)
-
-duration = time.time() - startTime
-logging.info('Processing finished')
-
-duration_h, rest = divmod(duration, 3600)
-duration_min, rest = divmod(rest, 60)
-duration_s = int(round(rest))
-if duration_h > 0:
-    logging.info(
-        '%i files procced in %i h, %i min and %i s',
-        imageCount, duration_h, duration_min, duration_s)
-elif duration_min > 0:
-    logging.info(
-        '%i files procced in %i min and %i s',
-        imageCount, duration_min, duration_s)
-else:
-    logging.info('%i files procced in %i s', imageCount, duration_s)
-
-IJ.log("\\Clear")
-IJ.log("Finished")
+                wait = WaitForUserDialog("You need to set ROIs, then click OK.")
+                wait.show()
+                if wait.escPressed():
+                    stopReason = 'Esc was pressed'
+                    break
+                rois = rm.getRoisAsArray()
+                if not rois:
+                    stopReason = 'No ROIs set'
+                    break
+
+            # the ROIs are drawn on the overview, the crops and the saved ROIs are at full resolution
+            names = [rm.getName(k) for k in range(len(rois))]
+            if scale != 1:
+                rois = [RoiScaler.scale(roi, scale, scale, False) for roi in rois]
+            task = CropTask(slide, cropBaseName(file, slide.tag), rois, names, journal)
+            imp.close()
+            # the crop task only needs the reader, not the overview
+            slide.imp = None
+            waitForCrops(cropTasks, prefetchPref)
+            cropTasks.append((file, cropPool.submit(task)))
+            slide = None
+            slide = prefetcher.take()
+        completed = stopReason is None
+    finally:
+        # whatever ended the session, the crops already queued are finished and the journal is closed
+        if not completed:
+            if stopReason is not None:
+                logging.info(stopReason)
+            prefetcher.stop()
+            if slide is not None:
+                if slide.imp is not None:
+                    slide.imp.close()
+                slide.close()
+        saveProgress(opts.outDir, journal, cropPool, cropTasks)
+        opts.catalog.close()
+    if prefetcher.failed:
+        logging.error('%i slides could not be opened:', len(prefetcher.failed))
+        for name, error in prefetcher.failed:
+            logging.error('    %s', name)
+    if stopReason is not None:
+        return
+
+    logDuration(startTime, imageCount)
+
+    IJ.log("\\Clear")
+    for name, error in prefetcher.failed:
+        IJ.log("Could not open %s: %s" % (name, error))
+    IJ.log("Finished")
+
+
+def run_replay(inDir, outDir, fileExt=".tif", fileID="Wholeslide_Default_Extended", outDirPref=outDirChoices[2],
+               parallelPref=1, shard=None, writerThreads=1, catalogPath=catalogFile):
+    """Exports the crops of all slides again from their saved ROI sets, without any dialog."""
+    global writer
+    startTime = time.time()
+    timer.reset()
+    # array jobs share the output dir, so every shard keeps its own log and summary files
+    shardSuffix = shardTag(shard)
+    fileList = selectShard(setup(inDir, outDir, fileExt, fileID, outDirPref, "Log" + shardSuffix, catalogPath),
+                           shard)
+
+    logging.info('Start HistoSplitter script (ROI replay)')
+    logging.info('Preferences')
+    logging.info('    Input dir: %s', opts.inDir)
+    logging.info('    Output dir: %s', opts.outDir)
+    logging.info('    Output format: %s', outDirPref)
+    logging.info('    Slides processed in parallel: %i', parallelPref)
+    logging.info('    Writer threads: %i', writerThreads)
+    if shard is not None:
+        logging.info('    Shard: %i/%i', shard[0], shard[1])
+    logging.info('    Metadata catalog: %s', opts.catalog.status)
+
+    voxel_info = str()
+    exported = 0
+    upToDate = 0
+    failedFiles = []
+    writer = AsyncWriter(writerThreads, 2 * (parallelPref + writerThreads))
+    pool = Executors.newFixedThreadPool(parallelPref)
+    completed = False
+    try:
+        futures = [pool.submit(ReplayTask(file, number)) for number, file in enumerate(fileList)]
+        for future in futures:
+            result = future.get()
+            for msg, args in result.logLines:
+                logging.info(msg, *args)
+            voxel_info += ''.join(result.voxelRows)
+            exported += result.exported
+            upToDate += result.upToDate
+            if result.error is not None:
+                logging.error('Could not replay %s: %s', result.path, result.error)
+                failedFiles.append((result.path, result.error))
+        completed = True
+    finally:
+        # after an error, the queued slides are dropped before the writer is flushed
+        stopPool(pool, not completed)
+        for path, error in writer.flush():
+            logging.error('Could not write %s: %s', path, error)
+        opts.catalog.close()
+        # the sizes and times of the slides done so far are kept, whatever stopped the replay
+        SaveVoxel(opts.outDir, voxel_info, "PhysicalSize" + shardSuffix)
+        timer.report(opts.outDir, "StageTimes" + shardSuffix)
+
+    logging.info('%i crops exported, %i crops up to date', exported, upToDate)
+    logDuration(startTime, len(fileList) - len(failedFiles))
+    if failedFiles:
+        logging.error('%i slides could not be replayed:', len(failedFiles))
+        for path, error in failedFiles:
+            logging.error('    %s', path)
+
+    IJ.log("\\Clear")
+    for path, error in failedFiles:
+        IJ.log("Could not replay %s: %s" % (path, error))
+    IJ.log("Finished")
+
+
+def show_gui():
+    gd = GenericDialog("Set HistoSplitter.py Options")
+    gd.addStringField("File extension to be processed", ".tif")
+    gd.addStringField(
+        "String to identify your input images", "Wholeslide_Default_Extended")
+    gd.addRadioButtonGroup("Output", outDirChoices, 3, 1, outDirChoices[2])
+    gd.addRadioButtonGroup("Do you want to continue?", ['yes', 'no'], 2, 1, 'no')
+    gd.addNumericField("Slides prepared ahead", 1, 0)
+    gd.addNumericField("Memory for prepared slides (MB)", defaultPrefetchMemory, 0)
+    gd.addCheckbox("Re-export crops from the saved ROIs (no annotation)", False)
+    gd.addNumericField("Slides processed in parallel (re-export)", 1, 0)
+    gd.showDialog()
+    if gd.wasCanceled():
+        return
+
+    fileExt = gd.getNextString()
+    fileID = gd.getNextString()
+    outDirPref = gd.getNextRadioButton()
+    contPref = gd.getNextRadioButton()
+    prefetchPref = max(1, int(gd.getNextNumber()))
+    prefetchMemoryPref = max(0, int(gd.getNextNumber()))
+    replayPref = gd.getNextBoolean()
+    parallelPref = max(1, int(gd.getNextNumber()))
+
+    inDir = IJ.getDirectory("Choose Directory Containing Input Files")
+    if inDir is None:
+        IJ.log('No input directory selected!')
+        return
+
+    outDir = inDir
+    if outDirPref != outDirChoices[2]:
+        outDir = IJ.getDirectory("Choose Directory For Output")
+        if outDir is None:
+            IJ.log('No output directory selected!')
+            return
+
+    if replayPref:
+        run_replay(inDir, outDir, fileExt, fileID, outDirPref, parallelPref)
+        return
+
+    processedFile = None
+    journalFile = os.path.join(outDir, "ProcessedFiles.txt")
+    if contPref == 'yes' and not os.path.isfile(journalFile):
+        processedFile = IJ.getFilePath('Please select your processed file list.')
+    run_histo_splitter(inDir, outDir, fileExt, fileID, outDirPref, contPref == 'yes', processedFile, prefetchPref,
+                       prefetchMemoryPref)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="histo_splitter.py",
+                                     description="Crop ROIs from whole-slide images, or re-export them from saved ROIs.")
+    parser.add_argument("--input", required=True, help="directory containing the slides")
+    parser.add_argument("--output", help="output directory (not needed with --layout input)")
+    parser.add_argument("--ext", default=".tif", help="file extension to be processed")
+    parser.add_argument("--id", default="Wholeslide_Default_Extended", help="string to identify the input images")
+    parser.add_argument("--layout", choices=outDirArgs, default=outDirArgs[2],
+                        help="flat: new folder, tree: new folder with the input subfolders, input: next to the inputs")
+    parser.add_argument("--replay", action="store_true",
+                        help="re-export the crops from the saved ROI sets, without any dialog (works headless)")
+    parser.add_argument("--parallel", type=int, default=1, help="slides processed in parallel with --replay")
+    parser.add_argument("--writers", type=int, default=1, help="threads writing the crops with --replay")
+    parser.add_argument("--shard", type=parseShard, help="i/N: process only the i-th of N parts of the slides")
+    parser.add_argument("--continue", dest="continue_", action="store_true",
+                        help="skip the slides in ProcessedFiles.txt of the output folder and continue it")
+    parser.add_argument("--continue-from", help="ProcessedFiles.txt of an earlier annotation run elsewhere")
+    parser.add_argument("--prefetch", type=int, default=1, help="slides prepared ahead while annotating")
+    parser.add_argument("--prefetch-memory", type=int, default=defaultPrefetchMemory,
+                        help="memory for prepared slides in MB")
+    addCatalogArguments(parser)
+    args = parser.parse_args(argv)
+    if args.output is None and args.layout != outDirArgs[2]:
+        parser.error("--output is needed unless --layout is input")
+    return args
+
+
+def main():
+    if len(sys.argv) < 2:
+        show_gui()
+        return
+    args = parse_args(sys.argv[1:])
+    outDirPref = outDirChoices[outDirArgs.index(args.layout)]
+    if args.replay:
+        run_replay(args.input, args.output, args.ext, args.id, outDirPref, max(1, args.parallel), args.shard,
+                   max(1, args.writers), args.catalog)
+    else:
+        run_histo_splitter(args.input, args.output, args.ext, args.id, outDirPref,
+                           args.continue_ or args.continue_from is not None, args.continue_from,
+                           max(1, args.prefetch), max(0, args.prefetch_memory), args.catalog)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,115 +2,319 @@ import os
 import re
 import time
 import logging
+import sys
+import argparse
 from ij import IJ, ImagePlus, ImageStack, WindowManager
 from ij.io import FileSaver
 from ij.plugin import ZProjector
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions
-from loci.formats import ImageReader, MetadataTools
+from loci.formats import ImageReader, MetadataTools, FormatTools, ChannelSeparator
+from loci.formats.out import TiffWriter
+from ome.units import UNITS
+from ome.units.quantity import Length
 from ij.gui import GenericDialog
+from java.util.concurrent import Callable, Executors
+from java.lang import Throwable
+from toolbox_common import AsyncWriter, FileResult, MetadataCatalog, addCatalogArguments, catalogFile, catalogRecord, \
+    fileResults, logDuration, makeDir, parseShard, readMetadata, selectShard, seriesTag, shardTag, stopPool, timer
 
-startTime = time.time()
-imageCount = 0
-voxel_info = str()
 channelSubfolderChoices = ["yes", "no"]
 
-gd = GenericDialog("Set split_channels.py Options")
-gd.addStringField("File extension to be processed", ".nd2")
-gd.addRadioButtonGroup("Save channels in different subfolders", channelSubfolderChoices, 1, 1,
-                       channelSubfolderChoices[0])
-gd.addCheckbox("Voxel size", True)
-gd.showDialog()
-if gd.wasCanceled():
-    exit()
 
-fileExt = gd.getNextString()
-channelSubfolderPref = gd.getNextRadioButton()
-voxelPref = gd.getNextBoolean()
+writer = None
 
-inDir = IJ.getDirectory("Choose Directory Containing Input Files (" + str(fileExt) + ')')
-outDir = IJ.getDirectory("Choose Directory For Output")
 
-logging.basicConfig(filename=os.path.join(outDir, "Log.txt"), filemode='w', level=logging.DEBUG,
-                    format='%(asctime)s | %(levelname)s >> %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
+def saveImage(img, out_file):
+    writer.submit(FileSaver(img).saveAsTiff, out_file, img)
 
-logging.info('Start split_channels script')
-logging.info('Preferences')
-logging.info('    Input dir: %s', inDir)
-logging.info('    Output dir: %s', outDir)
-logging.info('    processed files format: %s', fileExt)
-logging.info('    Save channels in different subfolders: %s', channelSubfolderPref)
 
+class FileTask(Callable):
+    """Processes one series of a file. The task of the first series finds the series count and, given the pool,
+    submits the other series to it."""
 
-def saveImage(img, out_file):
-    FileSaver(img).saveAsTiff(out_file)
+    def __init__(self, root, file, number, series, outDir, fileExt, channelSubfolderPref, catalog, streamPref,
+                 autoscalePref, pool=None):
+        self.args = (root, file, number, series, outDir, fileExt, channelSubfolderPref, catalog, streamPref,
+                     autoscalePref)
+        self.pool = pool
+
+    def call(self):
+        result = FileResult(os.path.join(self.args[0], self.args[1]))
+        # a file that can't be processed is reported, the others go on
+        try:
+            processFile(*(self.args + (result, self.pool)))
+        except (Exception, Throwable) as e:
+            result.error = str(e)
+        return result
+
+
+def channelName(record, channel_id):
+    names = record['channelNames']
+    if channel_id < len(names) and names[channel_id] is not None:
+        return names[channel_id]
+    return "C" + str(channel_id)
+
+
+def channelOutput(result, record, channel_name, out_name, outDir, channelSubfolderPref):
+    """Logs the sizes of one output channel, adds its VoxelSize.txt row and returns its output path."""
+    out_name = out_name.replace(" ", "")
+    physSizeX, physSizeY, physSizeZ = record['physicalSizeX'], record['physicalSizeY'], record['physicalSizeZ']
+    stackSizeX, stackSizeY, stackSizeZ = record['sizeX'], record['sizeY'], record['sizeZ']
+    result.info('    Saving under: %s', out_name)
+    result.info('        Size in micrometer: %.4f, %.4f, %.4f', physSizeX, physSizeY, physSizeZ)
+    result.info('        Size in pixel: %i, %i, %i', stackSizeX, stackSizeY, stackSizeZ)
+    result.voxelRows.append(','.join([str(entry) for entry in (out_name, physSizeX, physSizeY, physSizeZ,
+                                                               stackSizeX, stackSizeY, stackSizeZ)]) + '\n')
+    if channelSubfolderPref == "yes":
+        makeDir(os.path.join(outDir, channel_name))
+        return os.path.join(outDir, channel_name, out_name + ".tiff")
+    return os.path.join(outDir, out_name + ".tiff")
+
+
+def writeChannel(reader, channel_id, record, out_file):
+    """Copies the planes of one channel into a TIFF, one plane at a time and in the reader's pixel type."""
+    meta = MetadataTools.createOMEXMLMetadata()
+    MetadataTools.populateMetadata(meta, 0, os.path.basename(out_file), reader.isLittleEndian(), "XYZCT",
+                                   FormatTools.getPixelTypeString(reader.getPixelType()), reader.getSizeX(),
+                                   reader.getSizeY(), reader.getSizeZ(), 1, reader.getSizeT(), 1)
+    for setSize, size in ((meta.setPixelsPhysicalSizeX, record['physicalSizeX']),
+                          (meta.setPixelsPhysicalSizeY, record['physicalSizeY']),
+                          (meta.setPixelsPhysicalSizeZ, record['physicalSizeZ'])):
+        if size is not None:
+            setSize(Length(size, UNITS.MICROMETER), 0)
+    planeBytes = reader.getSizeX() * reader.getSizeY() * FormatTools.getBytesPerPixel(reader.getPixelType())
+    if os.path.exists(out_file):
+        os.remove(out_file)
+    tiffWriter = TiffWriter()
+    tiffWriter.setMetadataRetrieve(meta)
+    tiffWriter.setBigTiff(planeBytes * reader.getSizeZ() * reader.getSizeT() > 2 ** 32 - 2 ** 26)
+    tiffWriter.setId(out_file)
+    try:
+        plane = 0
+        for t in range(reader.getSizeT()):
+            for z in range(reader.getSizeZ()):
+                tiffWriter.saveBytes(plane, reader.openBytes(reader.getIndex(z, channel_id, t)))
+                plane += 1
+    finally:
+        tiffWriter.close()
+    return planeBytes * plane
 
 
-for root, dirs, files in os.walk(inDir):
-    for file in files:
-        if file.endswith(fileExt):
-            logging.info('Starting image #%i (%s)', imageCount, str(file))
-            options = ImporterOptions()
-            options.setAutoscale(True)
-            options.setId(os.path.join(root, file))
-            options.setSplitChannels(True)
+def openSeries(path, series, catalog):
+    """Returns a reader opened at one series of path, and the catalog record of the series."""
+    reader = ChannelSeparator(ImageReader())
+    omeMeta = MetadataTools.createOMEXMLMetadata()
+    reader.setMetadataStore(omeMeta)
+    try:
+        reader.setId(path)
+        reader.setSeries(series)
+        record = catalog.lookup(path, series)
+        if record is None:
+            record = catalogRecord(reader, omeMeta, series)
+            catalog.store(path, record, series)
+    except (Exception, Throwable):
+        reader.close()
+        raise
+    return reader, record
+
+
+def streamChannels(reader, record, base_name, result, outDir, channelSubfolderPref):
+    """Writes one TIFF per channel straight from the reader, without decoding the whole file into images."""
+    for channel_id in range(reader.getSizeC()):
+        channel_name = channelName(record, channel_id)
+        out_file = channelOutput(result, record, channel_name, base_name + "_" + str(channel_name), outDir,
+                                 channelSubfolderPref)
+        with timer.stage("stream", out_file) as stage:
+            stage.nbytes = writeChannel(reader, channel_id, record, out_file)
+
+
+def processFile(root, file, number, series, outDir, fileExt, channelSubfolderPref, catalog, streamPref, autoscalePref,
+                result, pool=None):
+    path = os.path.join(root, file)
+    reader = None
+    with timer.stage("metadata", path):
+        if streamPref and not autoscalePref:
+            reader, record = openSeries(path, series, catalog)
+        else:
+            record = readMetadata(path, catalog, series)
+    try:
+        seriesCount = record['seriesCount']
+        # the series are only known once the file is parsed, in the worker; each further series is a task of its own
+        if series == 0 and pool is not None:
+            result.seriesFutures = [pool.submit(FileTask(root, file, number, s, outDir, fileExt, channelSubfolderPref,
+                                                         catalog, streamPref, autoscalePref))
+                                    for s in range(1, seriesCount)]
+        if seriesCount == 1:
+            result.info('Starting image #%i (%s)', number, str(file))
+        else:
+            result.info('Starting image #%i (%s, series %i of %i)', number, str(file), series + 1, seriesCount)
+        base_name = file.split(fileExt)[0] + seriesTag(series, seriesCount)
+        if reader is not None:
+            streamChannels(reader, record, base_name, result, outDir, channelSubfolderPref)
+            return result
+        options = ImporterOptions()
+        options.setAutoscale(autoscalePref)
+        options.setId(path)
+        options.clearSeries()
+        options.setSeriesOn(series, True)
+        options.setSplitChannels(True)
+        with timer.stage("import", path, os.path.getsize(path)):
             imps = BF.openImagePlus(options)
-            for imp in imps:
-                reader = ImageReader()
-                omeMeta = MetadataTools.createOMEXMLMetadata()
-                reader.setMetadataStore(omeMeta)
-                reader.setId(os.path.join(root, file))
-
-                filename = str(imp)
-                channel_id = int(re.findall("C=(\d)", filename)[0])
-                channel_name = omeMeta.getChannelName(0, channel_id)
-                out_name = filename.split('"')[1]
-                out_name = out_name.split(fileExt)[0] + "_" + str(channel_name)
-                out_name = out_name.replace(" ", "")
-
-                physSizeX = omeMeta.getPixelsPhysicalSizeX(0)
-                physSizeY = omeMeta.getPixelsPhysicalSizeY(0)
-                physSizeZ = omeMeta.getPixelsPhysicalSizeZ(0)
-                stackSizeX = omeMeta.getPixelsSizeX(0).getValue()
-                stackSizeY = omeMeta.getPixelsSizeY(0).getValue()
-                stackSizeZ = omeMeta.getPixelsSizeZ(0).getValue()
-                logging.info('    Saving under: %s', out_name)
-                logging.info('        Size in micrometer: %.4f, %.4f, %.4f', physSizeX.value(), physSizeY.value(), physSizeZ.value())
-                logging.info('        Size in pixel: %i, %i, %i', stackSizeX, stackSizeY, stackSizeZ)
-                voxel_info += ','.join([str(entry) for entry in (out_name, physSizeX.value(), physSizeY.value(), physSizeZ.value(),
-	                                             stackSizeX, stackSizeY, stackSizeZ)]) + '\n'
-            if channelSubfolderPref == "no":
-                out_file = os.path.join(outDir, out_name + ".tiff")
-                saveImage(imp, out_file)
-            elif channelSubfolderPref == "yes":
-                out_file = os.path.join(outDir, channel_name, out_name + ".tiff")
-                if not os.path.isdir(os.path.join(outDir, channel_name)):
-                    os.mkdir(os.path.join(outDir, channel_name))
-                saveImage(imp, out_file)
-            imageCount += 1
-
-with open(os.path.join(outDir, "VoxelSize.txt"), 'w') as output:
-    output.write(voxel_info)
-
-duration = time.time() - startTime
-logging.info('Processing finished')
-
-if voxelPref:
-	with open(os.path.join(outDir, "VoxelSize.txt"), 'w') as output:
-	    output.write(voxel_info)
-
-duration = time.time()- startTime
-logging.info('Processing finished')
-
-duration_h, rest = divmod(duration, 3600)
-duration_min, rest = divmod(rest, 60)
-duration_s = int(round(rest))
-if duration_h > 0:
-    logging.info('%i files procced in %i h, %i min and %i s', imageCount, duration_h, duration_min, duration_s)
-elif duration_min > 0:
-    logging.info('%i files procced in %i min and %i s', imageCount, duration_min, duration_s)
-else:
-    logging.info('%i files procced in %i s', imageCount, duration_s)
-
-IJ.log("\\Clear")
-IJ.log("Finished")
+        for imp in imps:
+            channel_id = int(re.findall("C=(\d)", str(imp))[0])
+            channel_name = channelName(record, channel_id)
+            out_name = base_name + "_" + str(channel_name)
+            saveImage(imp, channelOutput(result, record, channel_name, out_name, outDir, channelSubfolderPref))
+        return result
+    finally:
+        if reader is not None:
+            reader.close()
+
+
+def run_split_channels(inDir, outDir, fileExt=".nd2", channelSubfolderPref=channelSubfolderChoices[0], voxelPref=True,
+                       parallelPref=1, shard=None, writerThreads=1, streamPref=False, autoscalePref=False,
+                       catalogPath=catalogFile):
+    global writer
+    startTime = time.time()
+    timer.reset()
+    if not fileExt.startswith('.'):
+        fileExt = '.' + fileExt
+    voxel_info = str()
+    # array jobs share the output dir, so every shard keeps its own log and voxel sizes
+    shardSuffix = shardTag(shard)
+
+    logging.basicConfig(filename=os.path.join(outDir, "Log" + shardSuffix + ".txt"), filemode='w', level=logging.DEBUG,
+                        format='%(asctime)s | %(levelname)s >> %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
+
+    logging.info('Start split_channels script')
+    logging.info('Preferences')
+    logging.info('    Input dir: %s', inDir)
+    logging.info('    Output dir: %s', outDir)
+    logging.info('    processed files format: %s', fileExt)
+    logging.info('    Save channels in different subfolders: %s', channelSubfolderPref)
+    logging.info('    Files processed in parallel: %i', parallelPref)
+    logging.info('    Writer threads: %i', writerThreads)
+    logging.info('    Stream one channel at a time: %s', streamPref and not autoscalePref)
+    logging.info('    Autoscale: %s', autoscalePref)
+    if shard is not None:
+        logging.info('    Shard: %i/%i', shard[0], shard[1])
+    catalog = MetadataCatalog(catalogPath)
+    logging.info('    Metadata catalog: %s', catalog.status)
+
+    inputs = []
+    for root, dirs, files in os.walk(inDir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(fileExt):
+                inputs.append((root, file))
+
+    # log lines and voxel sizes are merged in input order, whatever order the workers finish in
+    writer = AsyncWriter(writerThreads, 2 * (parallelPref + writerThreads))
+    pool = Executors.newFixedThreadPool(parallelPref)
+
+    # every series of a file is a task of its own, so the series of multi-position files are processed in parallel
+    files = selectShard(inputs, shard)
+    imageCount = len(files)
+    failedFiles = []
+    completed = False
+    try:
+        futures = [pool.submit(FileTask(root, file, number, 0, outDir, fileExt, channelSubfolderPref, catalog,
+                                        streamPref, autoscalePref, pool))
+                   for number, (root, file) in enumerate(files)]
+        for result in fileResults(futures):
+            for msg, args in result.logLines:
+                logging.info(msg, *args)
+            voxel_info += ''.join(result.voxelRows)
+            if result.error is not None:
+                logging.error('Could not process %s: %s', result.path, result.error)
+                if result.path not in failedFiles:
+                    failedFiles.append(result.path)
+        completed = True
+    finally:
+        # after an error, the queued files are dropped before the writer is flushed
+        stopPool(pool, not completed)
+        for path, error in writer.flush():
+            logging.error('Could not write %s: %s', path, error)
+        catalog.close()
+
+    if voxelPref:
+        with open(os.path.join(outDir, "VoxelSize" + shardSuffix + ".txt"), 'w') as output:
+            output.write(voxel_info)
+
+    logDuration(startTime, imageCount - len(failedFiles))
+    if failedFiles:
+        logging.error('%i files could not be processed:', len(failedFiles))
+        for path in failedFiles:
+            logging.error('    %s', path)
+
+    timer.report(outDir, "StageTimes" + shardSuffix)
+
+    IJ.log("\\Clear")
+    IJ.log("Finished")
+
+
+def show_gui():
+    gd = GenericDialog("Set split_channels.py Options")
+    gd.addStringField("File extension to be processed", ".nd2")
+    gd.addRadioButtonGroup("Save channels in different subfolders", channelSubfolderChoices, 1, 1,
+                           channelSubfolderChoices[0])
+    gd.addCheckbox("Voxel size", True)
+    gd.addNumericField("Files processed in parallel", 1, 0)
+    gd.addNumericField("Writer threads", 1, 0)
+    gd.addCheckbox("Stream one channel at a time (native pixel type, plain TIFF without ImageJ hyperstack info)",
+                   False)
+    gd.addCheckbox("Autoscale (imports the whole file)", False)
+    gd.showDialog()
+    if gd.wasCanceled():
+        return
+
+    fileExt = gd.getNextString()
+    channelSubfolderPref = gd.getNextRadioButton()
+    voxelPref = gd.getNextBoolean()
+    parallelPref = max(1, int(gd.getNextNumber()))
+    writerThreads = max(1, int(gd.getNextNumber()))
+    streamPref = gd.getNextBoolean()
+    autoscalePref = gd.getNextBoolean()
+
+    inDir = IJ.getDirectory("Choose Directory Containing Input Files (" + str(fileExt) + ')')
+    if inDir is None:
+        return
+    outDir = IJ.getDirectory("Choose Directory For Output")
+    if outDir is None:
+        return
+
+    run_split_channels(inDir, outDir, fileExt, channelSubfolderPref, voxelPref, parallelPref, writerThreads=writerThreads,
+                       streamPref=streamPref, autoscalePref=autoscalePref)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="split_channels.py", description="Split microscopy images into channels.")
+    parser.add_argument("--input", required=True, help="directory containing the input files")
+    parser.add_argument("--output", required=True, help="output directory")
+    parser.add_argument("--ext", default=".nd2", help="file extension to be processed")
+    parser.add_argument("--channel-subfolders", choices=channelSubfolderChoices, default=channelSubfolderChoices[0])
+    parser.add_argument("--no-voxel-size", action="store_true", help="do not write VoxelSize.txt")
+    parser.add_argument("--parallel", type=int, default=1, help="files processed in parallel")
+    parser.add_argument("--shard", type=parseShard, help="i/N: process only the i-th of N parts of the input list")
+    parser.add_argument("--writers", type=int, default=1, help="threads writing the output files")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream one channel at a time into Bio-Formats TIFFs instead of importing the whole file "
+                             "and saving ImageJ TIFFs")
+    parser.add_argument("--autoscale", action="store_true", help="autoscale the channels (no streaming)")
+    addCatalogArguments(parser)
+    return parser.parse_args(argv)
+
+
+def main():
+    if len(sys.argv) < 2:
+        show_gui()
+        return
+    args = parse_args(sys.argv[1:])
+    run_split_channels(args.input, args.output, args.ext, args.channel_subfolders, not args.no_voxel_size,
+                       max(1, args.parallel), args.shard, max(1, args.writers), args.stream, args.autoscale,
+                       args.catalog)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,457 @@
+"""Helpers shared by the toolbox scripts: stage timings, the background writer, array-job shards, the
+metadata catalog, ROI sets and summary tables.
+
+Fiji's Jython finds this module in Fiji.app/jars/Lib; copy it there together with the scripts.
+"""
+import os
+import json
+import logging
+import math
+import threading
+import time
+import Queue
+from ij.io import RoiEncoder
+from ij.measure import ResultsTable
+from java.lang import Throwable
+from java.util import Properties
+from java.util.concurrent import TimeUnit
+from java.util.zip import ZipEntry, ZipOutputStream
+from java.io import BufferedOutputStream, DataOutputStream, FileOutputStream
+from loci.formats import ImageReader, MetadataTools, FormatTools
+
+
+# Per-stage timing, written to StageTimes.json/.csv in the output directory
+class StageTimer(object):
+    """Collects the wall time (and bytes, where known) of every stage per file.
+
+    report() writes per-stage totals and percentiles to <name>.json and <name>.csv.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.records = []
+
+    def stage(self, stage, file=None, nbytes=None):
+        return TimedStage(self, stage, file, nbytes)
+
+    def add(self, stage, file, seconds, nbytes):
+        with self.lock:
+            self.records.append({'stage': stage, 'file': file, 'seconds': seconds, 'bytes': nbytes})
+
+    def summary(self):
+        stages = {}
+        for record in self.records:
+            stages.setdefault(record['stage'], []).append(record)
+        summary = {}
+        for stage, records in stages.items():
+            seconds = sorted(record['seconds'] for record in records)
+            nbytes = sum(record['bytes'] or 0 for record in records)
+            total = sum(seconds)
+            summary[stage] = {'count': len(seconds), 'total_s': total, 'mean_s': total / len(seconds),
+                              'p50_s': percentile(seconds, 50), 'p90_s': percentile(seconds, 90),
+                              'p99_s': percentile(seconds, 99), 'max_s': seconds[-1], 'bytes': nbytes,
+                              'MB_per_s': nbytes / total / 1e6 if total > 0 else None}
+        return summary
+
+    def report(self, outDir, name="StageTimes"):
+        with self.lock:
+            summary = self.summary()
+            records = list(self.records)
+        with open(os.path.join(outDir, name + ".json"), 'w') as f:
+            json.dump({'stages': summary, 'records': records}, f, indent=1, sort_keys=True)
+        columns = ['count', 'total_s', 'mean_s', 'p50_s', 'p90_s', 'p99_s', 'max_s', 'bytes', 'MB_per_s']
+        with open(os.path.join(outDir, name + ".csv"), 'w') as f:
+            f.write(','.join(['stage'] + columns) + '\n')
+            for stage in sorted(summary, key=lambda key: -summary[key]['total_s']):
+                f.write(','.join([stage] + [str(summary[stage][column]) for column in columns]) + '\n')
+
+
+class TimedStage(object):
+    def __init__(self, timer, stage, file, nbytes):
+        self.timer = timer
+        self.stage = stage
+        self.file = file
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.stage, self.file, time.time() - self.start, self.nbytes)
+        return False
+
+
+def percentile(sortedValues, p):
+    # nearest-rank percentile
+    rank = int(math.ceil(p / 100.0 * len(sortedValues)))
+    return sortedValues[max(rank, 1) - 1]
+
+
+timer = StageTimer()
+
+
+def timedSave(saveFunction, path):
+    with timer.stage("save", path) as stage:
+        saved = saveFunction(path)
+        if os.path.isfile(path):
+            stage.nbytes = os.path.getsize(path)
+    return saved
+
+
+# Background writer, so that images are encoded and written while the next one is processed
+class AsyncWriter(object):
+    """Saves finished images on background threads while the caller moves on to the next one.
+
+    The queue is bounded: submit() blocks while maxPending images are waiting, which caps the memory
+    held by unwritten images. flush() waits for all writes and returns the (path, error) of failed ones.
+    Once flush() has started, submit() raises IOError instead of waiting for writer threads that are gone.
+    """
+
+    def __init__(self, threads=1, maxPending=4):
+        self.queue = Queue.Queue(maxPending)
+        self.closed = False
+        self.errors = []
+        self.lock = threading.Lock()
+        self.threads = []
+        for i in range(max(1, threads)):
+            thread = threading.Thread(target=self.work, name="writer-%i" % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, saveFunction, path, imp=None, close=False):
+        """Queues saveFunction(path); imp is closed after writing if close is set."""
+        while True:
+            if self.closed:
+                raise IOError("the writer is closed, could not save " + path)
+            try:
+                self.queue.put((saveFunction, path, imp, close), True, 0.5)
+                return
+            except Queue.Full:
+                pass
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            saveFunction, path, imp, close = item
+            try:
+                if timedSave(saveFunction, path) is False:
+                    raise IOError("could not save " + path)
+            except (Exception, Throwable) as e:
+                with self.lock:
+                    self.errors.append((path, str(e)))
+            if close and imp is not None:
+                imp.changes = False
+                imp.close()
+
+    def flush(self):
+        self.closed = True
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        # images submitted while the writer was closing were never written
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not None:
+                self.errors.append((item[1], "submitted after the writer was closed"))
+        return self.errors
+
+
+def stopPool(pool, now=False):
+    """Shuts an executor down and waits for its running tasks, so that none of them submits to a writer
+    that is being flushed. With now, the queued tasks are dropped and the running ones interrupted."""
+    if now:
+        pool.shutdownNow()
+    else:
+        pool.shutdown()
+    while not pool.awaitTermination(1, TimeUnit.MINUTES):
+        pass
+
+
+# Batch runs: options, per-file results, output folders and the duration in the log
+class Options(object):
+    """The options of one run, read by all workers."""
+
+    def __init__(self, **options):
+        self.__dict__.update(options)
+
+
+class FileResult(object):
+    """Log lines and summary rows (VoxelSize.txt, PhysicalSize.txt) of one series of an input file, or the error
+    that stopped it, merged in input order by the main thread. The result of the first series holds the futures of
+    the file's other series.
+
+    Workers only ever write into their own result.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.logLines = []
+        self.voxelRows = []
+        self.error = None
+        self.seriesFutures = []
+
+    def info(self, msg, *args):
+        self.logLines.append((msg, args))
+
+
+def makeDir(path):
+    # several workers may want the same folder at the same time
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+def logDuration(startTime, imageCount):
+    duration = time.time() - startTime
+    logging.info('Processing finished')
+
+    duration_h, rest = divmod(duration, 3600)
+    duration_min, rest = divmod(rest, 60)
+    duration_s = int(round(rest))
+    if duration_h > 0:
+        logging.info('%i files procced in %i h, %i min and %i s', imageCount, duration_h, duration_min, duration_s)
+    elif duration_min > 0:
+        logging.info('%i files procced in %i min and %i s', imageCount, duration_min, duration_s)
+    else:
+        logging.info('%i files procced in %i s', imageCount, duration_s)
+
+
+# Functions to split the inputs between array jobs
+def selectShard(items, shard):
+    """Keeps every N-th item starting at i for shard (i, N), so N array jobs split the inputs between them."""
+    if shard is None:
+        return items
+    index, count = shard
+    return [item for k, item in enumerate(items) if k % count == index]
+
+
+def shardTag(shard):
+    # array jobs share the output dir, so every shard names its log and summary files after itself
+    return "" if shard is None else "_shard%iof%i" % shard
+
+
+def parseShard(value):
+    index, count = [int(part) for part in value.split('/')]
+    if not 0 <= index < count:
+        raise ValueError("shard must be i/N with 0 <= i < N, got " + value)
+    return index, count
+
+
+# Image metadata catalog shared by the scripts and runs
+catalogFile = os.path.join(os.path.expanduser("~"), ".FijiScriptToolbox", "catalog.sqlite")
+catalogColumns = ["seriesCount", "sizeX", "sizeY", "sizeZ", "sizeC", "sizeT", "bitDepth",
+                  "physicalSizeX", "physicalSizeY", "physicalSizeZ", "channelNames"]
+
+
+class MetadataCatalog(object):
+    """Image metadata shared by all toolbox scripts and runs, keyed by path, series numbering and series, and
+    valid while the file keeps its mtime and size.
+
+    Stored in SQLite through the sqlite-jdbc driver. Without a path, or if the driver is not among Fiji's jars or
+    the database can't be opened, the catalog is disabled: lookups miss and stores are dropped, so every file is
+    read with Bio-Formats as before. A failing lookup or store (e.g. the database locked by another node for
+    longer than busyTimeout ms) counts as a miss and is logged once.
+    """
+
+    busyTimeout = 30000
+
+    def __init__(self, path=catalogFile):
+        self.lock = threading.Lock()
+        self.connection = None
+        self.failed = False
+        if not path:
+            self.status = "disabled"
+            return
+        try:
+            from org.sqlite import JDBC
+        except ImportError:
+            self.status = "disabled (sqlite-jdbc not found)"
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.connection = JDBC().connect("jdbc:sqlite:" + path, Properties())
+            statement = self.connection.createStatement()
+            try:
+                # array jobs on several nodes may share the file; wait for their writes instead of failing
+                statement.executeUpdate("PRAGMA busy_timeout = %i" % self.busyTimeout)
+                statement.executeUpdate(
+                    "CREATE TABLE IF NOT EXISTS series (path TEXT NOT NULL, flattened INTEGER NOT NULL, "
+                    "series INTEGER NOT NULL, mtime REAL, size INTEGER, seriesCount INTEGER, sizeX INTEGER, "
+                    "sizeY INTEGER, sizeZ INTEGER, sizeC INTEGER, sizeT INTEGER, bitDepth INTEGER, physicalSizeX REAL, "
+                    "physicalSizeY REAL, physicalSizeZ REAL, channelNames TEXT, PRIMARY KEY (path, flattened, series))")
+            finally:
+                statement.close()
+        except (Exception, Throwable) as e:
+            self.close()
+            self.status = "disabled (%s: %s)" % (path, e)
+            return
+        self.status = path
+
+    def fail(self, action, path, error):
+        if not self.failed:
+            self.failed = True
+            logging.warning('Metadata catalog: could not %s %s, reading the metadata from the file instead: %s',
+                            action, path, error)
+
+    def lookup(self, path, series=0, flattenedResolutions=True):
+        """Returns the stored record of path, or None if there is none, the file changed since or the catalog
+        can't be read."""
+        if self.connection is None:
+            return None
+        try:
+            with self.lock:
+                statement = self.connection.prepareStatement(
+                    "SELECT mtime, size, " + ", ".join(catalogColumns) +
+                    " FROM series WHERE path = ? AND flattened = ? AND series = ?")
+                try:
+                    statement.setString(1, path)
+                    statement.setInt(2, int(flattenedResolutions))
+                    statement.setInt(3, series)
+                    rows = statement.executeQuery()
+                    try:
+                        if not rows.next() or rows.getDouble(1) != os.path.getmtime(path) \
+                                or rows.getLong(2) != os.path.getsize(path):
+                            return None
+                        record = dict((column, rows.getObject(i + 3)) for i, column in enumerate(catalogColumns))
+                    finally:
+                        rows.close()
+                finally:
+                    statement.close()
+            record['channelNames'] = json.loads(record['channelNames'])
+        except (Exception, Throwable) as e:
+            self.fail("look up", path, e)
+            return None
+        return record
+
+    def store(self, path, record, series=0, flattenedResolutions=True):
+        if self.connection is None:
+            return
+        try:
+            values = [path, int(flattenedResolutions), series, os.path.getmtime(path), os.path.getsize(path)]
+            values += [json.dumps(record[column]) if column == "channelNames" else record[column]
+                       for column in catalogColumns]
+            with self.lock:
+                statement = self.connection.prepareStatement(
+                    "INSERT OR REPLACE INTO series (path, flattened, series, mtime, size, " +
+                    ", ".join(catalogColumns) + ") VALUES (" + ", ".join(["?"] * len(values)) + ")")
+                try:
+                    for i, value in enumerate(values):
+                        statement.setObject(i + 1, value)
+                    statement.executeUpdate()
+                finally:
+                    statement.close()
+        except (Exception, Throwable) as e:
+            self.fail("record", path, e)
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except (Exception, Throwable):
+                pass
+            self.connection = None
+
+
+def addCatalogArguments(parser):
+    """Adds --catalog and --no-catalog; args.catalog is then the catalog path, or None to read every file."""
+    parser.add_argument("--catalog", default=catalogFile,
+                        help="SQLite file of the metadata catalog, e.g. one per node for array jobs")
+    parser.add_argument("--no-catalog", dest="catalog", action="store_const", const=None,
+                        help="read the metadata from every file instead of the catalog")
+
+
+def catalogRecord(reader, omeMeta, series=0):
+    """Reads the catalog record of one series from an initialised reader and its OME metadata."""
+    physicalSizes = [omeMeta.getPixelsPhysicalSizeX(series), omeMeta.getPixelsPhysicalSizeY(series),
+                     omeMeta.getPixelsPhysicalSizeZ(series)]
+    physicalSizes = [None if size is None else size.value() for size in physicalSizes]
+    return {'seriesCount': reader.getSeriesCount(),
+            'sizeX': omeMeta.getPixelsSizeX(series).getValue(), 'sizeY': omeMeta.getPixelsSizeY(series).getValue(),
+            'sizeZ': omeMeta.getPixelsSizeZ(series).getValue(), 'sizeC': omeMeta.getPixelsSizeC(series).getValue(),
+            'sizeT': omeMeta.getPixelsSizeT(series).getValue(),
+            'bitDepth': 8 * FormatTools.getBytesPerPixel(reader.getPixelType()),
+            'physicalSizeX': physicalSizes[0], 'physicalSizeY': physicalSizes[1], 'physicalSizeZ': physicalSizes[2],
+            'channelNames': [omeMeta.getChannelName(series, c) for c in range(omeMeta.getChannelCount(series))]}
+
+
+def readMetadata(path, catalog, series=0, flattenedResolutions=True):
+    """Returns the catalog record of one series of path. On a miss, all series are read and recorded at once.
+
+    Without flattenedResolutions, the levels of pyramid files are resolutions of one series, not series of their own.
+    """
+    record = catalog.lookup(path, series, flattenedResolutions)
+    if record is None:
+        reader = ImageReader()
+        omeMeta = MetadataTools.createOMEXMLMetadata()
+        reader.setMetadataStore(omeMeta)
+        reader.setFlattenedResolutions(flattenedResolutions)
+        reader.setId(path)
+        try:
+            for s in range(reader.getSeriesCount()):
+                reader.setSeries(s)
+                seriesRecord = catalogRecord(reader, omeMeta, s)
+                catalog.store(path, seriesRecord, s, flattenedResolutions)
+                if s == series:
+                    record = seriesRecord
+        finally:
+            reader.close()
+    return record
+
+
+def seriesTag(series, seriesCount):
+    # single-series files keep their output names
+    return "" if seriesCount == 1 else "_S%i" % series
+
+
+def fileResults(futures):
+    """Yields the results of file tasks in input order, each followed by those of the file's other series, which
+    the task of the first series submits once it knows their number (as seriesFutures of its result)."""
+    for future in futures:
+        result = future.get()
+        yield result
+        for seriesFuture in result.seriesFutures:
+            yield seriesFuture.get()
+
+
+# ROI sets and summary tables
+def saveRois(rois, names, path):
+    """Writes the ROIs to a zip file in the RoiManager format."""
+    zos = ZipOutputStream(BufferedOutputStream(FileOutputStream(path)))
+    out = DataOutputStream(zos)
+    encoder = RoiEncoder(out)
+    for roi, name in zip(rois, names):
+        zos.putNextEntry(ZipEntry(name + ".roi"))
+        encoder.write(roi)
+        out.flush()
+    out.close()
+
+
+def summaryTable(rows):
+    """Collects summary rows, each a list of (column, value) pairs, in a results table saved like the Summary
+    window of Analyze Particles."""
+    table = ResultsTable()
+    table.showRowNumbers(False)
+    for row in rows:
+        table.incrementCounter()
+        for name, value in row:
+            if isinstance(value, basestring):
+                table.addValue(name, value)
+            else:
+                table.addValue(name, float(value))
+    return table